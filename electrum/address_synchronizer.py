@@ -184,6 +184,15 @@ class AddressSynchronizer(Logger):
         if self.synchronizer:
             self.synchronizer.add(address)
 
+    def add_addresses(self, addresses: Sequence[str]):
+        new_addresses = [addr for addr in addresses if not self.db.get_addr_history(addr)]
+        for addr in new_addresses:
+            self.db.history[addr] = []
+        if new_addresses:
+            self.set_up_to_date(False)
+        if self.synchronizer and addresses:
+            self.synchronizer.add_many(addresses)
+
     def get_conflicting_transactions(self, tx_hash, tx: Transaction, include_self=False):
         """Returns a set of transaction hashes from the wallet history that are
         directly conflicting with tx, i.e. they have common outpoints being
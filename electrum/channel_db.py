@@ -26,8 +26,9 @@
 import time
 import random
 import os
+import pickle
 from collections import defaultdict
-from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
+from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set, Iterable
 import binascii
 import base64
 import asyncio
@@ -35,6 +36,8 @@ import asyncio
 
 from .sql_db import SqlDB, sql
 from . import constants
+from . import ecc
+from .crypto import sha256d
 from .util import bh2u, profiler, get_headers_dir, bfh, is_ip_address, list_enabled_bits
 from .logging import Logger
 from .lnutil import LN_GLOBAL_FEATURES_KNOWN_SET, LNPeerAddr, format_short_channel_id, ShortChannelID
@@ -116,6 +119,33 @@ class Policy(NamedTuple):
         return self.key[8:]
 
 
+class GraphEdge(NamedTuple):
+    """A usable direction of a channel, with what path finding needs to
+    know about it. htlc_maximum_msat also takes the capacity into account.
+    """
+    short_channel_id: ShortChannelID
+    start_node: bytes
+    fee_base_msat: int
+    fee_proportional_millionths: int
+    cltv_expiry_delta: int
+    htlc_minimum_msat: int
+    htlc_maximum_msat: Optional[int]
+    has_end_policy: bool
+
+    @staticmethod
+    def from_channel(channel_info: ChannelInfo, policy: Optional[Policy], end_policy: Optional[Policy]) -> Optional['GraphEdge']:
+        if policy is None or policy.is_disabled():
+            return None
+        htlc_maximum_msat = policy.htlc_maximum_msat
+        if channel_info.capacity_sat is not None:
+            capacity_msat = channel_info.capacity_sat * 1000 + 999
+            if htlc_maximum_msat is None or capacity_msat < htlc_maximum_msat:
+                htlc_maximum_msat = capacity_msat
+        # note: positional arguments, this runs for every channel in load_data
+        return GraphEdge(channel_info.short_channel_id, policy.key[8:], policy.fee_base_msat,
+                         policy.fee_proportional_millionths, policy.cltv_expiry_delta,
+                         policy.htlc_minimum_msat, htlc_maximum_msat, end_policy is not None)
+
 
 class NodeInfo(NamedTuple):
     node_id: bytes
@@ -234,6 +264,9 @@ alias STRING(64),
 PRIMARY KEY(node_id)
 )"""
 
+# bump when the in-memory graph changes shape
+SNAPSHOT_VERSION = 1
+
 
 class ChannelDB(SqlDB):
 
@@ -253,6 +286,9 @@ class ChannelDB(SqlDB):
         # node_id -> (host, port, ts)
         self._addresses = defaultdict(set)  # type: Dict[bytes, Set[Tuple[str, int, int]]]
         self._channels_for_node = defaultdict(set)
+        # for path finding: end node -> short_channel_id -> edge into the node.
+        # kept up to date with _channels and _policies by _update_edges
+        self._edges_to_node = defaultdict(dict)  # type: Dict[bytes, Dict[ShortChannelID, GraphEdge]]
         self.data_loaded = asyncio.Event()
         self.network = network # only for callback
 
@@ -334,6 +370,7 @@ class ChannelDB(SqlDB):
         self._channels[channel_info.short_channel_id] = channel_info
         self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
         self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
+        self._update_edges(channel_info)
         self.save_channel(channel_info)
 
     def print_change(self, old_policy: Policy, new_policy: Policy):
@@ -354,6 +391,16 @@ class ChannelDB(SqlDB):
             self.logger.info(f'message_flags: {old_policy.message_flags} -> {new_policy.message_flags}')
 
     def add_channel_updates(self, payloads, max_age=None, verify=True) -> CategorizedChannelUpdates:
+        categorized_chan_upds = self.categorize_channel_updates(payloads, max_age=max_age)
+        # verify the whole batch before touching the in-memory state
+        if verify:
+            self.verify_channel_updates(categorized_chan_upds.good)
+        return self.apply_channel_updates(categorized_chan_upds)
+
+    def categorize_channel_updates(self, payloads, max_age=None) -> CategorizedChannelUpdates:
+        """Sort channel updates by what add_channel_updates would do with them.
+        Nothing is stored; the good ones still need to be verified.
+        """
         orphaned = []
         expired = []
         deprecated = []
@@ -388,13 +435,6 @@ class ChannelDB(SqlDB):
                 deprecated.append(payload)
                 continue
             good.append(payload)
-            if verify:
-                self.verify_channel_update(payload)
-            policy = Policy.from_msg(payload)
-            self._policies[key] = policy
-            self.save_policy(policy)
-        #
-        self.update_counts()
         return CategorizedChannelUpdates(
             orphaned=orphaned,
             expired=expired,
@@ -403,6 +443,30 @@ class ChannelDB(SqlDB):
             to_delete=to_delete,
         )
 
+    def apply_channel_updates(self, categorized_chan_upds: CategorizedChannelUpdates) -> CategorizedChannelUpdates:
+        """Store the good (and verified) channel updates."""
+        good = []
+        deprecated = list(categorized_chan_upds.deprecated)
+        new_policies = {}
+        for payload in categorized_chan_upds.good:
+            policy = Policy.from_msg(payload)
+            key = (policy.start_node, policy.short_channel_id)
+            # a newer update might have been stored since the batch was categorized
+            old_policy = self._policies.get(key)
+            if old_policy and policy.timestamp <= old_policy.timestamp:
+                deprecated.append(payload)
+                continue
+            self._policies[key] = policy
+            new_policies[key] = policy
+            good.append(payload)
+        self._update_edges_of_policies(new_policies)
+        # a single sql request (and transaction) for the whole batch
+        if new_policies:
+            self.save_policies(list(new_policies.values()))
+        #
+        self.update_counts()
+        return categorized_chan_upds._replace(good=good, deprecated=deprecated)
+
     def add_channel_update(self, payload):
         # called from add_own_channel
         # the update may be categorized as deprecated because of caching
@@ -417,9 +481,9 @@ class ChannelDB(SqlDB):
         self.conn.commit()
 
     @sql
-    def save_policy(self, policy):
+    def save_policies(self, policies: Sequence[Policy]):
         c = self.conn.cursor()
-        c.execute("""REPLACE INTO policy (key, cltv_expiry_delta, htlc_minimum_msat, htlc_maximum_msat, fee_base_msat, fee_proportional_millionths, channel_flags, message_flags, timestamp) VALUES (?,?,?,?,?,?,?,?,?)""", list(policy))
+        c.executemany("""REPLACE INTO policy (key, cltv_expiry_delta, htlc_minimum_msat, htlc_maximum_msat, fee_base_msat, fee_proportional_millionths, channel_flags, message_flags, timestamp) VALUES (?,?,?,?,?,?,?,?,?)""", [list(policy) for policy in policies])
 
     @sql
     def delete_policy(self, node_id, short_channel_id):
@@ -438,9 +502,9 @@ class ChannelDB(SqlDB):
         c.execute("""DELETE FROM channel_info WHERE short_channel_id=?""", (short_channel_id,))
 
     @sql
-    def save_node(self, node_info):
+    def save_nodes(self, node_infos: Sequence[NodeInfo]):
         c = self.conn.cursor()
-        c.execute("REPLACE INTO node_info (node_id, features, timestamp, alias) VALUES (?,?,?,?)", list(node_info))
+        c.executemany("REPLACE INTO node_info (node_id, features, timestamp, alias) VALUES (?,?,?,?)", [list(node_info) for node_info in node_infos])
 
     @sql
     def save_node_address(self, node_id, peer, now):
@@ -448,27 +512,32 @@ class ChannelDB(SqlDB):
         c.execute("REPLACE INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)", (node_id, peer.host, peer.port, now))
 
     @sql
-    def save_node_addresses(self, node_id, node_addresses):
+    def save_node_addresses(self, node_addresses: Sequence[Address]):
         c = self.conn.cursor()
-        for addr in node_addresses:
-            c.execute("SELECT * FROM address WHERE node_id=? AND host=? AND port=?", (addr.node_id, addr.host, addr.port))
-            r = c.fetchall()
-            if r == []:
-                c.execute("INSERT INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)", (addr.node_id, addr.host, addr.port, 0))
-
-    def verify_channel_update(self, payload):
-        short_channel_id = payload['short_channel_id']
-        short_channel_id = ShortChannelID(short_channel_id)
-        if constants.net.rev_genesis_bytes() != payload['chain_hash']:
-            raise Exception('wrong chain hash')
-        if not verify_sig_for_channel_update(payload, payload['start_node']):
-            raise Exception(f'failed verifying channel update for {short_channel_id}')
+        # (node_id, host, port) is the primary key; existing rows keep their timestamp
+        c.executemany("INSERT OR IGNORE INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)",
+                      [(addr.node_id, addr.host, addr.port, 0) for addr in node_addresses])
+
+    def verify_channel_updates(self, payloads):
+        # note: this only reads the payloads, so it can run outside the event loop thread
+        chain_hash = constants.net.rev_genesis_bytes()
+        for payload in payloads:
+            if chain_hash != payload['chain_hash']:
+                raise Exception('wrong chain hash')
+        items = [(payload['start_node'], payload['signature'], sha256d(payload['raw'][2+64:]))
+                 for payload in payloads]
+        if not ecc.verify_signatures(items):
+            # find the culprit for the error message
+            for payload in payloads:
+                if not verify_sig_for_channel_update(payload, payload['start_node']):
+                    short_channel_id = ShortChannelID(payload['short_channel_id'])
+                    raise Exception(f'failed verifying channel update for {short_channel_id}')
 
     def add_node_announcement(self, msg_payloads):
         if type(msg_payloads) is dict:
             msg_payloads = [msg_payloads]
-        old_addr = None
         new_nodes = {}
+        new_addresses = []
         for msg_payload in msg_payloads:
             try:
                 node_info, node_addresses = NodeInfo.from_msg(msg_payload)
@@ -487,11 +556,15 @@ class ChannelDB(SqlDB):
                 continue
             # save
             self._nodes[node_id] = node_info
-            self.save_node(node_info)
+            new_nodes[node_id] = node_info
             for addr in node_addresses:
                 self._addresses[node_id].add((addr.host, addr.port, 0))
-            self.save_node_addresses(node_id, node_addresses)
-
+            new_addresses.extend(node_addresses)
+        # write the whole batch in one sql request
+        if new_nodes:
+            self.save_nodes(list(new_nodes.values()))
+        if new_addresses:
+            self.save_node_addresses(new_addresses)
         self.logger.debug("on_node_announcement: %d/%d"%(len(new_nodes), len(msg_payloads)))
         self.update_counts()
 
@@ -516,6 +589,7 @@ class ChannelDB(SqlDB):
             for k in l:
                 self._policies.pop(k)
                 self.delete_policy(*k)
+            self._update_edges_of_policies(l)
             self.update_counts()
             self.logger.info(f'Deleting {len(l)} old policies')
 
@@ -543,44 +617,146 @@ class ChannelDB(SqlDB):
         if channel_info:
             self._channels_for_node[channel_info.node1_id].remove(channel_info.short_channel_id)
             self._channels_for_node[channel_info.node2_id].remove(channel_info.short_channel_id)
+            self._update_edges(channel_info, removed=True)
         # delete from database
         self.delete_channel(short_channel_id)
 
+    def _update_edges(self, channel_info: ChannelInfo, *, removed=False) -> None:
+        """Updates both edges of a channel, after its info or one of its
+        policies changed. Each policy matters for both edges.
+        """
+        short_channel_id = channel_info.short_channel_id
+        policy1 = self._policies.get((channel_info.node1_id, short_channel_id))
+        policy2 = self._policies.get((channel_info.node2_id, short_channel_id))
+        for end_node, policy, end_policy in ((channel_info.node2_id, policy1, policy2),
+                                             (channel_info.node1_id, policy2, policy1)):
+            edge = None if removed else GraphEdge.from_channel(channel_info, policy, end_policy)
+            if edge is not None:
+                self._edges_to_node[end_node][short_channel_id] = edge
+            elif short_channel_id in self._edges_to_node.get(end_node, {}):
+                del self._edges_to_node[end_node][short_channel_id]
+
+    def _update_edges_of_policies(self, keys: Iterable[Tuple[bytes, ShortChannelID]]) -> None:
+        for short_channel_id in set(short_channel_id for start_node, short_channel_id in keys):
+            channel_info = self._channels.get(short_channel_id)
+            if channel_info is not None:
+                self._update_edges(channel_info)
+
+    def rebuild_edges(self) -> None:
+        """Builds the path finding edges of all channels from scratch,
+        after _channels and _policies were filled directly.
+        """
+        edges_to_node = defaultdict(dict)
+        policies = self._policies
+        from_channel = GraphEdge.from_channel
+        for short_channel_id, channel_info in list(self._channels.items()):
+            policy1 = policies.get((channel_info.node1_id, short_channel_id))
+            policy2 = policies.get((channel_info.node2_id, short_channel_id))
+            edge = from_channel(channel_info, policy1, policy2)
+            if edge is not None:
+                edges_to_node[channel_info.node2_id][short_channel_id] = edge
+            edge = from_channel(channel_info, policy2, policy1)
+            if edge is not None:
+                edges_to_node[channel_info.node1_id][short_channel_id] = edge
+        self._edges_to_node = edges_to_node
+
     def get_node_addresses(self, node_id):
         return self._addresses.get(node_id)
 
-    @sql
+    def get_snapshot_path(self):
+        return self.path + '.snapshot'
+
+    def _get_db_stat(self):
+        st = os.stat(self.path)
+        return st.st_size, st.st_mtime_ns
+
+    def on_clean_close(self):
+        # only a fully loaded graph mirrors the database
+        if not self.data_loaded.is_set():
+            return
+        try:
+            self.write_snapshot()
+        except Exception as e:
+            self.logger.info(f'could not write snapshot: {repr(e)}')
+
     @profiler
-    def load_data(self):
+    def write_snapshot(self):
+        """Writes the in-memory graph next to the database, tagged with the
+        size and mtime of the database file. The snapshot is only valid for
+        as long as the database is not written to.
+        """
+        data = (SNAPSHOT_VERSION, self._get_db_stat(), self._channels, self._policies, self._nodes,
+                dict(self._addresses), dict(self._channels_for_node))
+        path = self.get_snapshot_path()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _load_snapshot(self) -> bool:
+        try:
+            with open(self.get_snapshot_path(), 'rb') as f:
+                data = pickle.load(f)
+            version, db_stat, channels, policies, nodes, addresses, channels_for_node = data
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            self.logger.info(f'could not read snapshot: {repr(e)}')
+            return False
+        if version != SNAPSHOT_VERSION or db_stat != self._get_db_stat():
+            self.logger.info('snapshot is outdated')
+            return False
+        self._channels.update(channels)
+        self._policies.update(policies)
+        self._nodes.update(nodes)
+        for node_id, addresses_for_node in addresses.items():
+            self._addresses[node_id].update(addresses_for_node)
+        for node_id, short_channel_ids in channels_for_node.items():
+            self._channels_for_node[node_id].update(short_channel_ids)
+        return True
+
+    def _load_from_database(self):
         c = self.conn.cursor()
         c.execute("""SELECT * FROM address""")
-        for x in c:
-            node_id, host, port, timestamp = x
+        for node_id, host, port, timestamp in c:
             self._addresses[node_id].add((str(host), int(port), int(timestamp or 0)))
+        # note: rows are unpacked directly, and the node->channels index is built
+        #       in the same pass, as this is the bulk of the startup time
+        channels_for_node = self._channels_for_node
         c.execute("""SELECT * FROM channel_info""")
-        for x in c:
-            x = (ShortChannelID.normalize(x[0]), *x[1:])
-            ci = ChannelInfo(*x)
-            self._channels[ci.short_channel_id] = ci
+        for short_channel_id, node1_id, node2_id, capacity_sat in c:
+            short_channel_id = ShortChannelID(short_channel_id)
+            self._channels[short_channel_id] = ChannelInfo(short_channel_id, node1_id, node2_id, capacity_sat)
+            channels_for_node[node1_id].add(short_channel_id)
+            channels_for_node[node2_id].add(short_channel_id)
         c.execute("""SELECT * FROM node_info""")
-        for x in c:
-            ni = NodeInfo(*x)
-            self._nodes[ni.node_id] = ni
+        self._nodes.update((x[0], NodeInfo._make(x)) for x in c)
         c.execute("""SELECT * FROM policy""")
-        for x in c:
-            p = Policy(*x)
-            self._policies[(p.start_node, p.short_channel_id)] = p
-        for channel_info in self._channels.values():
-            self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
-            self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
+        self._policies.update(((x[0][8:], ShortChannelID(x[0][0:8])), Policy._make(x)) for x in c)
+
+    @sql
+    @profiler
+    def load_data(self):
+        """Loads the graph, from the snapshot written on the last clean
+        shutdown if the database has not changed since, from the database
+        otherwise. data_loaded is set as soon as channels, policies, nodes
+        and addresses are all in memory; only the semi-orphaned statistic
+        is computed after that, when gossip may already be modifying the
+        graph.
+        """
+        if not self._load_snapshot():
+            self._load_from_database()
+        self.rebuild_edges()
         self.logger.info(f'load data {len(self._channels)} {len(self._policies)} {len(self._channels_for_node)}')
         self.update_counts()
-        self.count_incomplete_channels()
+        # the graph is usable from here on; statistics can wait
         self.data_loaded.set()
+        self.count_incomplete_channels()
 
     def count_incomplete_channels(self):
         out = set()
-        for short_channel_id, ci in self._channels.items():
+        # iterate over a copy, the event loop thread may be adding channels
+        for short_channel_id, ci in list(self._channels.items()):
             p1 = self.get_policy_for_node(short_channel_id, ci.node1_id)
             p2 = self.get_policy_for_node(short_channel_id, ci.node2_id)
             if p1 is None or p2 is not None:
@@ -596,3 +772,8 @@ class ChannelDB(SqlDB):
     def get_channels_for_node(self, node_id) -> Set[bytes]:
         """Returns the set of channels that have node_id as one of the endpoints."""
         return self._channels_for_node.get(node_id) or set()
+
+    def get_edges_to_node(self, node_id) -> Iterable[GraphEdge]:
+        """Returns the usable edges that end in node_id, one per channel."""
+        edges = self._edges_to_node.get(node_id)
+        return edges.values() if edges else ()
@@ -34,7 +34,7 @@ import operator
 import asyncio
 import inspect
 from functools import wraps, partial
-from itertools import repeat
+from itertools import repeat, islice
 from decimal import Decimal
 from typing import Optional, TYPE_CHECKING, Dict, List
 
@@ -162,6 +162,15 @@ class Commands:
             self._callback()
         return result
 
+    async def _run_blocking(self, wallet: Optional[Abstract_Wallet], func, *args, **kwargs):
+        """Runs func, a synchronous function that only uses wallet methods
+        taking the wallet lock, in a worker thread of the daemon, so that
+        it does not stall the event loop. Offline, it is simply called.
+        """
+        if self.daemon:
+            return await self.daemon.run_blocking_command(partial(func, *args, **kwargs), wallet=wallet)
+        return func(*args, **kwargs)
+
     @command('')
     async def commands(self):
         """List of commands"""
@@ -303,13 +312,15 @@ class Commands:
     async def listunspent(self, wallet: Abstract_Wallet = None):
         """List unspent outputs. Returns the list of unspent transaction
         outputs in your wallet."""
-        coins = []
-        for txin in wallet.get_utxos():
-            d = txin.to_json()
-            v = d.pop("value_sats")
-            d["value"] = str(Decimal(v)/COIN) if v is not None else None
-            coins.append(d)
-        return coins
+        def get_coins():
+            coins = []
+            for txin in wallet.get_utxos():
+                d = txin.to_json()
+                v = d.pop("value_sats")
+                d["value"] = str(Decimal(v)/COIN) if v is not None else None
+                coins.append(d)
+            return coins
+        return await self._run_blocking(wallet, get_coins)
 
     @command('n')
     async def getaddressunspent(self, address):
@@ -362,7 +373,7 @@ class Commands:
             pubkey = ecc.ECPrivkey(privkey2).get_public_key_bytes(compressed=compressed).hex()
             tx.sign({pubkey:(privkey2, compressed)})
         else:
-            wallet.sign_transaction(tx, password)
+            await self._run_blocking(wallet, wallet.sign_transaction, tx, password)
         return tx.serialize()
 
     @command('')
@@ -429,7 +440,7 @@ class Commands:
     @command('w')
     async def getbalance(self, wallet: Abstract_Wallet = None):
         """Return the balance of your wallet. """
-        c, u, x = wallet.get_balance()
+        c, u, x = await self._run_blocking(wallet, wallet.get_balance)
         l = wallet.lnworker.get_balance() if wallet.lnworker else None
         out = {"confirmed": str(Decimal(c)/COIN)}
         if u:
@@ -518,17 +529,17 @@ class Commands:
         """Sweep private keys. Returns a transaction that spends UTXOs from
         privkey to a destination address. The transaction is not
         broadcasted."""
-        from .wallet import sweep
+        from .wallet import sweep_async
         tx_fee = satoshis(fee)
         privkeys = privkey.split()
         self.nocheck = nocheck
         #dest = self._resolver(destination)
-        tx = sweep(privkeys,
-                   network=self.network,
-                   config=self.config,
-                   to_address=destination,
-                   fee=tx_fee,
-                   imax=imax)
+        tx = await sweep_async(privkeys,
+                               network=self.network,
+                               config=self.config,
+                               to_address=destination,
+                               fee=tx_fee,
+                               imax=imax)
         return tx.serialize() if tx else None
 
     @command('wp')
@@ -587,18 +598,19 @@ class Commands:
         tx_fee = satoshis(fee)
         domain_addr = from_addr.split(',') if from_addr else None
         domain_coins = from_coins.split(',') if from_coins else None
-        tx = self._mktx(wallet,
-                        [(destination, amount)],
-                        fee=tx_fee,
-                        feerate=feerate,
-                        change_addr=change_addr,
-                        domain_addr=domain_addr,
-                        domain_coins=domain_coins,
-                        nocheck=nocheck,
-                        unsigned=unsigned,
-                        rbf=rbf,
-                        password=password,
-                        locktime=locktime)
+        tx = await self._run_blocking(wallet, self._mktx,
+                                      wallet,
+                                      [(destination, amount)],
+                                      fee=tx_fee,
+                                      feerate=feerate,
+                                      change_addr=change_addr,
+                                      domain_addr=domain_addr,
+                                      domain_coins=domain_coins,
+                                      nocheck=nocheck,
+                                      unsigned=unsigned,
+                                      rbf=rbf,
+                                      password=password,
+                                      locktime=locktime)
         return tx.serialize()
 
     @command('wp')
@@ -608,26 +620,40 @@ class Commands:
         tx_fee = satoshis(fee)
         domain_addr = from_addr.split(',') if from_addr else None
         domain_coins = from_coins.split(',') if from_coins else None
-        tx = self._mktx(wallet,
-                        outputs,
-                        fee=tx_fee,
-                        feerate=feerate,
-                        change_addr=change_addr,
-                        domain_addr=domain_addr,
-                        domain_coins=domain_coins,
-                        nocheck=nocheck,
-                        unsigned=unsigned,
-                        rbf=rbf,
-                        password=password,
-                        locktime=locktime)
+        tx = await self._run_blocking(wallet, self._mktx,
+                                      wallet,
+                                      outputs,
+                                      fee=tx_fee,
+                                      feerate=feerate,
+                                      change_addr=change_addr,
+                                      domain_addr=domain_addr,
+                                      domain_coins=domain_coins,
+                                      nocheck=nocheck,
+                                      unsigned=unsigned,
+                                      rbf=rbf,
+                                      password=password,
+                                      locktime=locktime)
         return tx.serialize()
 
     @command('w')
-    async def onchain_history(self, year=None, show_addresses=False, show_fiat=False, wallet: Abstract_Wallet = None):
-        """Wallet onchain history. Returns the transaction history of your wallet."""
-        kwargs = {
-            'show_addresses': show_addresses,
-        }
+    async def onchain_history(self, year=None, show_addresses=False, show_fiat=False,
+                              from_height=None, to_height=None, limit=None, after_txid=None,
+                              wallet: Abstract_Wallet = None):
+        """Wallet onchain history. Returns the transaction history of your wallet.
+        Use limit and after_txid to page through the history; the summary then covers
+        the returned page only, which is marked with summary_scope 'page'."""
+        kwargs = self._get_history_kwargs(year=year, show_fiat=show_fiat)
+        history = await self._run_blocking(wallet, wallet.get_detailed_history,
+                                           show_addresses=show_addresses,
+                                           from_height=from_height,
+                                           to_height=to_height,
+                                           limit=limit,
+                                           after_txid=after_txid,
+                                           **kwargs)
+        return json_encode(history)
+
+    def _get_history_kwargs(self, *, year=None, show_fiat=False):
+        kwargs = {}
         if year:
             import time
             start_date = datetime.datetime(year, 1, 1)
@@ -638,7 +664,17 @@ class Commands:
             from .exchange_rate import FxThread
             fx = FxThread(self.config, None)
             kwargs['fx'] = fx
-        return json_encode(wallet.get_detailed_history(**kwargs))
+        return kwargs
+
+    def _iter_onchain_history(self, year=None, show_addresses=False, show_fiat=False,
+                              from_height=None, to_height=None, after_txid=None,
+                              wallet: Abstract_Wallet = None):
+        kwargs = self._get_history_kwargs(year=year, show_fiat=show_fiat)
+        return wallet.iter_detailed_history(show_addresses=show_addresses,
+                                            from_height=from_height,
+                                            to_height=to_height,
+                                            after_txid=after_txid,
+                                            **kwargs)
 
     @command('w')
     async def init_lightning(self, wallet: Abstract_Wallet = None):
@@ -683,10 +719,22 @@ class Commands:
         return results
 
     @command('w')
-    async def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False, wallet: Abstract_Wallet = None):
+    async def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False,
+                            limit=None, after_address=None, wallet: Abstract_Wallet = None):
         """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results."""
-        out = []
-        for addr in wallet.get_addresses():
+        items = self._iter_addresses(receiving=receiving, change=change, labels=labels, frozen=frozen,
+                                     unused=unused, funded=funded, balance=balance,
+                                     after_address=after_address, wallet=wallet)
+        return await self._run_blocking(wallet, lambda: list(islice(items, limit)))
+
+    def _iter_addresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False,
+                        after_address=None, wallet: Abstract_Wallet = None):
+        addresses = wallet.get_addresses()
+        if after_address is not None:
+            if after_address not in addresses:
+                raise Exception(f'address not in wallet: {after_address}')
+            addresses = addresses[addresses.index(after_address) + 1:]
+        for addr in addresses:
             if frozen and not wallet.is_frozen_address(addr):
                 continue
             if receiving and wallet.is_change(addr):
@@ -704,8 +752,7 @@ class Commands:
                 item += (format_satoshis(sum(wallet.get_addr_balance(addr))),)
             if labels:
                 item += (repr(wallet.labels.get(addr, '')),)
-            out.append(item)
-        return out
+            yield item
 
     @command('n')
     async def gettransaction(self, txid, wallet: Abstract_Wallet = None):
@@ -766,9 +813,14 @@ class Commands:
     #    pass
 
     @command('w')
-    async def list_requests(self, pending=False, expired=False, paid=False, wallet: Abstract_Wallet = None):
+    async def list_requests(self, pending=False, expired=False, paid=False, limit=None, after_key=None,
+                            wallet: Abstract_Wallet = None):
         """List the payment requests you made."""
-        out = wallet.get_sorted_requests()
+        items = self._iter_requests(pending=pending, expired=expired, paid=paid, after_key=after_key, wallet=wallet)
+        return await self._run_blocking(wallet, lambda: list(islice(items, limit)))
+
+    def _iter_requests(self, pending=False, expired=False, paid=False, after_key=None,
+                       wallet: Abstract_Wallet = None):
         if pending:
             f = PR_UNPAID
         elif expired:
@@ -777,9 +829,8 @@ class Commands:
             f = PR_PAID
         else:
             f = None
-        if f is not None:
-            out = list(filter(lambda x: x.get('status')==f, out))
-        return list(map(self._format_request, out))
+        for req in wallet.iter_sorted_requests(after_key=after_key, status=f):
+            yield self._format_request(req)
 
     @command('w')
     async def createnewaddress(self, wallet: Abstract_Wallet = None):
@@ -851,14 +902,24 @@ class Commands:
         wallet.clear_invoices()
         return True
 
-    @command('n')
-    async def notify(self, address: str, URL: str):
-        """Watch an address. Every time the address changes, a http POST is sent to the URL."""
+    def _get_notifier(self) -> Notifier:
         if not hasattr(self, "_notifier"):
             self._notifier = Notifier(self.network)
-        await self._notifier.start_watching_queue.put((address, URL))
+        return self._notifier
+
+    @command('n')
+    async def notify(self, address: str, URL: str):
+        """Watch an address. Every time the address changes, a http POST is sent to the URL.
+        Failed notifications are retried, and pending ones are kept across restarts."""
+        await self._get_notifier().start_watching_queue.put((address, URL))
         return True
 
+    @command('n')
+    async def notify_stats(self):
+        """Return statistics about the notifications sent by 'notify',
+        including the number of pending notifications and the delivery lag (in seconds)."""
+        return self._get_notifier().get_stats()
+
     @command('wn')
     async def is_synchronized(self, wallet: Abstract_Wallet = None):
         """ return wallet synchronization status """
@@ -962,15 +1023,20 @@ class Commands:
 
     @command('n')
     async def clear_ln_blacklist(self):
-        self.network.path_finder.blacklist.clear()
+        self.network.path_finder.clear_blacklist()
 
     @command('w')
     async def list_invoices(self, wallet: Abstract_Wallet = None):
         return wallet.get_invoices()
 
     @command('w')
-    async def lightning_history(self, wallet: Abstract_Wallet = None):
-        return wallet.lnworker.get_history()
+    async def lightning_history(self, limit=None, after_key=None, wallet: Abstract_Wallet = None):
+        """Lightning payments and channel events. Use limit and after_key to page through them."""
+        items = self._iter_lightning_history(after_key=after_key, wallet=wallet)
+        return await self._run_blocking(wallet, lambda: list(islice(items, limit)))
+
+    def _iter_lightning_history(self, after_key=None, wallet: Abstract_Wallet = None):
+        return wallet.lnworker.iter_history(after_key=after_key)
 
     @command('wn')
     async def close_channel(self, channel_point, force=False, wallet: Abstract_Wallet = None):
@@ -1059,6 +1125,10 @@ command_options = {
     'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position"),
     'from_height': (None, "Only show transactions that confirmed after given block height"),
     'to_height':   (None, "Only show transactions that confirmed before given block height"),
+    'limit':       (None, "Maximum number of items to return"),
+    'after_txid':  (None, "Only show transactions after this one (pagination cursor)"),
+    'after_address': (None, "Only show addresses after this one (pagination cursor)"),
+    'after_key':   (None, "Only show requests or history items after this one (pagination cursor)"),
 }
 
 
@@ -1072,6 +1142,7 @@ arg_types = {
     'year': int,
     'from_height': int,
     'to_height': int,
+    'limit': int,
     'tx': convert_raw_tx_to_hex,
     'pubkeys': json_loads,
     'jsontx': json_loads,
@@ -24,11 +24,14 @@
 # SOFTWARE.
 import asyncio
 import ast
+import itertools
+import json
 import os
 import time
 import traceback
 import sys
 import threading
+import concurrent.futures
 from typing import Dict, Optional, Tuple, Iterable
 from base64 import b64decode
 from collections import defaultdict
@@ -42,12 +45,14 @@ from jsonrpcclient.clients.aiohttp_client import AiohttpClient
 from aiorpcx import TaskGroup
 
 from .network import Network
-from .util import (json_decode, to_bytes, to_string, profiler, standardize_path, constant_time_compare)
+from .util import (json_decode, to_bytes, to_string, profiler, standardize_path, constant_time_compare,
+                   MyEncoder)
 from .util import PR_PAID, PR_EXPIRED, get_request_status
 from .util import log_exceptions, ignore_exceptions
 from .wallet import Wallet, Abstract_Wallet
-from .storage import WalletStorage
+from .storage import WalletStorage, delete_wallet_file
 from .commands import known_commands, Commands
+from .synchronizer import Notifier
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
 from .logging import get_logger, Logger
@@ -55,6 +60,20 @@ from .logging import get_logger, Logger
 
 _logger = get_logger(__name__)
 
+# a client that fails to authenticate this many times within the window is rejected
+RPC_AUTH_MAX_FAILURES = 10
+RPC_AUTH_FAILURE_WINDOW = 60
+
+# list commands that can be streamed by the /stream endpoint -> item generator of Commands
+STREAMABLE_COMMANDS = {
+    'onchain_history': '_iter_onchain_history',
+    'listaddresses': '_iter_addresses',
+    'list_requests': '_iter_requests',
+    'lightning_history': '_iter_lightning_history',
+}
+# number of items computed at a time when streaming
+STREAM_CHUNK_SIZE = 100
+
 
 class DaemonNotRunning(Exception):
     pass
@@ -149,6 +168,7 @@ class WatchTowerServer(Logger):
         self.methods = jsonrpcserver.methods.Methods()
         self.methods.add(self.get_ctn)
         self.methods.add(self.add_sweep_tx)
+        self.methods.add(self.add_sweep_txs)
 
     async def handle(self, request):
         request = await request.text()
@@ -173,6 +193,9 @@ class WatchTowerServer(Logger):
     async def add_sweep_tx(self, *args):
         return await self.lnwatcher.sweepstore.add_sweep_tx(*args)
 
+    async def add_sweep_txs(self, *args):
+        return await self.lnwatcher.sweepstore.add_sweep_txs(*args)
+
 
 class PayServer(Logger):
 
@@ -272,7 +295,11 @@ class Daemon(Logger):
     @profiler
     def __init__(self, config: SimpleConfig, fd=None, *, listen_jsonrpc=True):
         Logger.__init__(self)
-        self.auth_lock = asyncio.Lock()
+        # client address -> (number of failed authentication attempts, time of last failure)
+        self._auth_failures = {}  # type: Dict[str, Tuple[int, float]]
+        self._auth_failures_pruned = time.time()
+        # client address -> number of authentication attempts in progress
+        self._auth_pending = defaultdict(int)  # type: Dict[str, int]
         self.running = False
         self.running_lock = threading.Lock()
         self.config = config
@@ -288,6 +315,10 @@ class Daemon(Logger):
         self.gui_object = None
         # path -> wallet;   make sure path is standardized.
         self._wallets = {}  # type: Dict[str, Abstract_Wallet]
+        # worker threads for blocking commands, see run_blocking_command
+        self.command_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.get('num_command_threads', 4), thread_name_prefix='Command')
+        self._command_locks = defaultdict(asyncio.Lock)  # type: Dict[str, asyncio.Lock]
         daemon_jobs = []
         # Setup JSONRPC server
         if listen_jsonrpc:
@@ -321,6 +352,35 @@ class Daemon(Logger):
         finally:
             self.logger.info("stopping daemon.taskgroup")
 
+    async def run_blocking_command(self, func, *, wallet: Optional[Abstract_Wallet]):
+        """Calls func, a synchronous function, in a worker thread, so that it
+        does not stall the event loop (see Commands._run_blocking).
+        Blocking calls for the same wallet are run one at a time.
+        """
+        if wallet is None:
+            return await self.asyncio_loop.run_in_executor(self.command_executor, func)
+        async with self._command_locks[wallet.storage.path]:
+            return await self.asyncio_loop.run_in_executor(self.command_executor, func)
+
+    def _is_client_throttled(self, client: str) -> bool:
+        num_failures, last_failure = self._auth_failures.get(client, (0, 0))
+        if time.time() - last_failure > RPC_AUTH_FAILURE_WINDOW:
+            self._auth_failures.pop(client, None)
+            num_failures = 0
+        # attempts in progress count as failures, as they might turn out to be
+        return num_failures + self._auth_pending.get(client, 0) >= RPC_AUTH_MAX_FAILURES
+
+    def _on_auth_failure(self, client: str):
+        now = time.time()
+        if now - self._auth_failures_pruned > RPC_AUTH_FAILURE_WINDOW:
+            self._auth_failures = {c: v for c, v in self._auth_failures.items()
+                                   if now - v[1] <= RPC_AUTH_FAILURE_WINDOW}
+            self._auth_failures_pruned = now
+        num_failures, last_failure = self._auth_failures.get(client, (0, 0))
+        if now - last_failure > RPC_AUTH_FAILURE_WINDOW:
+            num_failures = 0
+        self._auth_failures[client] = (num_failures + 1, now)
+
     async def authenticate(self, headers):
         if self.rpc_password == '':
             # RPC authentication is disabled
@@ -339,34 +399,111 @@ class Daemon(Logger):
             await asyncio.sleep(0.050)
             raise AuthenticationCredentialsInvalid('Invalid Credentials')
 
+    async def _check_auth(self, request) -> Optional[web.Response]:
+        """Returns an error response if the request must be rejected."""
+        # note: failed attempts are throttled per client, so that a misbehaving
+        #       client does not slow down the others
+        client = request.remote
+        if self._is_client_throttled(client):
+            return web.Response(text='Too Many Requests', status=429)
+        # the attempt is reserved before awaiting, so that concurrent
+        # requests of a client cannot all pass the check above
+        self._auth_pending[client] += 1
+        try:
+            await self.authenticate(request.headers)
+        except AuthenticationInvalidOrMissing:
+            return web.Response(headers={"WWW-Authenticate": "Basic realm=Electrum"},
+                                text='Unauthorized', status=401)
+        except AuthenticationCredentialsInvalid:
+            self._on_auth_failure(client)
+            return web.Response(text='Forbidden', status=403)
+        finally:
+            self._auth_pending[client] -= 1
+            if self._auth_pending[client] == 0:
+                del self._auth_pending[client]
+
     async def handle(self, request):
-        async with self.auth_lock:
-            try:
-                await self.authenticate(request.headers)
-            except AuthenticationInvalidOrMissing:
-                return web.Response(headers={"WWW-Authenticate": "Basic realm=Electrum"},
-                                    text='Unauthorized', status=401)
-            except AuthenticationCredentialsInvalid:
-                return web.Response(text='Forbidden', status=403)
+        error_response = await self._check_auth(request)
+        # note: responses are mappings, an empty one is falsy
+        if error_response is not None:
+            return error_response
         request = await request.text()
+        # note: batch requests (JSON arrays) are dispatched concurrently
         response = await jsonrpcserver.async_dispatch(request, methods=self.methods)
-        if isinstance(response, jsonrpcserver.response.ExceptionResponse):
-            self.logger.error(f"error handling request: {request}", exc_info=response.exc)
-            # this exposes the error message to the client
-            response.message = str(response.exc)
+        if isinstance(response, jsonrpcserver.response.BatchResponse):
+            for r in response.responses:
+                self._expose_exception(request, r)
+        else:
+            self._expose_exception(request, response)
         if response.wanted:
             return web.json_response(response.deserialized(), status=response.http_status)
         else:
             return web.Response()
 
+    async def handle_stream(self, request):
+        """Streams the result of a list command as newline-delimited JSON,
+        one item per line, e.g. {"method": "onchain_history", "params": {"from_height": 600000}}.
+        Items are computed in chunks as the response is written, so memory
+        use does not grow with the size of the wallet. Each chunk is a
+        separate read under the wallet's command lock: other commands may
+        run between chunks, so the wallet can change during the stream.
+        """
+        error_response = await self._check_auth(request)
+        # note: responses are mappings, an empty one is falsy
+        if error_response is not None:
+            return error_response
+        try:
+            body = await request.json()
+            method = body['method']
+            params = dict(body.get('params', {}))
+            if method not in STREAMABLE_COMMANDS:
+                raise Exception(f'command cannot be streamed: {method}')
+            wallet_path = params.pop('wallet_path', None) or params.pop('wallet', None) or self.config.get_wallet_path()
+            wallet = self.get_wallet(wallet_path)
+            if wallet is None:
+                raise Exception('wallet not loaded')
+            limit = params.pop('limit', None)
+            items = getattr(self.cmd_runner, STREAMABLE_COMMANDS[method])(wallet=wallet, **params)
+            items = itertools.islice(items, limit)
+
+            def next_chunk():
+                return [json.dumps(item, cls=MyEncoder) + '\n' for item in itertools.islice(items, STREAM_CHUNK_SIZE)]
+            # the first chunk is computed before the response is started,
+            # so that bad parameters (e.g. an unknown cursor) get a 400
+            lines = await self.run_blocking_command(next_chunk, wallet=wallet)
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=400)
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        while lines:
+            await response.write(''.join(lines).encode('utf8'))
+            try:
+                lines = await self.run_blocking_command(next_chunk, wallet=wallet)
+            except Exception as e:
+                self.logger.exception(f"error streaming {method}")
+                await response.write((json.dumps({'error': str(e)}) + '\n').encode('utf8'))
+                break
+        await response.write_eof()
+        return response
+
+    def _expose_exception(self, request: str, response: jsonrpcserver.response.Response):
+        if isinstance(response, jsonrpcserver.response.ExceptionResponse):
+            self.logger.error(f"error handling request: {request}", exc_info=response.exc)
+            # this exposes the error message to the client
+            response.message = str(response.exc)
+
     async def start_jsonrpc(self, config: SimpleConfig, fd):
         self.app = web.Application()
         self.app.router.add_post("/", self.handle)
+        self.app.router.add_post("/stream", self.handle_stream)
         self.rpc_user, self.rpc_password = get_rpc_credentials(config)
         self.methods = jsonrpcserver.methods.Methods()
         self.methods.add(self.ping)
         self.methods.add(self.gui)
         self.cmd_runner = Commands(config=self.config, network=self.network, daemon=self)
+        if self.network and Notifier.has_saved_state(config):
+            # resume watching addresses (see 'notify') from a previous run
+            self.cmd_runner._get_notifier()
         for cmdname in known_commands:
             self.methods.add(getattr(self.cmd_runner, cmdname))
         self.methods.add(self.run_cmdline)
@@ -435,7 +572,7 @@ class Daemon(Logger):
     def delete_wallet(self, path: str) -> bool:
         self.stop_wallet(path)
         if os.path.exists(path):
-            os.unlink(path)
+            delete_wallet_file(path)
             return True
         return False
 
@@ -446,6 +583,7 @@ class Daemon(Logger):
         if not wallet:
             return False
         wallet.stop_threads()
+        self._command_locks.pop(wallet.storage.path, None)
         return True
 
     async def run_cmdline(self, config_options):
@@ -501,6 +639,7 @@ class Daemon(Logger):
             fut.result(timeout=2)
         except (asyncio.TimeoutError, asyncio.CancelledError):
             pass
+        self.command_executor.shutdown(wait=False)
         self.logger.info("removing lockfile")
         remove_lockfile(get_lockfile(self.config))
         self.logger.info("stopped")
@@ -27,7 +27,7 @@ import base64
 import hashlib
 import functools
 import copy
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, Iterable
 
 import ecdsa
 from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
@@ -37,7 +37,8 @@ from ecdsa.util import string_to_number, number_to_string
 
 from .util import bfh, bh2u, assert_bytes, to_bytes, InvalidPassword, profiler
 from .crypto import (sha256d, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot)
-from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1
+from .ecc_fast import (do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1, is_using_fast_ecc,
+                       verify_signatures_with_libsecp256k1)
 from . import msqr
 from . import constants
 from .logging import get_logger
@@ -347,6 +348,14 @@ def verify_signature(pubkey: bytes, sig: bytes, h: bytes) -> bool:
         return False
     return True
 
+def verify_signatures(items: Iterable[Tuple[bytes, bytes, bytes]]) -> bool:
+    """Verify a batch of (pubkey, sig_string, msg_hash) triples.
+    Returns True iff all signatures are valid.
+    """
+    if is_using_fast_ecc():
+        return verify_signatures_with_libsecp256k1(items)
+    return all(verify_signature(pubkey, sig, h) for pubkey, sig, h in items)
+
 def verify_message_with_address(address: str, sig65: bytes, message: bytes, *, net=None):
     from .bitcoin import pubkey_to_address
     assert_bytes(sig65, message)
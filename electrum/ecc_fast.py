@@ -261,6 +261,35 @@ def is_using_fast_ecc():
     return _patched_functions.monkey_patching_active
 
 
+def verify_signatures_with_libsecp256k1(items) -> bool:
+    """Verify (pubkey, sig_string, msg_hash) triples, with pubkeys in
+    serialized form and 64 byte compact signatures, calling libsecp256k1
+    directly instead of going through python-ecdsa objects.
+    Returns True iff all signatures are valid.
+
+    Note: ctypes releases the GIL for these calls, so this can run in
+    several threads at once.
+    """
+    ctx = _libsecp256k1.ctx
+    pubkey_parse = _libsecp256k1.secp256k1_ec_pubkey_parse
+    signature_parse_compact = _libsecp256k1.secp256k1_ecdsa_signature_parse_compact
+    signature_normalize = _libsecp256k1.secp256k1_ecdsa_signature_normalize
+    ecdsa_verify = _libsecp256k1.secp256k1_ecdsa_verify
+    pubkey = create_string_buffer(64)
+    sig = create_string_buffer(64)
+    for pubkey_bytes, sig_string, msg_hash in items:
+        if len(sig_string) != 64 or len(msg_hash) != 32:
+            return False
+        if not pubkey_parse(ctx, pubkey, pubkey_bytes, len(pubkey_bytes)):
+            return False
+        if not signature_parse_compact(ctx, sig, sig_string):
+            return False
+        signature_normalize(ctx, sig, sig)
+        if 1 != ecdsa_verify(ctx, sig, msg_hash, pubkey):
+            return False
+    return True
+
+
 try:
     _libsecp256k1 = load_library()
 except BaseException as e:
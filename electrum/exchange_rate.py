@@ -1,5 +1,7 @@
 import asyncio
-from datetime import datetime
+from datetime import datetime, date
+from array import array
+from bisect import bisect_left
 import inspect
 import sys
 import os
@@ -7,15 +9,15 @@ import json
 import time
 import csv
 import decimal
+import statistics
 from decimal import Decimal
-from typing import Sequence, Optional
+from typing import Sequence, Optional, List, Dict, Tuple
 
 from aiorpcx.curio import timeout_after, TaskTimeout, TaskGroup
 
 from .bitcoin import COIN
 from .i18n import _
-from .util import (ThreadJob, make_dir, log_exceptions,
-                   make_aiohttp_session, resource_path)
+from .util import ThreadJob, make_dir, log_exceptions, resource_path
 from .network import Network
 from .simple_config import SimpleConfig
 from .logging import Logger
@@ -34,36 +36,78 @@ CCY_PRECISIONS = {'BHD': 3, 'BIF': 0, 'BYR': 0, 'CLF': 4, 'CLP': 0,
                   'RWF': 0, 'TND': 3, 'UGX': 0, 'UYI': 0, 'VND': 0,
                   'VUV': 0, 'XAF': 0, 'XAU': 4, 'XOF': 0, 'XPF': 0}
 
+# quotes older than this are not used, e.g. if a source keeps failing
+FX_QUOTE_MAX_AGE = 10 * 60  # seconds
+
+# (exchange name, ccy) -> download of the rate history. Shared by all
+# exchange instances, so that switching currency or exchange back and
+# forth does not start the same download twice.
+_history_downloads = {}  # type: Dict[Tuple[str, str], asyncio.Future]
+
+
+class HistoricalRates:
+    """Daily rates of a currency, as sorted arrays of day ordinals
+    (see date.toordinal) and rates, so that lookups do not need to
+    format dates.
+    """
+
+    def __init__(self, history: dict):
+        items = []
+        for day_str, rate in history.items():
+            try:
+                day = datetime.strptime(day_str, '%Y-%m-%d').date().toordinal()
+            except (TypeError, ValueError):
+                continue  # e.g. 'timestamp'
+            items.append((day, rate))
+        items.sort(key=lambda x: x[0])
+        self.days = array('l', [day for day, rate in items])
+        self.rates = [rate for day, rate in items]
+
+    def get(self, day: int):
+        i = bisect_left(self.days, day)
+        if i < len(self.days) and self.days[i] == day:
+            return self.rates[i]
+        return 'NaN'
+
+    def get_many(self, days: Sequence[int]) -> list:
+        """Same as [self.get(day) for day in days], in a single pass over the rates."""
+        out = ['NaN'] * len(days)
+        i = 0
+        num_days = len(self.days)
+        for k in sorted(range(len(days)), key=days.__getitem__):
+            day = days[k]
+            while i < num_days and self.days[i] < day:
+                i += 1
+            if i < num_days and self.days[i] == day:
+                out[k] = self.rates[i]
+        return out
+
 
 class ExchangeBase(Logger):
 
     def __init__(self, on_quotes, on_history):
         Logger.__init__(self)
         self.history = {}
+        self._historical_rates = {}  # type: Dict[str, HistoricalRates]  # ccy -> rates
+        self._history_tasks = {}  # type: Dict[str, asyncio.Task]  # ccy -> task
         self.quotes = {}
+        self.quotes_timestamp = None  # type: Optional[float]
         self.on_quotes = on_quotes
         self.on_history = on_history
 
     async def get_raw(self, site, get_string):
         # APIs must have https
         url = ''.join(['https://', site, get_string])
-        network = Network.get_instance()
-        proxy = network.proxy if network else None
-        async with make_aiohttp_session(proxy) as session:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                return await response.text()
+        return await Network._send_http_on_proxy('get', url)
 
     async def get_json(self, site, get_string):
         # APIs must have https
         url = ''.join(['https://', site, get_string])
-        network = Network.get_instance()
-        proxy = network.proxy if network else None
-        async with make_aiohttp_session(proxy) as session:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                # set content_type to None to disable checking MIME type
-                return await response.json(content_type=None)
+        async def on_finish(response):
+            response.raise_for_status()
+            # set content_type to None to disable checking MIME type
+            return await response.json(content_type=None)
+        return await Network._send_http_on_proxy('get', url, on_finish=on_finish)
 
     async def get_csv(self, site, get_string):
         raw = await self.get_raw(site, get_string)
@@ -74,17 +118,36 @@ class ExchangeBase(Logger):
         return self.__class__.__name__
 
     async def update_safe(self, ccy):
+        await self.update_quotes_safe(ccy)
+        self.on_quotes()
+
+    async def update_quotes_safe(self, ccy) -> bool:
+        """Fetches quotes, without notifying. On failure, the previous
+        quotes are kept until they become stale."""
         try:
             self.logger.info(f"getting fx quotes for {ccy}")
             self.quotes = await self.get_rates(ccy)
+            self.quotes_timestamp = time.time()
             self.logger.info("received fx quotes")
+            return True
         except asyncio.CancelledError:
             # CancelledError must be passed-through for cancellation to work
             raise
         except BaseException as e:
             self.logger.info(f"failed fx quotes: {repr(e)}")
-            self.quotes = {}
-        self.on_quotes()
+            if self.is_stale():
+                self.quotes = {}
+            return False
+
+    def is_stale(self) -> bool:
+        if self.quotes_timestamp is None:
+            return False  # quotes were not fetched, e.g. set by hand
+        return time.time() - self.quotes_timestamp > FX_QUOTE_MAX_AGE
+
+    def get_quote(self, ccy):
+        if self.is_stale():
+            return None
+        return self.quotes.get(ccy)
 
     def read_historical_rates(self, ccy, cache_dir) -> Optional[dict]:
         filename = os.path.join(cache_dir, self.name() + '_'+ ccy)
@@ -99,25 +162,43 @@ class ExchangeBase(Logger):
         if not h:  # e.g. empty dict
             return None
         h['timestamp'] = timestamp
+        self._set_history(ccy, h)
+        return h
+
+    def _set_history(self, ccy, h):
         self.history[ccy] = h
+        self._historical_rates[ccy] = HistoricalRates(h)
         self.on_history()
-        return h
 
     @log_exceptions
     async def get_historical_rates_safe(self, ccy, cache_dir):
+        key = (self.name(), ccy)
+        fut = _history_downloads.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._download_historical_rates(ccy, cache_dir))
+            _history_downloads[key] = fut
+            fut.add_done_callback(lambda fut: _history_downloads.pop(key, None))
+        else:
+            self.logger.info(f"fx history for {ccy} already requested")
+        h = await asyncio.shield(fut)
+        if h is None:
+            return
+        h = dict(h)
+        h['timestamp'] = time.time()
+        self._set_history(ccy, h)
+
+    async def _download_historical_rates(self, ccy, cache_dir) -> Optional[dict]:
         try:
             self.logger.info(f"requesting fx history for {ccy}")
             h = await self.request_history(ccy)
             self.logger.info(f"received fx history for {ccy}")
         except BaseException as e:
             self.logger.info(f"failed fx history: {repr(e)}")
-            return
+            return None
         filename = os.path.join(cache_dir, self.name() + '_' + ccy)
         with open(filename, 'w', encoding='utf-8') as f:
             f.write(json.dumps(h))
-        h['timestamp'] = time.time()
-        self.history[ccy] = h
-        self.on_history()
+        return h
 
     def get_historical_rates(self, ccy, cache_dir):
         if ccy not in self.history_ccys():
@@ -126,13 +207,23 @@ class ExchangeBase(Logger):
         if h is None:
             h = self.read_historical_rates(ccy, cache_dir)
         if h is None or h['timestamp'] < time.time() - 24*3600:
-            asyncio.get_event_loop().create_task(self.get_historical_rates_safe(ccy, cache_dir))
+            task = self._history_tasks.get(ccy)
+            if task and not task.done():
+                return  # already waiting for it
+            self._history_tasks[ccy] = asyncio.get_event_loop().create_task(self.get_historical_rates_safe(ccy, cache_dir))
 
     def history_ccys(self):
         return []
 
     def historical_rate(self, ccy, d_t):
-        return self.history.get(ccy, {}).get(d_t.strftime('%Y-%m-%d'), 'NaN')
+        return self.historical_rates(ccy, [d_t.toordinal()])[0]
+
+    def historical_rates(self, ccy, days: Sequence[int]) -> list:
+        """Rates for a list of day ordinals, 'NaN' where unknown."""
+        rates = self._historical_rates.get(ccy)
+        if rates is None:
+            return ['NaN'] * len(days)
+        return rates.get_many(days)
 
     async def request_history(self, ccy):
         raise NotImplementedError()  # implemented by subclasses
@@ -507,7 +598,14 @@ class FxThread(ThreadJob):
             except TaskTimeout:
                 pass
             if self.is_enabled():
-                await self.exchange.update_safe(self.ccy)
+                await self.update_quotes()
+
+    async def update_quotes(self):
+        # all sources are polled at the same time, over the http session of the network
+        async with TaskGroup() as group:
+            for exchange in self.get_exchanges():
+                await group.spawn(exchange.update_quotes_safe(self.ccy))
+        self.on_quotes()
 
     def is_enabled(self):
         return bool(self.config.get('use_exchange_rate', DEFAULT_ENABLED))
@@ -541,6 +639,28 @@ class FxThread(ThreadJob):
     def config_exchange(self):
         return self.config.get('use_exchange', DEFAULT_EXCHANGE)
 
+    def config_extra_exchanges(self) -> Sequence[str]:
+        return self.config.get('fx_extra_exchanges', [])
+
+    def set_extra_exchanges(self, names: Sequence[str]):
+        self.config.set_key('fx_extra_exchanges', list(names), True)
+        self._load_extra_exchanges()
+        self.trigger_update()
+
+    def _load_extra_exchanges(self):
+        # spot quotes of these are combined with those of self.exchange
+        self.extra_exchanges = {}  # type: Dict[str, ExchangeBase]
+        for name in self.config_extra_exchanges():
+            class_ = globals().get(name)
+            if name == self.exchange.name() or not (inspect.isclass(class_) and issubclass(class_, ExchangeBase)):
+                continue
+            self.extra_exchanges[name] = class_(self.on_quotes, self.on_history)
+
+    def get_exchanges(self) -> Sequence[ExchangeBase]:
+        """Sources of spot quotes for the current currency."""
+        return [self.exchange] + [exchange for name, exchange in self.extra_exchanges.items()
+                                  if self.ccy in CURRENCIES.get(name, [])]
+
     def show_history(self):
         return self.is_enabled() and self.get_history_config() and self.ccy in self.exchange.history_ccys()
 
@@ -561,6 +681,7 @@ class FxThread(ThreadJob):
             self.config.set_key('use_exchange', name, True)
         assert issubclass(class_, ExchangeBase), f"unexpected type {class_} for {name}"
         self.exchange = class_(self.on_quotes, self.on_history)  # type: ExchangeBase
+        self._load_extra_exchanges()
         # A new exchange means new fx quotes, initially empty.  Force
         # a quote refresh
         self.trigger_update()
@@ -575,11 +696,14 @@ class FxThread(ThreadJob):
             self.network.trigger_callback('on_history')
 
     def exchange_rate(self) -> Decimal:
-        """Returns the exchange rate as a Decimal"""
-        rate = self.exchange.quotes.get(self.ccy)
-        if rate is None:
+        """Returns the exchange rate as a Decimal: the median of the
+        quotes of all sources that are not stale"""
+        rates = [exchange.get_quote(self.ccy) for exchange in self.get_exchanges()]
+        rates = [Decimal(rate) for rate in rates if rate is not None]
+        rates = [rate for rate in rates if not rate.is_nan()]
+        if not rates:
             return Decimal('NaN')
-        return Decimal(rate)
+        return statistics.median(rates)
 
     def format_amount(self, btc_balance):
         rate = self.exchange_rate()
@@ -612,7 +736,7 @@ class FxThread(ThreadJob):
         # Frequently there is no rate for today, until tomorrow :)
         # Use spot quotes in that case
         if rate in ('NaN', None) and (datetime.today().date() - d_t.date()).days <= 2:
-            rate = self.exchange.quotes.get(self.ccy, 'NaN')
+            rate = self.exchange_rate()
             self.history_used_spot = True
         if rate is None:
             rate = 'NaN'
@@ -629,5 +753,22 @@ class FxThread(ThreadJob):
         date = timestamp_to_datetime(timestamp)
         return self.history_rate(date)
 
+    def timestamp_rates(self, timestamps: Sequence[float]) -> List[Decimal]:
+        """Same as [self.timestamp_rate(t) for t in timestamps], with a
+        single lookup in the rate history."""
+        days = [date.fromtimestamp(t).toordinal() for t in timestamps]
+        rates = self.exchange.historical_rates(self.ccy, days)
+        # see history_rate
+        min_spot_day = date.today().toordinal() - 2
+        out = []
+        for day, rate in zip(days, rates):
+            if rate in ('NaN', None) and day >= min_spot_day:
+                rate = self.exchange_rate()
+                self.history_used_spot = True
+            if rate is None:
+                rate = 'NaN'
+            out.append(Decimal(rate))
+        return out
+
 
 assert globals().get(DEFAULT_EXCHANGE), f"default exchange {DEFAULT_EXCHANGE} does not exist"
@@ -9,7 +9,7 @@ import threading
 import asyncio
 from typing import TYPE_CHECKING, Optional, Union, Callable
 
-from electrum.storage import WalletStorage, StorageReadWriteError
+from electrum.storage import WalletStorage, StorageReadWriteError, delete_wallet_file
 from electrum.wallet import Wallet, InternalAddressCorruption, Abstract_Wallet
 from electrum.plugin import run_hook
 from electrum.util import (profiler, InvalidPassword, send_exception_to_crash_reporter,
@@ -648,7 +648,7 @@ class ElectrumWindow(App):
                     if b:
                         launch_wizard()
                     else:
-                        try: os.unlink(path)
+                        try: delete_wallet_file(path)
                         except FileNotFoundError: pass
                         self.stop()
                 d = Question(_('Do you want to launch the wizard again?'), handle_answer)
@@ -1154,7 +1154,7 @@ class ElectrumWindow(App):
                 self.show_error("Invalid PIN")
                 return
         self.stop_wallet()
-        os.unlink(wallet_path)
+        delete_wallet_file(wallet_path)
         self.show_error(_("Wallet removed: {}").format(basename))
         new_path = self.electrum_config.get_wallet_path(use_gui_last_wallet=True)
         self.load_wallet_by_name(new_path)
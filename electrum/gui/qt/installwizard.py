@@ -16,7 +16,7 @@ from PyQt5.QtWidgets import (QWidget, QDialog, QLabel, QHBoxLayout, QMessageBox,
                              QGridLayout, QSlider, QScrollArea, QApplication)
 
 from electrum.wallet import Wallet, Abstract_Wallet
-from electrum.storage import WalletStorage, StorageReadWriteError
+from electrum.storage import WalletStorage, StorageReadWriteError, delete_wallet_file
 from electrum.util import UserCancelled, InvalidPassword, WalletFileException, get_new_wallet_name
 from electrum.base_wizard import BaseWizard, HWD_SETUP_DECRYPT_WALLET, GoBack
 from electrum.i18n import _
@@ -327,7 +327,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
             file_list = '\n'.join(storage.split_accounts())
             msg = _('Your accounts have been moved to') + ':\n' + file_list + '\n\n'+ _('Do you want to delete the old file') + ':\n' + path
             if self.question(msg):
-                os.remove(path)
+                delete_wallet_file(path)
                 self.show_warning(_('The file was removed'))
             # raise now, to avoid having the old storage opened
             raise UserCancelled()
@@ -341,7 +341,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
                     "Do you want to complete its creation now?").format(path)
             if not self.question(msg):
                 if self.question(_("Do you want to delete '{}'?").format(path)):
-                    os.remove(path)
+                    delete_wallet_file(path)
                     self.show_warning(_('The file was removed'))
                 return
             self.show()
@@ -28,7 +28,6 @@ import threading
 import os
 import traceback
 import json
-import shutil
 import weakref
 import csv
 from decimal import Decimal
@@ -72,6 +71,7 @@ from electrum.version import ELECTRUM_VERSION
 from electrum.network import Network, TxBroadcastError, BestEffortRequestFailed
 from electrum.exchange_rate import FxThread
 from electrum.simple_config import SimpleConfig
+from electrum.storage import copy_wallet_file
 from electrum.logging import Logger
 from electrum.util import PR_PAID, PR_FAILED
 from electrum.util import pr_expiration_values
@@ -278,6 +278,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger):
         Exception_Hook(self)
 
     def on_fx_history(self):
+        self.wallet.clear_coin_price_cache()
         self.history_model.refresh('fx_history')
         self.address_list.update()
 
@@ -534,7 +535,9 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
-                shutil.copy2(path, new_path)
+                # fold the channel journal into the wallet file
+                self.wallet.storage.write()
+                copy_wallet_file(path, new_path)
                 self.show_message(_("A copy of your wallet file was created in")+" '%s'" % str(new_path), title=_("Wallet backup created"))
             except BaseException as reason:
                 self.show_critical(_("Electrum was unable to copy your wallet file to the specified location.") + "\n" + str(reason), title=_("Unable to create backup"))
@@ -2712,15 +2715,21 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger):
         except InternalAddressCorruption as e:
             self.show_error(str(e))
             raise
-        try:
-            coins, keypairs = sweep_preparations(get_pk(), self.network)
-        except Exception as e:  # FIXME too broad...
-            self.show_message(repr(e))
-            return
-        scriptpubkey = bfh(bitcoin.address_to_script(addr))
-        outputs = [PartialTxOutput(scriptpubkey=scriptpubkey, value='!')]
-        self.warn_if_watching_only()
-        self.pay_onchain_dialog(coins, outputs, external_keypairs=keypairs)
+        privkeys = get_pk()
+        msg = _('Looking for coins...')
+        waiting_dialog = WaitingDialog(self, msg, None)
+        def on_progress(num_done, num_total):
+            waiting_dialog.update(msg + f' {num_done}/{num_total}')
+        def on_success(result):
+            coins, keypairs = result
+            scriptpubkey = bfh(bitcoin.address_to_script(addr))
+            outputs = [PartialTxOutput(scriptpubkey=scriptpubkey, value='!')]
+            self.warn_if_watching_only()
+            self.pay_onchain_dialog(coins, outputs, external_keypairs=keypairs)
+        def on_failure(exc_info):  # FIXME too broad...
+            self.show_message(repr(exc_info[1]))
+        task = partial(sweep_preparations, privkeys, self.network, progress_callback=on_progress)
+        waiting_dialog.run_task(task, on_success, on_failure)
 
     def _do_import(self, title, header_layout, func):
         text = text_dialog(self, title, header_layout, _('Import'), allow_multi=True)
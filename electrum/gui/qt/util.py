@@ -279,7 +279,10 @@ class WindowModalDialog(QDialog, MessageBoxMixin):
 
 class WaitingDialog(WindowModalDialog):
     '''Shows a please wait dialog whilst running a task.  It is not
-    necessary to maintain a reference to this dialog.'''
+    necessary to maintain a reference to this dialog.  If task is None,
+    the task is started later with run_task.'''
+    update_signal = pyqtSignal(str)
+
     def __init__(self, parent: QWidget, message: str, task, on_success=None, on_error=None):
         assert parent
         if isinstance(parent, MessageBoxMixin):
@@ -288,10 +291,15 @@ class WaitingDialog(WindowModalDialog):
         self.message_label = QLabel(message)
         vbox = QVBoxLayout(self)
         vbox.addWidget(self.message_label)
+        self.update_signal.connect(self.message_label.setText)
         self.accepted.connect(self.on_accepted)
         self.show()
         self.thread = TaskThread(self)
         self.thread.finished.connect(self.deleteLater)  # see #3956
+        if task is not None:
+            self.run_task(task, on_success, on_error)
+
+    def run_task(self, task, on_success=None, on_error=None):
         self.thread.add(task, on_success, self.accept, on_error)
 
     def wait(self):
@@ -301,8 +309,8 @@ class WaitingDialog(WindowModalDialog):
         self.thread.stop()
 
     def update(self, msg):
-        print(msg)
-        self.message_label.setText(msg)
+        # note: can be called from the task thread
+        self.update_signal.emit(msg)
 
 
 class BlockingWaitingDialog(WindowModalDialog):
@@ -29,7 +29,7 @@ import sys
 import traceback
 import asyncio
 import socket
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set
+from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, Dict, Sequence
 from collections import defaultdict
 from ipaddress import IPv4Network, IPv6Network, ip_address, IPv6Address
 import itertools
@@ -82,6 +82,8 @@ class NotificationSession(RPCSession):
         super(NotificationSession, self).__init__(*args, **kwargs)
         self.subscriptions = defaultdict(list)
         self.cache = {}
+        self._subscription_requests = {}  # type: Dict[str, asyncio.Future]  # key -> initial request
+        self._subscription_keys = defaultdict(set)  # type: Dict[asyncio.Queue, Set[str]]  # queue -> keys
         self.default_timeout = NetworkTimeout.Generic.NORMAL
         self._msg_counter = itertools.count(start=1)
         self.interface = None  # type: Optional[Interface]
@@ -125,19 +127,55 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_request_batch(self, method: str, params_list: Sequence[List], *,
+                                 timeout=None) -> List:
+        """Sends one JSON-RPC batch calling method once per item of params_list.
+        Returns the results in the same order. Error responses are raised
+        as CodeMessageError.
+        """
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch of {len(params_list)} {method} (id: {msg_id})")
+        try:
+            async def send_batch():
+                async with self.send_batch() as batch:
+                    for params in params_list:
+                        batch.add_request(method, params)
+                return batch.results
+            results = await asyncio.wait_for(send_batch(), timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            raise RequestTimedOut(f'request timed out: batch of {method} (id: {msg_id})') from e
+        for result in results:
+            if isinstance(result, Exception):
+                self.maybe_log(f"--> {repr(result)} (id: {msg_id})")
+                raise result
+        self.maybe_log(f"--> batch of {len(results)} results (id: {msg_id})")
+        return list(results)
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
 
     async def subscribe(self, method: str, params: List, queue: asyncio.Queue):
-        # note: until the cache is written for the first time,
-        # each 'subscribe' call might make a request on the network.
+        # note: the session is shared by all wallets and watchers, so the
+        # same key is often subscribed to several times. Only the first
+        # call makes a request on the network; concurrent calls wait for it.
         key = self.get_hashable_key_for_rpc_call(method, params)
         self.subscriptions[key].append(queue)
+        self._subscription_keys[queue].add(key)
         if key in self.cache:
             result = self.cache[key]
         else:
-            result = await self.send_request(method, params)
+            fut = self._subscription_requests.get(key)
+            if fut is None:
+                fut = asyncio.ensure_future(self.send_request(method, params))
+                self._subscription_requests[key] = fut
+                def on_done(fut):
+                    if self._subscription_requests.get(key) is fut:
+                        del self._subscription_requests[key]
+                    if not fut.cancelled():
+                        fut.exception()  # mark as retrieved, waiters re-raise it
+                fut.add_done_callback(on_done)
+            result = await asyncio.shield(fut)
             self.cache[key] = result
         await queue.put(params + [result])
 
@@ -145,8 +183,9 @@ class NotificationSession(RPCSession):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
         # subsequent notifications
-        for v in self.subscriptions.values():
-            if queue in v:
+        for key in self._subscription_keys.pop(queue, ()):
+            v = self.subscriptions.get(key)
+            if v and queue in v:
                 v.remove(queue)
 
     @classmethod
@@ -117,6 +117,23 @@ class JsonDB(Logger):
     def commit(self):
         pass
 
+    @modifier
+    def put_channel(self, serialized: dict) -> None:
+        """Inserts or replaces one of the serialized channels."""
+        channels = self.data.setdefault('channels', [])
+        serialized = copy.deepcopy(serialized)
+        for i, c in enumerate(channels):
+            if c.get('channel_id') == serialized['channel_id']:
+                channels[i] = serialized
+                break
+        else:
+            channels.append(serialized)
+
+    @modifier
+    def put_ln_ledger_item(self, key: str, item: dict) -> None:
+        """Inserts or replaces one item of the lightning payment ledger."""
+        self.data.setdefault('lightning_payment_ledger', {})[key] = copy.deepcopy(item)
+
     @locked
     def dump(self):
         return json.dumps(self.data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
@@ -23,7 +23,8 @@
 # 42de4400bff5105352d0552155f73589166d162b
 
 import os
-from collections import namedtuple, defaultdict
+import copy
+from collections import namedtuple, defaultdict, OrderedDict
 import binascii
 import json
 from enum import IntEnum
@@ -55,6 +56,10 @@ if TYPE_CHECKING:
     from .lnworker import LNWallet
 
 
+# number of commitment transactions kept per channel by make_commitment
+COMMITMENT_CACHE_SIZE = 8
+
+
 # lightning channel states
 class channel_states(IntEnum):
     PREOPENING      = 0 # negociating
@@ -181,6 +186,10 @@ class Channel(Logger):
         self.peer_state = peer_states.DISCONNECTED
         self.sweep_info = {}  # type: Dict[str, Dict[str, SweepInfo]]
         self._outgoing_channel_update = None  # type: Optional[bytes]
+        # LRU, (subject, ctn) -> (state the ctx was built from, ctx)
+        self._commitment_cache = OrderedDict()  # type: Dict[Tuple[HTLCOwner, int], Tuple[tuple, PartialTransaction]]
+        # our signatures for the next remote ctx: (ctn, state, sig_64, htlcsigs)
+        self._commitment_sigs = None  # type: Optional[Tuple[int, tuple, bytes, List[bytes]]]
 
     def get_feerate(self, subject, ctn):
         return self.hm.get_feerate(subject, ctn)
@@ -320,6 +329,20 @@ class Channel(Logger):
         self.logger.info(f"sign_next_commitment {next_remote_ctn}")
 
         pending_remote_commitment = self.get_next_commitment(REMOTE)
+        # the signatures are reused when the same ctx is signed again,
+        # e.g. when commitment_signed is retransmitted after a reconnection
+        state = self._commitment_cache[(REMOTE, next_remote_ctn)][0]
+        if self._commitment_sigs is not None and self._commitment_sigs[0:2] == (next_remote_ctn, state):
+            sig_64, htlcsigs = self._commitment_sigs[2:]
+        else:
+            sig_64, htlcsigs = self._sign_commitment(pending_remote_commitment, next_remote_ctn)
+            self._commitment_sigs = next_remote_ctn, state, sig_64, htlcsigs
+
+        self.hm.send_ctx()
+
+        return sig_64, list(htlcsigs)
+
+    def _sign_commitment(self, pending_remote_commitment: PartialTransaction, next_remote_ctn: int) -> Tuple[bytes, List[bytes]]:
         sig_64 = sign_and_get_sig_string(pending_remote_commitment, self.config[LOCAL], self.config[REMOTE])
 
         their_remote_htlc_privkey_number = derive_privkey(
@@ -346,9 +369,6 @@ class Channel(Logger):
             htlcsigs.append((ctx_output_idx, htlc_sig))
         htlcsigs.sort()
         htlcsigs = [x[1] for x in htlcsigs]
-
-        self.hm.send_ctx()
-
         return sig_64, htlcsigs
 
     def receive_new_commitment(self, sig, htlc_sigs):
@@ -472,21 +492,13 @@ class Channel(Logger):
         """
         assert type(whose) is HTLCOwner
         initial = self.config[whose].initial_msat
-
-        for direction, htlc in self.hm.all_settled_htlcs_ever(ctx_owner, ctn):
-            # note: could "simplify" to (whose * ctx_owner == direction * SENT)
-            if whose == ctx_owner:
-                if direction == SENT:
-                    initial -= htlc.amount_msat
-                else:
-                    initial += htlc.amount_msat
-            else:
-                if direction == SENT:
-                    initial += htlc.amount_msat
-                else:
-                    initial -= htlc.amount_msat
-
-        return initial
+        sent = self.hm.get_settled_msat(ctx_owner, SENT, ctn)
+        received = self.hm.get_settled_msat(ctx_owner, RECEIVED, ctn)
+        # note: could "simplify" to (whose * ctx_owner == direction * SENT)
+        if whose == ctx_owner:
+            return initial - sent + received
+        else:
+            return initial + sent - received
 
     def balance_minus_outgoing_htlcs(self, whose: HTLCOwner, *, ctx_owner: HTLCOwner = HTLCOwner.LOCAL):
         """
@@ -593,7 +605,7 @@ class Channel(Logger):
     def total_msat(self, direction):
         """Return the cumulative total msat amount received/sent so far."""
         assert type(direction) is Direction
-        return htlcsum(self.hm.all_settled_htlcs_ever_by_direction(LOCAL, direction))
+        return self.hm.get_settled_msat(LOCAL, direction)
 
     def settle_htlc(self, preimage, htlc_id):
         """
@@ -706,6 +718,17 @@ class Channel(Logger):
             local_msat -= htlcsum(received_htlcs)
         assert remote_msat >= 0
         assert local_msat >= 0
+        # Nothing else that goes into the ctx changes once the channel is open,
+        # so a ctx built from the same state can be reused. It is copied, as
+        # callers sign the ctx they get.
+        # note: remote htlc_ids can be reused after a reconnection, so the
+        #       htlcs themselves are compared, not their ids
+        state = (this_point, feerate, local_msat, remote_msat, tuple(received_htlcs), tuple(sent_htlcs))
+        cache_key = (subject, ctn)
+        cached = self._commitment_cache.get(cache_key)
+        if cached is not None and cached[0] == state:
+            self._commitment_cache.move_to_end(cache_key)
+            return copy.deepcopy(cached[1])
         # same htlcs as before, but now without dust.
         received_htlcs = self.included_htlcs(subject, SENT if subject == LOCAL else RECEIVED, ctn)
         sent_htlcs = self.included_htlcs(subject, RECEIVED if subject == LOCAL else SENT, ctn)
@@ -731,7 +754,7 @@ class Channel(Logger):
             self.constraints.is_initiator == (subject == LOCAL),
         )
         payment_pubkey = derive_pubkey(other_config.payment_basepoint.pubkey, this_point)
-        return make_commitment(
+        ctx = make_commitment(
             ctn,
             this_config.multisig_key.pubkey,
             other_config.multisig_key.pubkey,
@@ -748,6 +771,10 @@ class Channel(Logger):
             this_config.dust_limit_sat,
             onchain_fees,
             htlcs=htlcs)
+        self._commitment_cache[cache_key] = state, copy.deepcopy(ctx)
+        while len(self._commitment_cache) > COMMITMENT_CACHE_SIZE:
+            self._commitment_cache.popitem(last=False)
+        return ctx
 
     def make_closing_tx(self, local_script: bytes, remote_script: bytes,
                         fee_sat: int) -> Tuple[bytes, PartialTransaction]:
@@ -1,5 +1,5 @@
 from copy import deepcopy
-from typing import Optional, Sequence, Tuple, List, Dict
+from typing import Optional, Sequence, Tuple, List, Dict, Iterable
 
 from .lnutil import SENT, RECEIVED, LOCAL, REMOTE, HTLCOwner, UpdateAddHtlc, Direction, FeeUpdate
 from .util import bh2u, bfh
@@ -44,6 +44,50 @@ class HTLCManager:
                 if not log[sub]['fee_updates']:
                     log[sub]['fee_updates'].append(FeeUpdate(initial_feerate, ctns={LOCAL:0, REMOTE:0}))
         self.log = log
+        self._init_active_htlc_ids()
+
+    def _init_active_htlc_ids(self) -> None:
+        # Queries at ctns from the oldest unrevoked one of the subject onwards
+        # only need to look at HTLCs that were not removed from subject's ctx
+        # before that ctn. Those are indexed here, as
+        # subject -> "side who offered htlc" -> htlc_id -> None (ordered set).
+        # The amounts of the settled HTLCs that dropped out of the index
+        # are kept as running totals, in self._settled_msat, once they have
+        # been queried (those not summed yet are in self._settled_unsummed).
+        self._active_htlc_ids = {sub: {party: dict.fromkeys(self.log[party]['locked_in'])
+                                       for party in (LOCAL, REMOTE)}
+                                 for sub in (LOCAL, REMOTE)}  # type: Dict[HTLCOwner, Dict[HTLCOwner, Dict[int, None]]]
+        self._settled_msat = {sub: {LOCAL: 0, REMOTE: 0}
+                              for sub in (LOCAL, REMOTE)}  # type: Dict[HTLCOwner, Dict[HTLCOwner, int]]
+        self._settled_unsummed = {sub: {LOCAL: [], REMOTE: []}
+                                  for sub in (LOCAL, REMOTE)}  # type: Dict[HTLCOwner, Dict[HTLCOwner, List[int]]]
+        for sub in (LOCAL, REMOTE):
+            self._prune_active_htlc_ids(sub)
+
+    def _prune_active_htlc_ids(self, subject: HTLCOwner) -> None:
+        """Drop HTLCs removed from subject's ctx before its oldest unrevoked ctn
+        from the index. Settled ones are rolled into the running totals.
+        """
+        oldest_ctn = self.ctn_oldest_unrevoked(subject)
+        for party in (LOCAL, REMOTE):
+            active_htlc_ids = self._active_htlc_ids[subject][party]
+            for log_action in ('settles', 'fails'):
+                removals = self.log[party][log_action]
+                for htlc_id in [htlc_id for htlc_id in active_htlc_ids if htlc_id in removals]:
+                    removal_ctn = removals[htlc_id][subject]
+                    if removal_ctn is None or removal_ctn >= oldest_ctn:
+                        continue
+                    del active_htlc_ids[htlc_id]
+                    if log_action == 'settles':
+                        self._settled_unsummed[subject][party].append(htlc_id)
+
+    def _considered_htlc_ids(self, subject: HTLCOwner, party: HTLCOwner, ctn: int) -> Iterable[int]:
+        """Return the ids of the HTLCs offered by party that might be
+        in subject's ctx at ctn, or have been removed from it at ctn.
+        """
+        if ctn >= self.ctn_oldest_unrevoked(subject):
+            return self._active_htlc_ids[subject][party]
+        return self.log[party]['locked_in']
 
     def ctn_latest(self, sub: HTLCOwner) -> int:
         """Return the ctn for the latest (newest that has a valid sig) ctx of sub"""
@@ -86,6 +130,8 @@ class HTLCManager:
         self.log[REMOTE]['ctn'] = 0
         self._set_revack_pending(LOCAL, False)
         self._set_revack_pending(REMOTE, False)
+        self._prune_active_htlc_ids(LOCAL)
+        self._prune_active_htlc_ids(REMOTE)
 
     def send_htlc(self, htlc: UpdateAddHtlc) -> UpdateAddHtlc:
         htlc_id = htlc.htlc_id
@@ -94,6 +140,8 @@ class HTLCManager:
                             f"{self.get_next_htlc_id(LOCAL)} but got {htlc_id}")
         self.log[LOCAL]['adds'][htlc_id] = htlc
         self.log[LOCAL]['locked_in'][htlc_id] = {LOCAL: None, REMOTE: self.ctn_latest(REMOTE)+1}
+        for sub in (LOCAL, REMOTE):
+            self._active_htlc_ids[sub][LOCAL][htlc_id] = None
         self.log[LOCAL]['next_htlc_id'] += 1
         return htlc
 
@@ -104,6 +152,8 @@ class HTLCManager:
                             f"{self.get_next_htlc_id(REMOTE)} but got {htlc_id}")
         self.log[REMOTE]['adds'][htlc_id] = htlc
         self.log[REMOTE]['locked_in'][htlc_id] = {LOCAL: self.ctn_latest(LOCAL)+1, REMOTE: None}
+        for sub in (LOCAL, REMOTE):
+            self._active_htlc_ids[sub][REMOTE][htlc_id] = None
         self.log[REMOTE]['next_htlc_id'] += 1
 
     def send_settle(self, htlc_id: int) -> None:
@@ -160,6 +210,7 @@ class HTLCManager:
         for fee_update in self.log[REMOTE]['fee_updates']:
             if fee_update.ctns[REMOTE] is None and fee_update.ctns[LOCAL] <= self.ctn_latest(LOCAL):
                 fee_update.ctns[REMOTE] = self.ctn_latest(REMOTE) + 1
+        self._prune_active_htlc_ids(LOCAL)
 
     def recv_rev(self) -> None:
         self.log[REMOTE]['ctn'] += 1
@@ -176,6 +227,7 @@ class HTLCManager:
         for fee_update in self.log[LOCAL]['fee_updates']:
             if fee_update.ctns[LOCAL] is None and fee_update.ctns[REMOTE] <= self.ctn_latest(REMOTE):
                 fee_update.ctns[LOCAL] = self.ctn_latest(LOCAL) + 1
+        self._prune_active_htlc_ids(REMOTE)
         # no need to keep local update raw msgs anymore, they have just been ACKed.
         self.log['unacked_local_updates2'].pop(self.log[REMOTE]['ctn'], None)
 
@@ -188,6 +240,8 @@ class HTLCManager:
             if ctns[LOCAL] > self.ctn_latest(LOCAL):
                 del self.log[REMOTE]['locked_in'][htlc_id]
                 del self.log[REMOTE]['adds'][htlc_id]
+                for sub in (LOCAL, REMOTE):
+                    self._active_htlc_ids[sub][REMOTE].pop(htlc_id, None)
         if self.log[REMOTE]['locked_in']:
             self.log[REMOTE]['next_htlc_id'] = max(self.log[REMOTE]['locked_in']) + 1
         else:
@@ -236,9 +290,11 @@ class HTLCManager:
         # subject's ctx
         # party is the proposer of the HTLCs
         party = subject if direction == SENT else subject.inverted()
+        locked_in = self.log[party]['locked_in']
         settles = self.log[party]['settles']
         fails = self.log[party]['fails']
-        for htlc_id, ctns in self.log[party]['locked_in'].items():
+        for htlc_id in self._considered_htlc_ids(subject, party, ctn):
+            ctns = locked_in[htlc_id]
             if ctns[subject] is not None and ctns[subject] <= ctn:
                 not_settled = htlc_id not in settles or settles[htlc_id][subject] is None or settles[htlc_id][subject] > ctn
                 not_failed = htlc_id not in fails or fails[htlc_id][subject] is None or fails[htlc_id][subject] > ctn
@@ -306,15 +362,40 @@ class HTLCManager:
         received = [(RECEIVED, x) for x in self.all_settled_htlcs_ever_by_direction(subject, RECEIVED, ctn)]
         return sent + received
 
+    def get_settled_msat(self, subject: HTLCOwner, direction: Direction, ctn: int = None) -> int:
+        """Return the total amount of all HTLCs that have been ever settled
+        in subject's ctx up to ctn, filtered to only "direction".
+        """
+        assert type(subject) is HTLCOwner
+        if ctn is None:
+            ctn = self.ctn_oldest_unrevoked(subject)
+        if ctn < self.ctn_oldest_unrevoked(subject):
+            return sum(htlc.amount_msat for htlc in self.all_settled_htlcs_ever_by_direction(subject, direction, ctn))
+        party = subject if direction == SENT else subject.inverted()
+        settles = self.log[party]['settles']
+        adds = self.log[party]['adds']
+        unsummed = self._settled_unsummed[subject][party]
+        if unsummed:
+            self._settled_msat[subject][party] += sum(adds[htlc_id].amount_msat for htlc_id in unsummed)
+            unsummed.clear()
+        total = self._settled_msat[subject][party]
+        for htlc_id in self._active_htlc_ids[subject][party]:
+            ctns = settles.get(htlc_id)
+            if ctns is not None and ctns[subject] is not None and ctns[subject] <= ctn:
+                total += adds[htlc_id].amount_msat
+        return total
+
+    def _settled_in_local_ctn(self, party: HTLCOwner, ctn: int) -> Sequence[UpdateAddHtlc]:
+        settles = self.log[party]['settles']
+        return [self.log[party]['adds'][htlc_id]
+                for htlc_id in self._considered_htlc_ids(LOCAL, party, ctn)
+                if htlc_id in settles and settles[htlc_id][LOCAL] == ctn]
+
     def received_in_ctn(self, ctn: int) -> Sequence[UpdateAddHtlc]:
-        return [self.log[REMOTE]['adds'][htlc_id]
-                for htlc_id, ctns in self.log[REMOTE]['settles'].items()
-                if ctns[LOCAL] == ctn]
+        return self._settled_in_local_ctn(REMOTE, ctn)
 
     def sent_in_ctn(self, ctn: int) -> Sequence[UpdateAddHtlc]:
-        return [self.log[LOCAL]['adds'][htlc_id]
-                for htlc_id, ctns in self.log[LOCAL]['settles'].items()
-                if ctns[LOCAL] == ctn]
+        return self._settled_in_local_ctn(LOCAL, ctn)
 
     ##### Queries re Fees:
 
@@ -1,48 +1,131 @@
 import json
 import os
-from typing import Callable, Tuple
-from collections import OrderedDict
+import struct
+from typing import Callable, Tuple, Union, Sequence, NamedTuple, Optional, Mapping
+from collections import OrderedDict, ChainMap
 
-def _eval_length_term(x, ma: dict) -> int:
-    """
-    Evaluate a term of the simple language used
-    to specify lightning message field lengths.
 
-    If `x` is an integer, it is returned as is,
-    otherwise it is treated as a variable and
-    looked up in `ma`.
+def _as_int(x: Union[int, bytes]) -> int:
+    """Length variables are ints, or big-endian bytes as found in a message."""
+    if isinstance(x, int):
+        return x
+    return int.from_bytes(x, byteorder='big')
 
-    If the value in `ma` was no integer, it is
-    assumed big-endian bytes and decoded.
+def _parse_exp(exp) -> Tuple[int, Tuple[str, ...], bool]:
+    """
+    Parse an expression of the simple language used
+    to specify lightning message field positions and
+    lengths, e.g. '2', 'gflen', '258+len' or 'num_htlcs*64'.
 
-    Returns evaluated result as int
+    Returns (constant, variables, is_product): a sum
+    evaluates to constant + sum(variables), a product
+    to constant * prod(variables).
     """
-    try:
-        x = int(x)
-    except ValueError:
-        x = ma[x]
-    try:
-        x = int(x)
-    except ValueError:
-        x = int.from_bytes(x, byteorder='big')
-    return x
-
-def _eval_exp_with_ctx(exp, ctx: dict) -> int:
+    exp = str(exp)
+    is_product = "*" in exp
+    if is_product:
+        assert "+" not in exp, exp
+    constant = 1 if is_product else 0
+    variables = []
+    for term in exp.split("*" if is_product else "+"):
+        term = term.strip()
+        if term.isdigit():
+            constant = constant * int(term) if is_product else constant + int(term)
+        else:
+            variables.append(term)
+    return constant, tuple(variables), is_product
+
+def _compile_exp(exp) -> Union[int, Callable[[Mapping], int]]:
     """
-    Evaluate simple mathematical expression given
-    in `exp` with context (variables assigned)
-    from the dict `ctx`.
+    Compile a position or length expression.
 
-    Returns evaluated result as int
+    Returns an int if the expression is constant, otherwise
+    a function evaluating it with the variables looked up
+    in a mapping (values being ints or big-endian bytes).
     """
-    exp = str(exp)
-    if "*" in exp:
-        assert "+" not in exp
-        result = 1
-        for term in exp.split("*"):
-            result *= _eval_length_term(term, ctx)
-        return result
-    return sum(_eval_length_term(x, ctx) for x in exp.split("+"))
+    constant, variables, is_product = _parse_exp(exp)
+    if not variables:
+        return constant
+    if len(variables) == 1 and constant == (1 if is_product else 0):
+        name, = variables
+        return lambda ctx: _as_int(ctx[name])
+    if is_product:
+        def evaluate(ctx):
+            result = constant
+            for name in variables:
+                result *= _as_int(ctx[name])
+            return result
+    else:
+        def evaluate(ctx):
+            return constant + sum(_as_int(ctx[name]) for name in variables)
+    return evaluate
+
+
+class _DecodeStep(NamedTuple):
+    # a run of consecutive fixed-length fields, decoded with one struct
+    names: Tuple[str, ...]
+    struct: Optional[struct.Struct]
+    # or a single field with a variable length
+    length: Optional[Callable[[Mapping], int]]
+    optional: bool
+
+
+class _EncodeStep(NamedTuple):
+    name: str
+    length: Union[int, Callable[[Mapping], int]]
+    optional: bool
+
+
+def _compile_payload(k: str, payload: dict) -> Tuple[Sequence[_DecodeStep], Sequence[_EncodeStep]]:
+    """
+    Compile the payload specification of message type `k`
+    into decoding and encoding steps. Field positions are
+    checked here once, instead of for every message.
+    """
+    decode_steps = []
+    encode_steps = []
+    fixed_names = []
+    fixed_format = ''
+    # the position of the next field, as (constant, sorted variables)
+    position = (0, ())
+    seen_optional = False
+
+    def flush_fixed():
+        nonlocal fixed_names, fixed_format
+        if fixed_names:
+            decode_steps.append(_DecodeStep(tuple(fixed_names), struct.Struct('>' + fixed_format), None, False))
+        fixed_names, fixed_format = [], ''
+
+    for fieldname, poslenMap in payload.items():
+        optional = "feature" in poslenMap
+        # an optional field is skipped when the message ends before it,
+        # so it cannot be followed by mandatory fields
+        assert optional or not seen_optional, (k, fieldname)
+        seen_optional |= optional
+        constant, variables, is_product = _parse_exp(poslenMap["position"])
+        assert position is not None and not is_product, (k, fieldname)
+        assert (constant, tuple(sorted(variables))) == position, (k, fieldname)
+        length = _compile_exp(poslenMap["length"])
+        encode_steps.append(_EncodeStep(fieldname, length, optional))
+        if isinstance(length, int):
+            position = (position[0] + length, position[1])
+            if not optional:
+                fixed_names.append(fieldname)
+                fixed_format += '%ds' % length
+                continue
+            flush_fixed()
+            decode_steps.append(_DecodeStep((fieldname,), struct.Struct('>%ds' % length), None, True))
+        else:
+            constant, variables, is_product = _parse_exp(poslenMap["length"])
+            if is_product:
+                # positions after this would not be sums
+                position = None
+            else:
+                position = (position[0] + constant, tuple(sorted(position[1] + variables)))
+            flush_fixed()
+            decode_steps.append(_DecodeStep((fieldname,), None, length, optional))
+    flush_fixed()
+    return tuple(decode_steps), tuple(encode_steps)
 
 def _make_handler(k: str, v: dict) -> Callable[[bytes], Tuple[str, dict]]:
     """
@@ -54,28 +137,42 @@ def _make_handler(k: str, v: dict) -> Callable[[bytes], Tuple[str, dict]]:
 
       { type: 16, payload: { 'gflen': ..., ... }, ... }
 
-    Returns function taking bytes
+    Returns function taking bytes, and optionally
+    the offset of the payload in them
     """
-    def handler(data: bytes) -> Tuple[str, dict]:
-        nonlocal k, v
+    decode_steps, _ = _compile_payload(k, v["payload"])
+    if len(decode_steps) == 1 and decode_steps[0].struct is not None and not decode_steps[0].optional:
+        # fixed-size message: a single struct does it all
+        names, s = decode_steps[0].names, decode_steps[0].struct
+        size, unpack_from = s.size, s.unpack_from
+        def handler(data: bytes, start: int = 0) -> Tuple[str, dict]:
+            assert len(data) - start == size, (k, size, len(data) - start)
+            return k, dict(zip(names, unpack_from(data, start)))
+        return handler
+
+    def handler(data: bytes, start: int = 0) -> Tuple[str, dict]:
         ma = {}
-        pos = 0
-        for fieldname in v["payload"]:
-            poslenMap = v["payload"][fieldname]
-            if "feature" in poslenMap and pos == len(data):
-                continue
-            assert pos == _eval_exp_with_ctx(poslenMap["position"], ma)
-            length = poslenMap["length"]
-            length = _eval_exp_with_ctx(length, ma)
-            ma[fieldname] = data[pos:pos+length]
-            pos += length
-        assert pos == len(data), (k, pos, len(data))
+        pos = start
+        end = len(data)
+        for names, s, length, optional in decode_steps:
+            if optional and pos == end:
+                break
+            if s is not None:
+                assert pos + s.size <= end, (k, pos + s.size - start, end - start)
+                ma.update(zip(names, s.unpack_from(data, pos)))
+                pos += s.size
+            else:
+                length = length(ma)
+                ma[names[0]] = data[pos:pos+length]
+                pos += length
+        assert pos == end, (k, pos - start, end - start)
         return k, ma
     return handler
 
 class LNSerializer:
     def __init__(self):
         message_types = {}
+        encoders = {}
         path = os.path.join(os.path.dirname(__file__), 'lightning.json')
         with open(path) as f:
             structured = json.loads(f.read(), object_pairs_hook=OrderedDict)
@@ -101,30 +198,40 @@ class LNSerializer:
             message_types[byts] = _make_handler(k, v)
             message_types[byts].__name__ = k + "_handler"
 
+        for k, v in structured.items():
+            try:
+                byts = int(v["type"]).to_bytes(2, 'big')
+            except ValueError:
+                continue
+            encoders[k] = byts, _compile_payload(k, v["payload"])[1]
+
         assert message_types[b"\x00\x10"].__name__ == "init_handler"
         self.structured = structured
         self.message_types = message_types
+        self._encoders = encoders
 
     def encode_msg(self, msg_type : str, **kwargs) -> bytes:
         """
         Encode kwargs into a Lightning message (bytes)
         of the type given in the msg_type string
         """
-        typ = self.structured[msg_type]
-        data = int(typ["type"]).to_bytes(2, 'big')
+        try:
+            typ, encode_steps = self._encoders[msg_type]
+        except KeyError:
+            # same error as for an unknown type, non-integer types are not encodable
+            int(self.structured[msg_type]["type"])
+            raise
+        data = [typ]
         lengths = {}
-        for k in typ["payload"]:
-            poslenMap = typ["payload"][k]
-            if k not in kwargs and "feature" in poslenMap:
+        # length variables are taken from kwargs, falling back to the
+        # lengths of the fields already encoded
+        ctx = ChainMap(kwargs, lengths)
+        for k, leng, optional in encode_steps:
+            if optional and k not in kwargs:
                 continue
             param = kwargs.get(k, 0)
-            leng = _eval_exp_with_ctx(poslenMap["length"], lengths)
-            try:
-                clone = dict(lengths)
-                clone.update(kwargs)
-                leng = _eval_exp_with_ctx(poslenMap["length"], clone)
-            except KeyError:
-                pass
+            if not isinstance(leng, int):
+                leng = leng(ctx)
             try:
                 if not isinstance(param, bytes):
                     assert isinstance(param, int), "field {} is neither bytes or int".format(k)
@@ -134,8 +241,8 @@ class LNSerializer:
             lengths[k] = len(param)
             if lengths[k] != leng:
                 raise Exception("field {} is {} bytes long, should be {} bytes long".format(k, lengths[k], leng))
-            data += param
-        return data
+            data.append(param)
+        return b''.join(data)
 
     def decode_msg(self, data : bytes) -> Tuple[str, dict]:
         """
@@ -145,7 +252,7 @@ class LNSerializer:
         Returns message type string and parsed message contents dict
         """
         typ = data[:2]
-        k, parsed = self.message_types[typ](data[2:])
+        k, parsed = self.message_types[typ](data, 2)
         return k, parsed
 
 _inst = LNSerializer()
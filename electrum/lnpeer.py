@@ -10,6 +10,7 @@ import json
 import asyncio
 import os
 import time
+import concurrent.futures
 from functools import partial
 from typing import List, Tuple, Dict, TYPE_CHECKING, Optional, Callable, Union
 import traceback
@@ -55,6 +56,14 @@ if TYPE_CHECKING:
 
 
 LN_P2P_NETWORK_TIMEOUT = 20
+# stop reading from the transport while this many gossip messages are pending
+GOSSIP_QUEUE_MAX_SIZE = 5000
+# gossip signatures are verified in a thread pool shared by all peers,
+# in jobs of at most this many messages
+GOSSIP_VERIFY_BATCH_SIZE = 100
+
+_gossip_verify_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='gossip_verify')
 
 
 def channel_id_from_funding_tx(funding_txid: str, funding_index: int) -> Tuple[bytes, bytes]:
@@ -62,6 +71,16 @@ def channel_id_from_funding_tx(funding_txid: str, funding_index: int) -> Tuple[b
     i = int.from_bytes(funding_txid_bytes, 'big') ^ funding_index
     return i.to_bytes(32, 'big'), funding_txid_bytes
 
+async def verify_gossip(verify_func: Callable[[list], None], payloads: list) -> None:
+    """Run verify_func over payloads in the gossip verification thread pool,
+    so that checking signatures does not block the event loop.
+    Raises if any batch fails to verify.
+    """
+    loop = asyncio.get_event_loop()
+    await asyncio.gather(*[loop.run_in_executor(_gossip_verify_executor, verify_func, batch)
+                           for batch in chunks(payloads, GOSSIP_VERIFY_BATCH_SIZE)])
+
+
 class Peer(Logger):
 
     def __init__(self, lnworker: Union['LNGossip', 'LNWallet'], pubkey:bytes, transport: LNTransportBase):
@@ -277,16 +296,18 @@ class Peer(Logger):
             # note: data processed in chunks to avoid taking sql lock for too long
             # channel announcements
             for chan_anns_chunk in chunks(chan_anns, 300):
-                self.verify_channel_announcements(chan_anns_chunk)
+                await verify_gossip(self.verify_channel_announcements, chan_anns_chunk)
                 self.channel_db.add_channel_announcement(chan_anns_chunk)
             # node announcements
             for node_anns_chunk in chunks(node_anns, 100):
-                self.verify_node_announcements(node_anns_chunk)
+                await verify_gossip(self.verify_node_announcements, node_anns_chunk)
                 self.channel_db.add_node_announcement(node_anns_chunk)
             # channel updates
             for chan_upds_chunk in chunks(chan_upds, 1000):
-                categorized_chan_upds = self.channel_db.add_channel_updates(
+                categorized_chan_upds = self.channel_db.categorize_channel_updates(
                     chan_upds_chunk, max_age=self.network.lngossip.max_age)
+                await verify_gossip(self.channel_db.verify_channel_updates, categorized_chan_upds.good)
+                categorized_chan_upds = self.channel_db.apply_channel_updates(categorized_chan_upds)
                 orphaned = categorized_chan_upds.orphaned
                 if orphaned:
                     self.logger.info(f'adding {len(orphaned)} unknown channel ids')
@@ -303,22 +324,25 @@ class Peer(Logger):
                 if categorized_chan_upds.good:
                     self.logger.debug(f'on_channel_update: {len(categorized_chan_upds.good)}/{len(chan_upds_chunk)}')
 
-    def verify_channel_announcements(self, chan_anns):
+    # note: the verify_* methods may run outside the event loop thread, see verify_gossip
+
+    @staticmethod
+    def verify_channel_announcements(chan_anns):
+        items = []
         for payload in chan_anns:
             h = sha256d(payload['raw'][2+256:])
             pubkeys = [payload['node_id_1'], payload['node_id_2'], payload['bitcoin_key_1'], payload['bitcoin_key_2']]
             sigs = [payload['node_signature_1'], payload['node_signature_2'], payload['bitcoin_signature_1'], payload['bitcoin_signature_2']]
-            for pubkey, sig in zip(pubkeys, sigs):
-                if not ecc.verify_signature(pubkey, sig, h):
-                    raise Exception('signature failed')
-
-    def verify_node_announcements(self, node_anns):
-        for payload in node_anns:
-            pubkey = payload['node_id']
-            signature = payload['signature']
-            h = sha256d(payload['raw'][66:])
-            if not ecc.verify_signature(pubkey, signature, h):
-                raise Exception('signature failed')
+            items += [(pubkey, sig, h) for pubkey, sig in zip(pubkeys, sigs)]
+        if not ecc.verify_signatures(items):
+            raise Exception('signature failed')
+
+    @staticmethod
+    def verify_node_announcements(node_anns):
+        items = [(payload['node_id'], payload['signature'], sha256d(payload['raw'][66:]))
+                 for payload in node_anns]
+        if not ecc.verify_signatures(items):
+            raise Exception('signature failed')
 
     async def query_gossip(self):
         try:
@@ -449,6 +473,9 @@ class Peer(Logger):
             self.process_message(msg)
             await asyncio.sleep(.01)
             self.ping_if_required()
+            # backpressure: let process_gossip catch up before reading more
+            while self.gossip_queue.qsize() >= GOSSIP_QUEUE_MAX_SIZE:
+                await asyncio.sleep(1)
 
     def on_reply_short_channel_ids_end(self, payload):
         self.querying.set()
@@ -23,14 +23,15 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import queue
-from collections import defaultdict
+import heapq
+import time
+from collections import defaultdict, OrderedDict
 from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
 
 from .util import bh2u, profiler
 from .logging import Logger
 from .lnutil import NUM_MAX_EDGES_IN_PAYMENT_PATH, ShortChannelID
-from .channel_db import ChannelDB, Policy
+from .channel_db import ChannelDB, Policy, ChannelInfo
 
 if TYPE_CHECKING:
     from .lnchannel import Channel
@@ -72,19 +73,24 @@ class RouteEdge(NamedTuple):
                          channel_policy.cltv_expiry_delta)
 
     def is_sane_to_use(self, amount_msat: int) -> bool:
-        # TODO revise ad-hoc heuristics
-        # cltv cannot be more than 2 weeks
-        if self.cltv_expiry_delta > 14 * 144: return False
-        total_fee = self.fee_for_edge(amount_msat)
-        # fees below 50 sat are fine
-        if total_fee > 50_000:
-            # fee cannot be higher than amt
-            if total_fee > amount_msat: return False
-            # fee cannot be higher than 5000 sat
-            if total_fee > 5_000_000: return False
-            # unless amt is tiny, fee cannot be more than 10%
-            if amount_msat > 1_000_000 and total_fee > amount_msat/10: return False
-        return True
+        return is_edge_sane_to_use(amount_msat=amount_msat,
+                                   fee_msat=self.fee_for_edge(amount_msat),
+                                   cltv_expiry_delta=self.cltv_expiry_delta)
+
+
+def is_edge_sane_to_use(*, amount_msat: int, fee_msat: int, cltv_expiry_delta: int) -> bool:
+    # TODO revise ad-hoc heuristics
+    # cltv cannot be more than 2 weeks
+    if cltv_expiry_delta > 14 * 144: return False
+    # fees below 50 sat are fine
+    if fee_msat > 50_000:
+        # fee cannot be higher than amt
+        if fee_msat > amount_msat: return False
+        # fee cannot be higher than 5000 sat
+        if fee_msat > 5_000_000: return False
+        # unless amt is tiny, fee cannot be more than 10%
+        if amount_msat > 1_000_000 and fee_msat > amount_msat/10: return False
+    return True
 
 
 LNPaymentRoute = Sequence[RouteEdge]
@@ -117,23 +123,60 @@ def is_route_sane_to_use(route: LNPaymentRoute, invoice_amount_msat: int, min_fi
     return True
 
 
+# Failures of a channel are forgotten over time: its failure score
+# halves every FAILURE_SCORE_HALF_LIFE seconds. A channel is not used
+# while its score is above FAILURE_SCORE_BLACKLIST, i.e. for one half-life
+# after a failure. After that, its score is added to the cost of the
+# channel, weighted by FAILURE_SCORE_COST.
+FAILURE_SCORE_HALF_LIFE = 600
+FAILURE_SCORE_BLACKLIST = 0.5
+FAILURE_SCORE_COST = 1000
+
+# paths found for a (source, destination, amount bucket) are reused
+# for this long, as long as they are usable for the amount paid
+ROUTE_CACHE_TTL = 60
+ROUTE_CACHE_SIZE = 100
+
+
 class LNPathFinder(Logger):
 
     def __init__(self, channel_db: ChannelDB):
         Logger.__init__(self)
         self.channel_db = channel_db
-        self.blacklist = set()
+        # short_channel_id -> (failure score, time it was last updated)
+        self._failure_scores = {}  # type: Dict[ShortChannelID, Tuple[float, float]]
+        # (nodeA, nodeB, amount bucket) -> (time, paths)
+        self._path_cache = OrderedDict()  # type: Dict[Tuple[bytes, bytes, int], Tuple[float, List[Sequence[Tuple[bytes, bytes]]]]]
 
     def add_to_blacklist(self, short_channel_id: ShortChannelID):
-        self.logger.info(f'blacklisting channel {short_channel_id}')
-        self.blacklist.add(short_channel_id)
+        now = time.time()
+        score = self.get_failure_score(short_channel_id, now) + 1
+        self.logger.info(f'blacklisting channel {short_channel_id}, failure score {score:.2f}')
+        self._failure_scores[short_channel_id] = score, now
+
+    def clear_blacklist(self):
+        self._failure_scores.clear()
+
+    def get_failure_score(self, short_channel_id: bytes, now: float = None) -> float:
+        if short_channel_id not in self._failure_scores:
+            return 0
+        if now is None:
+            now = time.time()
+        score, timestamp = self._failure_scores[short_channel_id]
+        score *= 0.5 ** ((now - timestamp) / FAILURE_SCORE_HALF_LIFE)
+        if score < 0.01:
+            del self._failure_scores[short_channel_id]
+            return 0
+        return score
 
     def _edge_cost(self, short_channel_id: bytes, start_node: bytes, end_node: bytes,
-                   payment_amt_msat: int, ignore_costs=False, is_mine=False) -> Tuple[float, int]:
+                   payment_amt_msat: int, ignore_costs=False, is_mine=False,
+                   *, channel_info: ChannelInfo = None) -> Tuple[float, int]:
         """Heuristic cost of going through a channel.
         Returns (heuristic_cost, fee_for_edge_msat).
         """
-        channel_info = self.channel_db.get_channel_info(short_channel_id)
+        if channel_info is None:
+            channel_info = self.channel_db.get_channel_info(short_channel_id)
         if channel_info is None:
             return float('inf'), 0
         channel_policy = self.channel_db.get_policy_for_node(short_channel_id, start_node)
@@ -144,7 +187,6 @@ class LNPathFinder(Logger):
             return float('inf'), 0
         if channel_policy.is_disabled():
             return float('inf'), 0
-        route_edge = RouteEdge.from_channel_policy(channel_policy, short_channel_id, end_node)
         if payment_amt_msat < channel_policy.htlc_minimum_msat:
             return float('inf'), 0  # payment amount too little
         if channel_info.capacity_sat is not None and \
@@ -153,20 +195,27 @@ class LNPathFinder(Logger):
         if channel_policy.htlc_maximum_msat is not None and \
                 payment_amt_msat > channel_policy.htlc_maximum_msat:
             return float('inf'), 0  # payment amount too large
-        if not route_edge.is_sane_to_use(payment_amt_msat):
+        # note: no RouteEdge is created here, as this runs for every edge relaxation
+        fee_msat = fee_for_edge_msat(forwarded_amount_msat=payment_amt_msat,
+                                     fee_base_msat=channel_policy.fee_base_msat,
+                                     fee_proportional_millionths=channel_policy.fee_proportional_millionths)
+        if not is_edge_sane_to_use(amount_msat=payment_amt_msat, fee_msat=fee_msat,
+                                   cltv_expiry_delta=channel_policy.cltv_expiry_delta):
             return float('inf'), 0  # thanks but no thanks
-        fee_msat = route_edge.fee_for_edge(payment_amt_msat) if not ignore_costs else 0
+        if ignore_costs:
+            return 1, 0
         # TODO revise
         # paying 10 more satoshis ~ waiting one more block
         fee_cost = fee_msat / 1000 / 10
-        cltv_cost = route_edge.cltv_expiry_delta if not ignore_costs else 0
+        cltv_cost = channel_policy.cltv_expiry_delta
         return cltv_cost + fee_cost + 1, fee_msat
 
     @profiler
     def find_path_for_payment(self, nodeA: bytes, nodeB: bytes,
                               invoice_amount_msat: int,
-                              my_channels: List['Channel']=None) -> Sequence[Tuple[bytes, bytes]]:
-        """Return a path from nodeA to nodeB.
+                              my_channels: List['Channel']=None,
+                              *, exclude: Set[bytes] = frozenset()) -> Sequence[Tuple[bytes, bytes]]:
+        """Return a path from nodeA to nodeB, not using the channels in exclude.
 
         Returns a list of (node_id, short_channel_id) representing a path.
         To get from node ret[n][0] to ret[n+1][0], use channel ret[n+1][1];
@@ -177,58 +226,71 @@ class LNPathFinder(Logger):
         assert type(invoice_amount_msat) is int
         if my_channels is None: my_channels = []
         my_channels = {chan.short_channel_id: chan for chan in my_channels}
+        now = time.time()
 
         # FIXME paths cannot be longer than 20 edges (onion packet)...
 
         # run Dijkstra
         # The search is run in the REVERSE direction, from nodeB to nodeA,
         # to properly calculate compound routing fees.
+        # It goes over the edges prepared by channel_db, which have the policy
+        # fields needed here; no objects are created per edge relaxation.
         distance_from_start = defaultdict(lambda: float('inf'))
         distance_from_start[nodeB] = 0
         prev_node = {}
-        nodes_to_explore = queue.PriorityQueue()
-        nodes_to_explore.put((0, invoice_amount_msat, nodeB))  # order of fields (in tuple) matters!
-
-        def inspect_edge():
-            is_mine = edge_channel_id in my_channels
-            if is_mine:
-                if edge_startnode == nodeA:  # payment outgoing, on our channel
-                    if not my_channels[edge_channel_id].can_pay(amount_msat):
-                        return
-                else:  # payment incoming, on our channel. (funny business, cycle weirdness)
-                    assert edge_endnode == nodeA, (bh2u(edge_startnode), bh2u(edge_endnode))
-                    pass  # TODO?
-            edge_cost, fee_for_edge_msat = self._edge_cost(
-                edge_channel_id,
-                start_node=edge_startnode,
-                end_node=edge_endnode,
-                payment_amt_msat=amount_msat,
-                ignore_costs=(edge_startnode == nodeA),
-                is_mine=is_mine)
-            alt_dist_to_neighbour = distance_from_start[edge_endnode] + edge_cost
-            if alt_dist_to_neighbour < distance_from_start[edge_startnode]:
-                distance_from_start[edge_startnode] = alt_dist_to_neighbour
-                prev_node[edge_startnode] = edge_endnode, edge_channel_id
-                amount_to_forward_msat = amount_msat + fee_for_edge_msat
-                nodes_to_explore.put((alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
+        nodes_to_explore = [(0, invoice_amount_msat, nodeB)]  # heap; order of fields (in tuple) matters!
+        failure_scores = self._failure_scores
 
         # main loop of search
-        while nodes_to_explore.qsize() > 0:
-            dist_to_edge_endnode, amount_msat, edge_endnode = nodes_to_explore.get()
+        while nodes_to_explore:
+            dist_to_edge_endnode, amount_msat, edge_endnode = heapq.heappop(nodes_to_explore)
             if edge_endnode == nodeA:
                 break
             if dist_to_edge_endnode != distance_from_start[edge_endnode]:
-                # queue.PriorityQueue does not implement decrease_priority,
+                # heapq does not implement decrease_priority,
                 # so instead of decreasing priorities, we add items again into the queue.
                 # so there are duplicates in the queue, that we discard now:
                 continue
-            for edge_channel_id in self.channel_db.get_channels_for_node(edge_endnode):
-                assert isinstance(edge_channel_id, bytes)
-                if edge_channel_id in self.blacklist:
+            for (edge_channel_id, edge_startnode, fee_base_msat, fee_proportional_millionths,
+                 cltv_expiry_delta, htlc_minimum_msat, htlc_maximum_msat, has_end_policy) \
+                    in self.channel_db.get_edges_to_node(edge_endnode):
+                if edge_channel_id in exclude:
                     continue
-                channel_info = self.channel_db.get_channel_info(edge_channel_id)
-                edge_startnode = channel_info.node2_id if channel_info.node1_id == edge_endnode else channel_info.node1_id
-                inspect_edge()
+                failure_score = self.get_failure_score(edge_channel_id, now) if edge_channel_id in failure_scores else 0
+                if failure_score > FAILURE_SCORE_BLACKLIST:
+                    continue
+                is_mine = edge_channel_id in my_channels
+                if is_mine:
+                    if edge_startnode == nodeA:  # payment outgoing, on our channel
+                        if not my_channels[edge_channel_id].can_pay(amount_msat):
+                            continue
+                    else:  # payment incoming, on our channel. (funny business, cycle weirdness)
+                        assert edge_endnode == nodeA, (bh2u(edge_startnode), bh2u(edge_endnode))
+                        pass  # TODO?
+                # the same checks as in _edge_cost
+                # channels that did not publish both policies often return temporary channel failure
+                if not has_end_policy and not is_mine:
+                    continue
+                if amount_msat < htlc_minimum_msat:
+                    continue  # payment amount too little
+                if htlc_maximum_msat is not None and amount_msat > htlc_maximum_msat:
+                    continue  # payment amount too large
+                fee_msat = fee_base_msat + amount_msat * fee_proportional_millionths // 1_000_000
+                if (cltv_expiry_delta > 14 * 144 or fee_msat > 50_000) and \
+                        not is_edge_sane_to_use(amount_msat=amount_msat, fee_msat=fee_msat,
+                                                cltv_expiry_delta=cltv_expiry_delta):
+                    continue  # thanks but no thanks
+                if edge_startnode == nodeA:
+                    # no fees on our own channel
+                    edge_cost, fee_msat = 1, 0
+                else:
+                    # paying 10 more satoshis ~ waiting one more block
+                    edge_cost = cltv_expiry_delta + fee_msat / 1000 / 10 + 1
+                alt_dist_to_neighbour = dist_to_edge_endnode + edge_cost + failure_score * FAILURE_SCORE_COST
+                if alt_dist_to_neighbour < distance_from_start[edge_startnode]:
+                    distance_from_start[edge_startnode] = alt_dist_to_neighbour
+                    prev_node[edge_startnode] = edge_endnode, edge_channel_id
+                    heapq.heappush(nodes_to_explore, (alt_dist_to_neighbour, amount_msat + fee_msat, edge_startnode))
         else:
             return None  # no path found
 
@@ -241,6 +303,62 @@ class LNPathFinder(Logger):
             edge_startnode = edge_endnode
         return path
 
+    def find_paths_for_payment(self, nodeA: bytes, nodeB: bytes, invoice_amount_msat: int,
+                               my_channels: List['Channel'] = None,
+                               num_paths: int = 1) -> List[Sequence[Tuple[bytes, bytes]]]:
+        """Return up to num_paths paths from nodeA to nodeB, cheapest first.
+
+        Apart from our own channels, paths do not share channels, so
+        that a failure along one of them says little about the others.
+        Paths are cached per amount bucket, and those still usable
+        for invoice_amount_msat are returned again.
+        """
+        now = time.time()
+        key = (nodeA, nodeB, invoice_amount_msat.bit_length())
+        if key in self._path_cache:
+            timestamp, paths = self._path_cache[key]
+            if now - timestamp < ROUTE_CACHE_TTL:
+                paths = [path for path in paths
+                         if self._is_path_usable(nodeA, path, invoice_amount_msat, my_channels, now)]
+                if paths:
+                    self._path_cache.move_to_end(key)
+                    return paths[:num_paths]
+        paths = []
+        exclude = set()
+        for i in range(num_paths):
+            path = self.find_path_for_payment(nodeA, nodeB, invoice_amount_msat, my_channels, exclude=exclude)
+            if path is None or path in paths:
+                break
+            paths.append(path)
+            exclude |= {short_channel_id for node_id, short_channel_id in path[1:]}
+        if paths:
+            self._path_cache[key] = now, paths
+            while len(self._path_cache) > ROUTE_CACHE_SIZE:
+                self._path_cache.popitem(last=False)
+        else:
+            self._path_cache.pop(key, None)
+        return paths
+
+    def _is_path_usable(self, nodeA: bytes, path: Sequence[Tuple[bytes, bytes]], invoice_amount_msat: int,
+                        my_channels: Optional[List['Channel']], now: float) -> bool:
+        """Whether find_path_for_payment could still return this path for this amount."""
+        my_channels = {chan.short_channel_id: chan for chan in my_channels or []}
+        amount_msat = invoice_amount_msat
+        nodes = [nodeA] + [node_id for node_id, short_channel_id in path]
+        for i in reversed(range(len(path))):
+            start_node, (end_node, short_channel_id) = nodes[i], path[i]
+            if self.get_failure_score(short_channel_id, now) > FAILURE_SCORE_BLACKLIST:
+                return False
+            is_mine = short_channel_id in my_channels
+            if is_mine and start_node == nodeA and not my_channels[short_channel_id].can_pay(amount_msat):
+                return False
+            edge_cost, fee_msat = self._edge_cost(short_channel_id, start_node, end_node, amount_msat,
+                                                  ignore_costs=(start_node == nodeA), is_mine=is_mine)
+            if edge_cost == float('inf'):
+                return False
+            amount_msat += fee_msat
+        return True
+
     def create_route_from_path(self, path, from_node_id: bytes) -> LNPaymentRoute:
         assert isinstance(from_node_id, bytes)
         if path is None:
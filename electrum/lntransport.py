@@ -104,29 +104,25 @@ class LNTransportBase:
         self.writer.write(lc+c)
 
     async def read_messages(self):
-        read_buffer = b''
+        # note: framing is left to the StreamReader, which reads the socket
+        # in large chunks into a bytearray that is consumed from the front,
+        # so a burst of messages is neither copied quadratically nor is the
+        # length prefix of a message decrypted more than once.
         while True:
             rn_l, rk_l = self.rn()
             rn_m, rk_m = self.rn()
-            while True:
-                if len(read_buffer) >= 18:
-                    lc = read_buffer[:18]
-                    l = aead_decrypt(rk_l, rn_l, b'', lc)
-                    length = int.from_bytes(l, 'big')
-                    offset = 18 + length + 16
-                    if len(read_buffer) >= offset:
-                        c = read_buffer[18:offset]
-                        read_buffer = read_buffer[offset:]
-                        msg = aead_decrypt(rk_m, rn_m, b'', c)
-                        yield msg
-                        break
-                try:
-                    s = await self.reader.read(2**10)
-                except:
-                    s = None
-                if not s:
-                    raise LightningPeerConnectionClosed()
-                read_buffer += s
+            lc = await self._read_exactly(18)
+            l = aead_decrypt(rk_l, rn_l, b'', lc)
+            length = int.from_bytes(l, 'big')
+            c = await self._read_exactly(length + 16)
+            yield aead_decrypt(rk_m, rn_m, b'', c)
+
+    async def _read_exactly(self, n: int) -> bytes:
+        try:
+            return await self.reader.readexactly(n)
+        except Exception as e:
+            # e.g. asyncio.IncompleteReadError, ConnectionResetError
+            raise LightningPeerConnectionClosed() from e
 
     def rn(self):
         o = self._rn, self.rk
@@ -5,6 +5,7 @@
 from enum import IntFlag, IntEnum
 import json
 from collections import namedtuple
+from functools import lru_cache
 from typing import NamedTuple, List, Tuple, Mapping, Optional, TYPE_CHECKING, Union, Dict, Set, Sequence
 import re
 
@@ -33,6 +34,8 @@ HTLC_SUCCESS_WEIGHT = 703
 
 LN_MAX_FUNDING_SAT = pow(2, 24) - 1
 
+DERIVED_KEY_CACHE_SIZE = 1000
+
 # dummy address for fee estimation of funding tx
 def ln_dummy_address():
     return redeem_script_to_address('p2wsh', '')
@@ -273,6 +276,9 @@ def secret_to_pubkey(secret: int) -> bytes:
 def privkey_to_pubkey(priv: bytes) -> bytes:
     return ecc.ECPrivkey(priv[:32]).get_public_key_bytes()
 
+# Keys derived from per-commitment points are memoized: each one is
+# needed for the ctx itself and again for every htlc in it.
+@lru_cache(maxsize=DERIVED_KEY_CACHE_SIZE)
 def derive_pubkey(basepoint: bytes, per_commitment_point: bytes) -> bytes:
     p = ecc.ECPubkey(basepoint) + ecc.generator() * ecc.string_to_number(sha256(per_commitment_point + basepoint))
     return p.get_public_key_bytes()
@@ -284,6 +290,7 @@ def derive_privkey(secret: int, per_commitment_point: bytes) -> int:
     basepoint %= CURVE_ORDER
     return basepoint
 
+@lru_cache(maxsize=DERIVED_KEY_CACHE_SIZE)
 def derive_blinded_pubkey(basepoint: bytes, per_commitment_point: bytes) -> bytes:
     k1 = ecc.ECPubkey(basepoint) * ecc.string_to_number(sha256(basepoint + per_commitment_point))
     k2 = ecc.ECPubkey(per_commitment_point) * ecc.string_to_number(sha256(per_commitment_point + basepoint))
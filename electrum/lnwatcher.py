@@ -9,8 +9,9 @@ import threading
 import concurrent
 from collections import defaultdict
 import asyncio
+import heapq
 from enum import IntEnum, auto
-from typing import NamedTuple, Dict
+from typing import NamedTuple, Dict, Sequence, Tuple, Union, Set, Optional
 
 from .sql_db import SqlDB, sql
 from .json_db import JsonDB
@@ -29,6 +30,10 @@ class ListenerItem(NamedTuple):
     # txs we broadcast are put on this queue so that the test can wait for them to get mined
     tx_queue : asyncio.Queue
 
+# a spending tx with more confirmations than this is not watched anymore
+DEEP_CONFIRMATIONS = 100
+
+
 class TxMinedDepth(IntEnum):
     """ IntEnum because we call min() in get_deepest_tx_mined_depth_for_txids """
     DEEP = auto()
@@ -45,6 +50,12 @@ prevout VARCHAR(34),
 tx VARCHAR
 )"""
 
+create_sweep_txs_index="""
+CREATE INDEX IF NOT EXISTS sweep_txs_outpoint_prevout ON sweep_txs (funding_outpoint, prevout)"""
+
+create_sweep_txs_ctn_index="""
+CREATE INDEX IF NOT EXISTS sweep_txs_outpoint_ctn ON sweep_txs (funding_outpoint, ctn)"""
+
 create_channel_info="""
 CREATE TABLE IF NOT EXISTS channel_info (
 outpoint VARCHAR(34) NOT NULL,
@@ -62,6 +73,8 @@ class SweepStore(SqlDB):
         c = self.conn.cursor()
         c.execute(create_channel_info)
         c.execute(create_sweep_txs)
+        c.execute(create_sweep_txs_index)
+        c.execute(create_sweep_txs_ctn_index)
         self.conn.commit()
 
     @sql
@@ -77,11 +90,27 @@ class SweepStore(SqlDB):
         return set([r[0] for r in c.fetchall()])
 
     @sql
-    def add_sweep_tx(self, funding_outpoint, ctn, prevout, tx: Transaction):
+    def add_sweep_tx(self, funding_outpoint, ctn, prevout, tx: Union[Transaction, str]):
+        self._add_sweep_txs(funding_outpoint, [(ctn, prevout, tx)])
+
+    @sql
+    def add_sweep_txs(self, funding_outpoint, sweeps: Sequence[Tuple[int, str, Union[Transaction, str]]]):
+        """Add (ctn, prevout, tx) sweeps of a channel, in a single transaction."""
+        self._add_sweep_txs(funding_outpoint, sweeps)
+
+    def _add_sweep_txs(self, funding_outpoint, sweeps):
+        rows = []
+        for ctn, prevout, tx in sweeps:
+            if isinstance(tx, Transaction):
+                assert tx.is_complete()
+                tx = tx.serialize()
+            rows.append((funding_outpoint, int(ctn), prevout, bfh(tx)))
         c = self.conn.cursor()
-        assert tx.is_complete()
-        raw_tx = bfh(tx.serialize())
-        c.execute("""INSERT INTO sweep_txs (funding_outpoint, ctn, prevout, tx) VALUES (?,?,?,?)""", (funding_outpoint, ctn, prevout, raw_tx))
+        try:
+            c.executemany("""INSERT INTO sweep_txs (funding_outpoint, ctn, prevout, tx) VALUES (?,?,?,?)""", rows)
+        except BaseException:
+            self.conn.rollback()
+            raise
         self.conn.commit()
 
     @sql
@@ -138,8 +167,20 @@ class SweepStore(SqlDB):
 
 class LNWatcher(AddressSynchronizer):
     LOGGING_SHORTCUT = 'W'
+    # LNWallet looks at the funding depth and at expiring htlcs of open channels
+    # on every new block. A watchtower only acts when the funding outpoint is spent.
+    CHECK_OPEN_CHANNELS_ON_NEW_BLOCK = True
 
     def __init__(self, network: 'Network'):
+        # channels are only re-examined when one of their txs changes,
+        # or when a height they wait for is reached
+        self._channels_by_txid = defaultdict(set)  # type: Dict[str, Set[str]]
+        self._channel_addresses = {}  # type: Dict[str, str]
+        self._open_channels = set()  # type: Set[str]
+        self._dirty_channels = set()  # type: Set[str]
+        self._timers = []  # heap of (height, funding_outpoint)
+        self._timer_set = set()  # type: Set[Tuple[int, str]]
+        self._last_checked_height = None  # type: Optional[int]
         AddressSynchronizer.__init__(self, JsonDB({}, manual_upgrades=False))
         self.config = network.config
         self.channels = {}
@@ -157,11 +198,99 @@ class LNWatcher(AddressSynchronizer):
         assert isinstance(outpoint, str)
         assert isinstance(address, str)
         self.add_address(address)
-        self.channels[address] = outpoint
+        with self.lock:
+            self.channels[address] = outpoint
+            self._channel_addresses[outpoint] = address
+            self._channels_by_txid[outpoint.split(':')[0]].add(outpoint)
+            self._dirty_channels.add(outpoint)
 
     async def unwatch_channel(self, address, funding_outpoint):
         pass
 
+    def schedule_check(self, txid: str, height: int) -> None:
+        """Re-examine the channels txid belongs to once the chain reaches height."""
+        with self.lock:
+            for outpoint in self._channels_by_txid.get(txid, ()):
+                self._add_timer(height, outpoint)
+
+    def schedule_retry(self, funding_outpoint: str) -> None:
+        """Re-examine the channel at the next block, e.g. after a failed broadcast."""
+        with self.lock:
+            self._add_timer(self.get_local_height() + 1, funding_outpoint)
+
+    def _add_timer(self, height: int, outpoint: str) -> None:
+        if (height, outpoint) in self._timer_set:
+            return
+        self._timer_set.add((height, outpoint))
+        heapq.heappush(self._timers, (height, outpoint))
+
+    def _mark_dirty(self, tx_hash: str, tx: Optional[Transaction] = None) -> None:
+        # a channel is affected if the tx is one of its txs, or spends one of their outputs
+        txids = {tx_hash}
+        if tx is not None:
+            txids.update(txin.prevout.txid.hex() for txin in tx.inputs() if not txin.is_coinbase_input())
+        with self.lock:
+            for txid in txids:
+                self._dirty_channels.update(self._channels_by_txid.get(txid, ()))
+
+    def add_transaction(self, tx: Transaction, *, allow_unrelated=False) -> bool:
+        added = super().add_transaction(tx, allow_unrelated=allow_unrelated)
+        if added:
+            self._mark_dirty(tx.txid(), tx)
+        return added
+
+    def remove_transaction(self, tx_hash: str) -> None:
+        tx = self.db.get_transaction(tx_hash)
+        super().remove_transaction(tx_hash)
+        self._mark_dirty(tx_hash, tx)
+
+    def add_verified_tx(self, tx_hash: str, info):
+        self._mark_dirty(tx_hash)
+        super().add_verified_tx(tx_hash, info)
+
+    def undo_verifications(self, blockchain, above_height):
+        txs = super().undo_verifications(blockchain, above_height)
+        for tx_hash in txs:
+            self._mark_dirty(tx_hash)
+        return txs
+
+    def _pop_channels_to_check(self) -> Set[str]:
+        height = self.get_local_height()
+        with self.lock:
+            outpoints = self._dirty_channels
+            self._dirty_channels = set()
+            while self._timers and self._timers[0][0] <= height:
+                timer = heapq.heappop(self._timers)
+                self._timer_set.discard(timer)
+                outpoints.add(timer[1])
+            if height != self._last_checked_height:
+                self._last_checked_height = height
+                if self.CHECK_OPEN_CHANNELS_ON_NEW_BLOCK:
+                    outpoints |= self._open_channels
+        return outpoints
+
+    def _index_channel(self, funding_outpoint: str, spenders: Dict[str, Optional[str]], keep_watching: bool) -> None:
+        """Remember which txs the situation of the channel depends on,
+        and when it has to be looked at again without any of them changing."""
+        with self.lock:
+            for prevout, txid in spenders.items():
+                self._channels_by_txid[prevout.split(':')[0]].add(funding_outpoint)
+                if txid is not None:
+                    self._channels_by_txid[txid].add(funding_outpoint)
+            if spenders.get(funding_outpoint) is None:
+                self._open_channels.add(funding_outpoint)
+                return
+            self._open_channels.discard(funding_outpoint)
+            if not keep_watching:
+                return
+            # spending txs stop being watched when they get deep
+            for txid in set(spenders.values()):
+                if txid is None:
+                    continue
+                tx_mined_info = self.get_tx_height(txid)
+                if 0 < tx_mined_info.conf <= DEEP_CONFIRMATIONS:
+                    self._add_timer(tx_mined_info.height + DEEP_CONFIRMATIONS, funding_outpoint)
+
     @log_exceptions
     async def on_network_update(self, event, *args):
         if event in ('verified', 'wallet_updated'):
@@ -172,11 +301,28 @@ class LNWatcher(AddressSynchronizer):
             return
         if not self.up_to_date:
             return
-        for address, outpoint in self.channels.items():
-            await self.check_onchain_situation(address, outpoint)
+        outpoints = self._pop_channels_to_check()
+        try:
+            while outpoints:
+                outpoint = outpoints.pop()
+                address = self._channel_addresses.get(outpoint)
+                if address is None:
+                    continue
+                try:
+                    await self.check_onchain_situation(address, outpoint)
+                except BaseException:
+                    outpoints.add(outpoint)
+                    raise
+        finally:
+            # channels that were not checked, e.g. because one of them raised,
+            # are checked at the next update
+            if outpoints:
+                with self.lock:
+                    self._dirty_channels |= outpoints
 
     async def check_onchain_situation(self, address, funding_outpoint):
         keep_watching, spenders = self.inspect_tx_candidate(funding_outpoint, 0)
+        self._index_channel(funding_outpoint, spenders, keep_watching)
         funding_txid = funding_outpoint.split(':')[0]
         funding_height = self.get_tx_height(funding_txid)
         closing_txid = spenders.get(funding_outpoint)
@@ -233,7 +379,7 @@ class LNWatcher(AddressSynchronizer):
             return TxMinedDepth.FREE
         tx_mined_depth = self.get_tx_height(txid)
         height, conf = tx_mined_depth.height, tx_mined_depth.conf
-        if conf > 100:
+        if conf > DEEP_CONFIRMATIONS:
             return TxMinedDepth.DEEP
         elif conf > 0:
             return TxMinedDepth.SHALLOW
@@ -251,6 +397,7 @@ class LNWatcher(AddressSynchronizer):
 class WatchTower(LNWatcher):
 
     LOGGING_SHORTCUT = 'W'
+    CHECK_OPEN_CHANNELS_ON_NEW_BLOCK = False
 
     def __init__(self, network):
         LNWatcher.__init__(self, network)
@@ -282,6 +429,7 @@ class WatchTower(LNWatcher):
             txid = await self.network.broadcast_transaction(tx)
         except Exception as e:
             self.logger.info(f'broadcast failure: txid={tx.txid()}, funding_outpoint={funding_outpoint}: {repr(e)}')
+            self.schedule_retry(funding_outpoint)
         else:
             self.logger.info(f'broadcast success: txid={tx.txid()}, funding_outpoint={funding_outpoint}')
             if funding_outpoint in self.tx_progress:
@@ -303,6 +451,11 @@ class WatchTower(LNWatcher):
             return await self.sweepstore.add_sweep_tx(funding_outpoint, ctn, prevout, tx)
         return self.network.run_from_another_thread(f())
 
+    def add_sweep_txs(self, funding_outpoint: str, sweeps: Sequence[Tuple[int, str, str]]):
+        async def f():
+            return await self.sweepstore.add_sweep_txs(funding_outpoint, sweeps)
+        return self.network.run_from_another_thread(f())
+
     def list_sweep_tx(self):
         async def f():
             return await self.sweepstore.list_sweep_tx()
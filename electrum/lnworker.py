@@ -14,6 +14,8 @@ import json
 from datetime import datetime, timezone
 from functools import partial
 from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from itertools import islice
 import concurrent
 from concurrent import futures
 
@@ -32,7 +34,7 @@ from .transaction import Transaction
 from .crypto import sha256
 from .bip32 import BIP32Node
 from .util import bh2u, bfh, InvoiceError, resolve_dns_srv, is_ip_address, log_exceptions
-from .util import ignore_exceptions, make_aiohttp_session
+from .util import ignore_exceptions
 from .util import timestamp_to_datetime
 from .logging import Logger
 from .lntransport import LNTransport, LNResponderTransport
@@ -73,6 +75,10 @@ NUM_PEERS_TARGET = 4
 PEER_RETRY_INTERVAL = 600  # seconds
 PEER_RETRY_INTERVAL_FOR_CHANNELS = 30  # seconds
 GRAPH_DOWNLOAD_SECONDS = 600
+WATCHTOWER_UPLOAD_BATCH_SIZE = 500  # sweep txs per request
+# routes probed concurrently before paying, see LNWallet._probe_routes
+PAYMENT_NUM_CANDIDATE_ROUTES = 3
+PAYMENT_PROBE_TIMEOUT = 60  # seconds
 
 FALLBACK_NODE_LIST_TESTNET = (
     LNPeerAddr(host='203.132.95.10', port=9735, pubkey=bfh('038863cf8ab91046230f561cd5b386cbff8309fa02e3f0c3ed161a3aeb64a643b9')),
@@ -361,6 +367,16 @@ class LNWallet(LNWorker):
         # timestamps of opening and closing transactions
         self.channel_timestamps = self.storage.get('lightning_channel_timestamps', {})
         self.pending_payments = defaultdict(asyncio.Future)
+        # lightning history: settled payments and channel events, by history key.
+        # items are only ever added or updated, also when a channel is removed.
+        self.payment_ledger = self.storage.get('lightning_payment_ledger', {})
+        # channel_id -> for LOCAL and REMOTE, the first htlc_id that was not
+        # resolved when the history index was last built
+        self.ledger_marks = self.storage.get('lightning_ledger_marks', {})
+        # history keys sorted by (timestamp, key), with the running balance after each
+        self._history_index = []  # type: List[Tuple[float, str]]
+        self._history_balances = []  # type: List[int]
+        self._init_history_index()
 
     @ignore_exceptions
     @log_exceptions
@@ -379,10 +395,20 @@ class LNWallet(LNWorker):
     async def sync_with_remote_watchtower(self):
         import aiohttp
         from jsonrpcclient.clients.aiohttp_client import AiohttpClient
+        from jsonrpcclient.exceptions import ReceivedNon2xxResponseError
         class myAiohttpClient(AiohttpClient):
             async def request(self, *args, **kwargs):
                 r = await super().request(*args, **kwargs)
                 return r.data.result
+            async def add_sweep_txs(self, outpoint, sweeps):
+                try:
+                    return await self.request('add_sweep_txs', outpoint, sweeps)
+                except ReceivedNon2xxResponseError as e:
+                    if e.code != 404:
+                        raise
+                # method not found: the watchtower predates bulk uploads
+                for ctn, prevout, tx in sweeps:
+                    await self.request('add_sweep_tx', outpoint, ctn, prevout, tx)
         while True:
             await asyncio.sleep(5)
             watchtower_url = self.config.get('watchtower_url')
@@ -391,11 +417,10 @@ class LNWallet(LNWorker):
             with self.lock:
                 channels = list(self.channels.values())
             try:
-                async with make_aiohttp_session(proxy=self.network.proxy) as session:
-                    watchtower = myAiohttpClient(session, watchtower_url)
-                    for chan in channels:
-                        await self.sync_channel_with_watchtower(chan, watchtower)
-            except aiohttp.client_exceptions.ClientConnectorError:
+                watchtower = myAiohttpClient(self.network._get_http_session(), watchtower_url)
+                for chan in channels:
+                    await self.sync_channel_with_watchtower(chan, watchtower)
+            except aiohttp.client_exceptions.ClientConnectionError:
                 self.logger.info(f'could not contact remote watchtower {watchtower_url}')
 
     async def sync_channel_with_watchtower(self, chan: Channel, watchtower):
@@ -403,10 +428,18 @@ class LNWallet(LNWorker):
         addr = chan.get_funding_address()
         current_ctn = chan.get_oldest_unrevoked_ctn(REMOTE)
         watchtower_ctn = await watchtower.get_ctn(outpoint, addr)
+        # upload the sweeps of several ctns per request. the watchtower
+        # returns the highest ctn it has, so the sweeps of a ctn must
+        # not be split across requests
+        sweeps = []
         for ctn in range(watchtower_ctn + 1, current_ctn):
             sweeptxs = chan.create_sweeptxs(ctn)
-            for tx in sweeptxs:
-                await watchtower.add_sweep_tx(outpoint, ctn, tx.inputs()[0].prevout.to_str(), tx.serialize())
+            sweeps.extend((ctn, tx.inputs()[0].prevout.to_str(), tx.serialize()) for tx in sweeptxs)
+            if len(sweeps) >= WATCHTOWER_UPLOAD_BATCH_SIZE:
+                await watchtower.add_sweep_txs(outpoint, sweeps)
+                sweeps = []
+        if sweeps:
+            await watchtower.add_sweep_txs(outpoint, sweeps)
 
     def start_network(self, network: 'Network'):
         assert network
@@ -450,6 +483,7 @@ class LNWallet(LNWorker):
     def payment_completed(self, chan: Channel, direction: Direction,
                           htlc: UpdateAddHtlc):
         chan_id = chan.channel_id
+        self._add_htlc_to_ledger(chan_id, htlc, direction)
         preimage = self.get_preimage(htlc.payment_hash)
         timestamp = int(time.time())
         self.network.trigger_callback('ln_payment_completed', timestamp, direction, htlc, preimage, chan_id)
@@ -502,86 +536,181 @@ class LNWallet(LNWorker):
             out.append(item)
         return out
 
-    def get_history(self):
-        out = []
-        for key, plist in self.get_payments().items():
-            plist = list(filter(lambda x: x[3] == 'settled', plist))
-            if len(plist) == 0:
-                continue
-            elif len(plist) == 1:
-                chan_id, htlc, _direction, status = plist[0]
-                direction = 'sent' if _direction == SENT else 'received'
-                amount_msat = int(_direction) * htlc.amount_msat
-                timestamp = htlc.timestamp
-                label = self.wallet.get_label(key)
-                if _direction == SENT:
-                    try:
-                        inv = self.get_payment_info(bfh(key))
-                        fee_msat = - inv.amount*1000 - amount_msat if inv.amount else None
-                    except UnknownPaymentHash:
-                        fee_msat = None
-                else:
-                    fee_msat = None
-            else:
-                # assume forwarding
-                direction = 'forwarding'
-                amount_msat = sum([int(_direction) * htlc.amount_msat for chan_id, htlc, _direction, status in plist])
-                status = ''
-                label = _('Forwarding')
-                timestamp = min([htlc.timestamp for chan_id, htlc, _direction, status in plist])
-                fee_msat = None # fixme
-
-            item = {
-                'type': 'payment',
-                'label': label,
-                'timestamp': timestamp or 0,
-                'date': timestamp_to_datetime(timestamp),
-                'direction': direction,
-                'status': status,
-                'amount_msat': amount_msat,
-                'fee_msat': fee_msat,
-                'payment_hash': key,
-            }
-            out.append(item)
-        # add funding events
+    def _init_history_index(self):
+        # settles and channel events may have happened after the ledger
+        # was last written, the channels have them
         with self.lock:
             channels = list(self.channels.values())
+        self.ledger_marks = {bh2u(chan.channel_id): self.ledger_marks.get(bh2u(chan.channel_id), [0, 0])
+                             for chan in channels}
         for chan in channels:
-            item = self.channel_timestamps.get(chan.channel_id.hex())
-            if item is None:
-                continue
-            funding_txid, funding_height, funding_timestamp, closing_txid, closing_height, closing_timestamp = item
-            item = {
-                'channel_id': bh2u(chan.channel_id),
-                'type': 'channel_opening',
-                'label': _('Open channel'),
-                'txid': funding_txid,
-                'amount_msat': chan.balance(LOCAL, ctn=0),
-                'direction': 'received',
-                'timestamp': funding_timestamp,
-                'fee_msat': None,
-            }
-            out.append(item)
-            if not chan.is_closed():
-                continue
-            item = {
-                'channel_id': bh2u(chan.channel_id),
-                'txid': closing_txid,
-                'label': _('Close channel'),
-                'type': 'channel_closure',
-                'amount_msat': -chan.balance_minus_outgoing_htlcs(LOCAL),
-                'direction': 'sent',
-                'timestamp': closing_timestamp,
+            self._add_channel_payments_to_ledger(chan)
+            self._add_channel_events_to_ledger(chan, update_index=False)
+        self.storage.put('lightning_ledger_marks', self.ledger_marks)
+        with self.lock:
+            self._history_index = sorted(self._history_sort_key(key, item) for key, item in self.payment_ledger.items())
+            self._history_balances = []
+            self._update_history_balances(0)
+
+    @staticmethod
+    def _history_sort_key(key: str, item: dict) -> Tuple[float, str]:
+        return (item['timestamp'] or float("inf"), key)
+
+    def _update_history_balances(self, start: int):
+        del self._history_balances[start:]
+        balance_msat = self._history_balances[-1] if self._history_balances else 0
+        for timestamp, key in self._history_index[start:]:
+            balance_msat += self.payment_ledger[key]['amount_msat']
+            self._history_balances.append(balance_msat)
+
+    def _put_ledger_item(self, key: str, item: dict, *, update_index=True):
+        with self.lock:
+            old_item = self.payment_ledger.get(key)
+            if old_item == item:
+                return
+            self.payment_ledger[key] = item
+            self.storage.db.put_ln_ledger_item(key, item)
+            if not update_index:
+                return
+            start = len(self._history_index)
+            if old_item is not None:
+                i = bisect_left(self._history_index, self._history_sort_key(key, old_item))
+                del self._history_index[i]
+                start = i
+            sort_key = self._history_sort_key(key, item)
+            i = bisect_right(self._history_index, sort_key)
+            self._history_index.insert(i, sort_key)
+            # usually the last item, so this is cheap
+            self._update_history_balances(min(start, i))
+
+    def _add_htlc_to_ledger(self, chan_id: bytes, htlc: UpdateAddHtlc, direction: Direction, *, update_index=True):
+        key = bh2u(htlc.payment_hash)
+        with self.lock:
+            item = self.payment_ledger.get(key)
+            htlcs = list(item['htlcs']) if item else []
+            entry = [bh2u(chan_id), htlc.htlc_id, int(direction), htlc.amount_msat, htlc.timestamp]
+            if any(x[0:3] == entry[0:3] for x in htlcs):
+                return
+            htlcs.append(entry)
+            self._put_ledger_item(key, {
+                'type': 'payment',
+                'htlcs': htlcs,
+                'amount_msat': sum(x[2] * x[3] for x in htlcs),
+                'timestamp': min((x[4] for x in htlcs if x[4] is not None), default=None),
+            }, update_index=update_index)
+
+    def _add_channel_payments_to_ledger(self, chan: Channel):
+        """Adds the settled HTLCs of chan from its ledger marks onwards, and
+        moves the marks past the HTLCs that are resolved by now. The HTLCs
+        below the marks are all in the ledger already.
+        """
+        chan_id = bh2u(chan.channel_id)
+        marks = []
+        for subject, mark in zip((LOCAL, REMOTE), self.ledger_marks[chan_id]):
+            log = chan.hm.log[subject]
+            direction = SENT if subject == LOCAL else RECEIVED
+            next_htlc_id = chan.hm.get_next_htlc_id(subject)
+            new_mark = max(mark, next_htlc_id)
+            for htlc_id in range(mark, next_htlc_id):
+                htlc = log['adds'].get(htlc_id)
+                if htlc is None:
+                    continue
+                if htlc_id in log['settles']:
+                    self._add_htlc_to_ledger(chan.channel_id, htlc, direction, update_index=False)
+                elif htlc_id not in log['fails']:
+                    new_mark = min(new_mark, htlc_id)
+            marks.append(new_mark)
+        self.ledger_marks[chan_id] = marks
+
+    def _add_channel_events_to_ledger(self, chan: Channel, *, update_index=True):
+        item = self.channel_timestamps.get(chan.channel_id.hex())
+        if item is None:
+            return
+        funding_txid, funding_height, funding_timestamp, closing_txid, closing_height, closing_timestamp = item
+        self._put_ledger_item('channel_opening' + bh2u(chan.channel_id), {
+            'type': 'channel_opening',
+            'channel_id': bh2u(chan.channel_id),
+            'txid': funding_txid,
+            'amount_msat': chan.balance(LOCAL, ctn=0),
+            'direction': 'received',
+            'timestamp': funding_timestamp,
+        }, update_index=update_index)
+        if not chan.is_closed():
+            return
+        self._put_ledger_item('channel_closure' + bh2u(chan.channel_id), {
+            'type': 'channel_closure',
+            'channel_id': bh2u(chan.channel_id),
+            'txid': closing_txid,
+            'amount_msat': -chan.balance_minus_outgoing_htlcs(LOCAL),
+            'direction': 'sent',
+            'timestamp': closing_timestamp,
+        }, update_index=update_index)
+
+    def _get_history_item(self, key: str, item: dict, balance_msat: int) -> dict:
+        if item['type'] != 'payment':
+            return {
+                'channel_id': item['channel_id'],
+                'type': item['type'],
+                'label': _('Open channel') if item['type'] == 'channel_opening' else _('Close channel'),
+                'txid': item['txid'],
+                'amount_msat': item['amount_msat'],
+                'direction': item['direction'],
+                'timestamp': item['timestamp'],
                 'fee_msat': None,
+                'balance_msat': balance_msat,
             }
-            out.append(item)
-        # sort by timestamp
-        out.sort(key=lambda x: (x.get('timestamp') or float("inf")))
-        balance_msat = 0
-        for item in out:
-            balance_msat += item['amount_msat']
-            item['balance_msat'] = balance_msat
-        return out
+        amount_msat = item['amount_msat']
+        timestamp = item['timestamp']
+        if len(item['htlcs']) == 1:
+            _direction = Direction(item['htlcs'][0][2])
+            direction = 'sent' if _direction == SENT else 'received'
+            status = 'settled'
+            label = self.wallet.get_label(key)
+            if _direction == SENT:
+                try:
+                    inv = self.get_payment_info(bfh(key))
+                    fee_msat = - inv.amount*1000 - amount_msat if inv.amount else None
+                except UnknownPaymentHash:
+                    fee_msat = None
+            else:
+                fee_msat = None
+        else:
+            # assume forwarding
+            direction = 'forwarding'
+            status = ''
+            label = _('Forwarding')
+            fee_msat = None # fixme
+        return {
+            'type': 'payment',
+            'label': label,
+            'timestamp': timestamp or 0,
+            'date': timestamp_to_datetime(timestamp),
+            'direction': direction,
+            'status': status,
+            'amount_msat': amount_msat,
+            'fee_msat': fee_msat,
+            'payment_hash': key,
+            'balance_msat': balance_msat,
+        }
+
+    def iter_history(self, *, after_key=None):
+        """ sorted by timestamp, with running balances. Items are
+        looked up in the history index, and only formatted when
+        they are consumed. """
+        with self.lock:
+            if after_key is None:
+                start = 0
+            else:
+                if after_key not in self.payment_ledger:
+                    raise Exception(f'history item not found: {after_key}')
+                start = bisect_right(self._history_index, self._history_sort_key(after_key, self.payment_ledger[after_key]))
+            index = self._history_index[start:]
+            balances = self._history_balances[start:]
+        for (timestamp, key), balance_msat in zip(index, balances):
+            yield self._get_history_item(key, self.payment_ledger[key], balance_msat)
+
+    def get_history(self, *, limit=None, after_key=None):
+        return list(islice(self.iter_history(after_key=after_key), limit))
 
     def get_and_inc_counter_for_channel_keys(self):
         with self.lock:
@@ -612,7 +741,8 @@ class LNWallet(LNWorker):
             raise Exception("Tried to save channel with next_point == current_point, this should not happen")
         with self.lock:
             self.channels[chan.channel_id] = chan
-            self.save_channels()
+        # only this channel is written, to the storage journal
+        self.storage.write_channel(chan.serialize())
         self.network.trigger_callback('channel', chan)
 
     def save_channels(self):
@@ -670,6 +800,7 @@ class LNWallet(LNWorker):
         # save timestamp regardless of state, so that funding tx is returned in get_history
         self.channel_timestamps[bh2u(chan.channel_id)] = chan.funding_outpoint.txid, funding_height.height, funding_height.timestamp, None, None, None
         self.storage.put('lightning_channel_timestamps', self.channel_timestamps)
+        self._add_channel_events_to_ledger(chan)
 
         if chan.get_state() == channel_states.OPEN and self.should_channel_be_closed_due_to_expiring_htlcs(chan):
             self.logger.info(f"force-closing due to expiring htlcs")
@@ -722,6 +853,7 @@ class LNWallet(LNWorker):
 
         if chan.get_state() < channel_states.CLOSED:
             chan.set_state(channel_states.CLOSED)
+        self._add_channel_events_to_ledger(chan)
 
         if chan.get_state() == channel_states.CLOSED and not keep_watching:
             chan.set_state(channel_states.REDEEMED)
@@ -757,13 +889,15 @@ class LNWallet(LNWorker):
         name = sweep_info.name
         prev_txid, prev_index = prevout.split(':')
         broadcast = True
+        local_height = self.network.get_local_height()
+        wake_up_height = local_height
         if sweep_info.cltv_expiry:
-            local_height = self.network.get_local_height()
             remaining = sweep_info.cltv_expiry - local_height
             if remaining > 0:
                 self.logger.info('waiting for {}: CLTV ({} > {}), prevout {}'
                                  .format(name, local_height, sweep_info.cltv_expiry, prevout))
                 broadcast = False
+                wake_up_height = max(wake_up_height, sweep_info.cltv_expiry)
         if sweep_info.csv_delay:
             prev_height = self.lnwatcher.get_tx_height(prev_txid)
             remaining = sweep_info.csv_delay - prev_height.conf
@@ -771,6 +905,9 @@ class LNWallet(LNWorker):
                 self.logger.info('waiting for {}: CSV ({} >= {}), prevout: {}'
                                  .format(name, prev_height.conf, sweep_info.csv_delay, prevout))
                 broadcast = False
+                if prev_height.conf > 0:
+                    # otherwise the lnwatcher looks again when prev_txid gets mined
+                    wake_up_height = max(wake_up_height, local_height + remaining)
         tx = sweep_info.gen_tx()
         if tx is None:
             self.logger.info(f'{name} could not claim output: {prevout}, dust')
@@ -780,9 +917,13 @@ class LNWallet(LNWorker):
                 await self.network.broadcast_transaction(tx)
             except Exception as e:
                 self.logger.info(f'could NOT publish {name} for prevout: {prevout}, {str(e)}')
+                # try again at the next block
+                self.lnwatcher.schedule_check(prev_txid, local_height + 1)
             else:
                 self.logger.info(f'success: broadcasting {name} for prevout: {prevout}')
         else:
+            if wake_up_height > local_height:
+                self.lnwatcher.schedule_check(prev_txid, wake_up_height)
             # it's OK to add local transaction, the fee will be recomputed
             try:
                 self.wallet.add_future_tx(tx, remaining)
@@ -922,11 +1063,21 @@ class LNWallet(LNWorker):
         success = False
         for i in range(attempts):
             try:
-                route = await self._create_route_from_invoice(decoded_invoice=lnaddr)
+                routes = await self._create_routes_from_invoice(decoded_invoice=lnaddr,
+                                                                num_routes=PAYMENT_NUM_CANDIDATE_ROUTES)
             except NoPathFound as e:
                 log.append(PaymentAttemptLog(success=False, exception=e))
                 break
             self.network.trigger_callback('invoice_status', key, PR_INFLIGHT)
+            # the first attempt goes straight along the best route,
+            # probing costs a round trip that is only worth it after a failure
+            if i > 0 and len(routes) > 1:
+                route, probe_logs = await self._probe_routes(routes, lnaddr)
+                log.extend(probe_logs)
+                if route is None:
+                    continue
+            else:
+                route = routes[0]
             payment_attempt_log = await self._pay_to_route(route, lnaddr)
             log.append(payment_attempt_log)
             success = payment_attempt_log.success
@@ -950,26 +1101,96 @@ class LNWallet(LNWorker):
         if success:
             failure_log = None
         else:
-            failure_msg, sender_idx = chan.decode_onion_error(reason, route, htlc.htlc_id)
-            blacklist = self.handle_error_code_from_failed_htlc(failure_msg, sender_idx, route, peer)
-            if blacklist:
-                # blacklist channel after reporter node
-                # TODO this should depend on the error (even more granularity)
-                # also, we need finer blacklisting (directed edges; nodes)
-                try:
-                    short_chan_id = route[sender_idx + 1].short_channel_id
-                except IndexError:
-                    self.logger.info("payment destination reported error")
-                else:
-                    self.network.path_finder.add_to_blacklist(short_chan_id)
-            failure_log = PaymentAttemptFailureDetails(sender_idx=sender_idx,
-                                                       failure_msg=failure_msg,
-                                                       is_blacklisted=blacklist)
+            failure_log = self._handle_failed_htlc(route, chan, htlc, reason, peer)
         return PaymentAttemptLog(route=route,
                                  success=success,
                                  preimage=preimage,
                                  failure_details=failure_log)
 
+    def _handle_failed_htlc(self, route: LNPaymentRoute, chan: Channel, htlc: UpdateAddHtlc,
+                            reason: bytes, peer: Peer) -> PaymentAttemptFailureDetails:
+        failure_msg, sender_idx = chan.decode_onion_error(reason, route, htlc.htlc_id)
+        blacklist = self.handle_error_code_from_failed_htlc(failure_msg, sender_idx, route, peer)
+        if blacklist:
+            # blacklist channel after reporter node
+            # TODO this should depend on the error (even more granularity)
+            # also, we need finer blacklisting (directed edges; nodes)
+            try:
+                short_chan_id = route[sender_idx + 1].short_channel_id
+            except IndexError:
+                self.logger.info("payment destination reported error")
+            else:
+                self.network.path_finder.add_to_blacklist(short_chan_id)
+        return PaymentAttemptFailureDetails(sender_idx=sender_idx,
+                                            failure_msg=failure_msg,
+                                            is_blacklisted=blacklist)
+
+    async def _probe_routes(self, routes: Sequence[LNPaymentRoute],
+                            lnaddr: LnAddr) -> Tuple[Optional[LNPaymentRoute], List[PaymentAttemptLog]]:
+        """Probe routes concurrently, and return the first one that reaches the
+        destination, with the logs of the probes that failed.
+        Sending the payment itself along several routes at once could get it
+        paid several times, so probes use random payment hashes, which the
+        destination rejects. Routes whose first channel cannot hold the probes
+        and the payment are skipped. The remaining probes are awaited before
+        returning, so that their failures are taken into account.
+        """
+        amount_msat = int(lnaddr.amount * COIN * 1000)
+        locked_msat = defaultdict(int)  # short_channel_id -> amount of the probes
+        probes = []
+        for route in routes:
+            first_hop_msat = amount_msat
+            for edge in reversed(route[1:]):
+                first_hop_msat += edge.fee_for_edge(first_hop_msat)
+            chan = self.get_channel_by_short_id(route[0].short_channel_id)
+            if chan and not chan.can_pay(locked_msat[chan.short_channel_id] + 2 * first_hop_msat):
+                continue
+            if chan:
+                locked_msat[chan.short_channel_id] += first_hop_msat
+            probes.append(asyncio.ensure_future(self._probe_route(route, lnaddr)))
+        found_route = None
+        try:
+            for probe in asyncio.as_completed(probes):
+                reached_destination, payment_attempt_log = await probe
+                if reached_destination:
+                    found_route = payment_attempt_log.route
+                    break
+        finally:
+            # their htlcs are in flight already, cancelling would not release them
+            results = await asyncio.gather(*probes, return_exceptions=True)
+        logs = [payment_attempt_log for reached_destination, payment_attempt_log
+                in filter(lambda r: not isinstance(r, BaseException), results)
+                if payment_attempt_log.route is not found_route]
+        return found_route, logs
+
+    async def _probe_route(self, route: LNPaymentRoute, lnaddr: LnAddr) -> Tuple[bool, PaymentAttemptLog]:
+        probe_hash = os.urandom(32)
+        chan = self.get_channel_by_short_id(route[0].short_channel_id)
+        peer = self.peers.get(route[0].node_id)
+        future = self.pending_payments[probe_hash]
+        htlc = None
+        try:
+            if not chan or not peer:
+                raise PaymentFailure('first hop of route not available')
+            htlc = await peer.pay(route, chan, int(lnaddr.amount * COIN * 1000), probe_hash,
+                                  lnaddr.get_min_final_cltv_expiry())
+            # shielded, so that the future is still there when the htlc gets resolved
+            success, preimage, reason = await asyncio.wait_for(asyncio.shield(future), PAYMENT_PROBE_TIMEOUT)
+        except BaseException as e:
+            if htlc is None or future.done():
+                self.pending_payments.pop(probe_hash, None)
+            else:
+                # the htlc is still in flight
+                future.add_done_callback(lambda f: self.pending_payments.pop(probe_hash, None))
+            if isinstance(e, asyncio.CancelledError) or not isinstance(e, Exception):
+                raise
+            return False, PaymentAttemptLog(route=route, success=False, exception=e)
+        self.pending_payments.pop(probe_hash, None)
+        assert not success
+        failure_log = self._handle_failed_htlc(route, chan, htlc, reason, peer)
+        reached_destination = failure_log.sender_idx == len(route) - 1
+        return reached_destination, PaymentAttemptLog(route=route, success=False, failure_details=failure_log)
+
     def handle_error_code_from_failed_htlc(self, failure_msg, sender_idx, route, peer):
         code, data = failure_msg.code, failure_msg.data
         self.logger.info(f"UPDATE_FAIL_HTLC {repr(code)} {data}")
@@ -1031,62 +1252,71 @@ class LNWallet(LNWorker):
         return addr
 
     async def _create_route_from_invoice(self, decoded_invoice) -> LNPaymentRoute:
+        routes = await self._create_routes_from_invoice(decoded_invoice)
+        return routes[0]
+
+    async def _create_routes_from_invoice(self, decoded_invoice, *, num_routes: int = 1) -> List[LNPaymentRoute]:
+        """Returns up to num_routes routes, the best first, or raises NoPathFound."""
         amount_msat = int(decoded_invoice.amount * COIN * 1000)
         invoice_pubkey = decoded_invoice.pubkey.serialize()
         # use 'r' field from invoice
-        route = None  # type: Optional[LNPaymentRoute]
+        routes = []  # type: List[LNPaymentRoute]
         # only want 'r' tags
         r_tags = list(filter(lambda x: x[0] == 'r', decoded_invoice.tags))
         # strip the tag type, it's implicitly 'r' now
         r_tags = list(map(lambda x: x[1], r_tags))
-        # if there are multiple hints, we will use the first one that works,
+        # if there are multiple hints, we will use the first ones that work,
         # from a random permutation
         random.shuffle(r_tags)
         with self.lock:
             channels = list(self.channels.values())
         for private_route in r_tags:
+            if len(routes) >= num_routes:
+                break
             if len(private_route) == 0:
                 continue
             if len(private_route) > NUM_MAX_EDGES_IN_PAYMENT_PATH:
                 continue
             border_node_pubkey = private_route[0][0]
-            path = self.network.path_finder.find_path_for_payment(self.node_keypair.pubkey, border_node_pubkey, amount_msat, channels)
-            if not path:
-                continue
-            route = self.network.path_finder.create_route_from_path(path, self.node_keypair.pubkey)
-            # we need to shift the node pubkey by one towards the destination:
-            private_route_nodes = [edge[0] for edge in private_route][1:] + [invoice_pubkey]
-            private_route_rest = [edge[1:] for edge in private_route]
-            prev_node_id = border_node_pubkey
-            for node_pubkey, edge_rest in zip(private_route_nodes, private_route_rest):
-                short_channel_id, fee_base_msat, fee_proportional_millionths, cltv_expiry_delta = edge_rest
-                short_channel_id = ShortChannelID(short_channel_id)
-                # if we have a routing policy for this edge in the db, that takes precedence,
-                # as it is likely from a previous failure
-                channel_policy = self.channel_db.get_routing_policy_for_channel(prev_node_id, short_channel_id)
-                if channel_policy:
-                    fee_base_msat = channel_policy.fee_base_msat
-                    fee_proportional_millionths = channel_policy.fee_proportional_millionths
-                    cltv_expiry_delta = channel_policy.cltv_expiry_delta
-                route.append(RouteEdge(node_pubkey, short_channel_id, fee_base_msat, fee_proportional_millionths,
-                                       cltv_expiry_delta))
-                prev_node_id = node_pubkey
-            # test sanity
-            if not is_route_sane_to_use(route, amount_msat, decoded_invoice.get_min_final_cltv_expiry()):
-                self.logger.info(f"rejecting insane route {route}")
-                route = None
-                continue
-            break
+            paths = self.network.path_finder.find_paths_for_payment(self.node_keypair.pubkey, border_node_pubkey,
+                                                                    amount_msat, channels, num_routes - len(routes))
+            for path in paths:
+                route = self.network.path_finder.create_route_from_path(path, self.node_keypair.pubkey)
+                # we need to shift the node pubkey by one towards the destination:
+                private_route_nodes = [edge[0] for edge in private_route][1:] + [invoice_pubkey]
+                private_route_rest = [edge[1:] for edge in private_route]
+                prev_node_id = border_node_pubkey
+                for node_pubkey, edge_rest in zip(private_route_nodes, private_route_rest):
+                    short_channel_id, fee_base_msat, fee_proportional_millionths, cltv_expiry_delta = edge_rest
+                    short_channel_id = ShortChannelID(short_channel_id)
+                    # if we have a routing policy for this edge in the db, that takes precedence,
+                    # as it is likely from a previous failure
+                    channel_policy = self.channel_db.get_routing_policy_for_channel(prev_node_id, short_channel_id)
+                    if channel_policy:
+                        fee_base_msat = channel_policy.fee_base_msat
+                        fee_proportional_millionths = channel_policy.fee_proportional_millionths
+                        cltv_expiry_delta = channel_policy.cltv_expiry_delta
+                    route.append(RouteEdge(node_pubkey, short_channel_id, fee_base_msat, fee_proportional_millionths,
+                                           cltv_expiry_delta))
+                    prev_node_id = node_pubkey
+                # test sanity
+                if not is_route_sane_to_use(route, amount_msat, decoded_invoice.get_min_final_cltv_expiry()):
+                    self.logger.info(f"rejecting insane route {route}")
+                    continue
+                routes.append(route)
         # if could not find route using any hint; try without hint now
-        if route is None:
-            path = self.network.path_finder.find_path_for_payment(self.node_keypair.pubkey, invoice_pubkey, amount_msat, channels)
-            if not path:
-                raise NoPathFound()
-            route = self.network.path_finder.create_route_from_path(path, self.node_keypair.pubkey)
-            if not is_route_sane_to_use(route, amount_msat, decoded_invoice.get_min_final_cltv_expiry()):
-                self.logger.info(f"rejecting insane route {route}")
+        if not routes:
+            paths = self.network.path_finder.find_paths_for_payment(self.node_keypair.pubkey, invoice_pubkey,
+                                                                    amount_msat, channels, num_routes)
+            for path in paths:
+                route = self.network.path_finder.create_route_from_path(path, self.node_keypair.pubkey)
+                if not is_route_sane_to_use(route, amount_msat, decoded_invoice.get_min_final_cltv_expiry()):
+                    self.logger.info(f"rejecting insane route {route}")
+                    continue
+                routes.append(route)
+            if not routes:
                 raise NoPathFound()
-        return route
+        return routes
 
     def add_request(self, amount_sat, message, expiry):
         coro = self._add_request_coro(amount_sat, message, expiry)
@@ -26,7 +26,7 @@ import queue
 import os
 import random
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import threading
 import socket
 import json
@@ -39,6 +39,7 @@ from concurrent import futures
 
 import aiorpcx
 from aiorpcx import TaskGroup
+import aiohttp
 from aiohttp import ClientResponse
 
 from . import util
@@ -76,6 +77,8 @@ NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
 NUM_TARGET_CONNECTED_SERVERS = 10
 NUM_RECENT_SERVERS = 20
+HTTP_MAX_CONNECTIONS_PER_HOST = 10
+RAW_TX_CACHE_SIZE = 1000
 
 
 def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dict]:
@@ -301,6 +304,13 @@ class Network(Logger):
         self.connecting = set()
         self.server_queue = None
         self.proxy = None
+        # shared HTTP session, (re)created lazily with the current proxy
+        self._http_session = None  # type: Optional[aiohttp.ClientSession]
+        self._http_session_proxy = None  # type: Optional[dict]
+        # raw transactions fetched by wallets and watchers. A txid commits
+        # to the tx, so entries do not need to be invalidated.
+        self._raw_tx_cache = OrderedDict()  # type: Dict[str, str]  # LRU, txid -> raw tx
+        self._raw_tx_requests = {}  # type: Dict[Tuple[Interface, str, Optional[float]], asyncio.Future]  # (iface, txid, timeout) -> pending request
 
         # Dump network messages (all interfaces).  Set at runtime from the console.
         self.debug = False
@@ -695,6 +705,10 @@ class Network(Logger):
                     self.interfaces.pop(interface.server)
             if interface.server == self.default_server:
                 self.interface = None
+            # do not keep requests on the closed interface around
+            for key, fut in list(self._raw_tx_requests.items()):
+                if key[0] is interface:
+                    fut.cancel()
             await interface.close()
 
     @with_recent_servers_lock
@@ -1005,7 +1019,30 @@ class Network(Logger):
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
-        iface = self.interface
+        raw = self._raw_tx_cache.get(tx_hash)
+        if raw is not None:
+            self._raw_tx_cache.move_to_end(tx_hash)
+            return raw
+        # concurrent requests for the same tx share a single request.
+        # it is keyed on the interface, so that a retry after the
+        # interface went away (see best_effort_reliable) makes a new one
+        key = (self.interface, tx_hash, timeout)
+        fut = self._raw_tx_requests.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._request_transaction(self.interface, tx_hash, timeout=timeout))
+            self._raw_tx_requests[key] = fut
+            def on_done(fut):
+                if self._raw_tx_requests.get(key) is fut:
+                    del self._raw_tx_requests[key]
+                if not fut.cancelled():
+                    fut.exception()  # mark as retrieved, waiters re-raise it
+            fut.add_done_callback(on_done)
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError as e:
+            raise RequestTimedOut(f'request timed out: get_transaction {tx_hash}') from e
+
+    async def _request_transaction(self, iface: Interface, tx_hash: str, *, timeout=None) -> str:
         raw = await iface.session.send_request('blockchain.transaction.get', [tx_hash], timeout=timeout)
         # validate response
         tx = Transaction(raw)
@@ -1017,6 +1054,9 @@ class Network(Logger):
         if tx.txid() != tx_hash:
             self.logger.warning(f"received tx does not match expected txid {tx_hash} (got {tx.txid()}). from {str(iface)}")
             raise RequestCorrupted()  # TODO ban server?
+        self._raw_tx_cache[tx_hash] = raw
+        while len(self._raw_tx_cache) > RAW_TX_CACHE_SIZE:
+            self._raw_tx_cache.popitem(last=False)
         return raw
 
     @best_effort_reliable
@@ -1033,6 +1073,18 @@ class Network(Logger):
             raise Exception(f"{repr(sh)} is not a scripthash")
         return await self.interface.session.send_request('blockchain.scripthash.listunspent', [sh])
 
+    @best_effort_reliable
+    @catch_server_exceptions
+    async def listunspent_for_scripthashes(self, shs: Sequence[str]) -> List[List[dict]]:
+        """Like listunspent_for_scripthash, for several scripthashes
+        in a single JSON-RPC batch.
+        """
+        for sh in shs:
+            if not is_hash256_str(sh):
+                raise Exception(f"{repr(sh)} is not a scripthash")
+        return await self.interface.session.send_request_batch(
+            'blockchain.scripthash.listunspent', [[sh] for sh in shs])
+
     @best_effort_reliable
     @catch_server_exceptions
     async def get_balance_for_scripthash(self, sh: str) -> dict:
@@ -1158,6 +1210,8 @@ class Network(Logger):
         self.interfaces = {}  # type: Dict[str, Interface]
         self.connecting.clear()
         self.server_queue = None
+        # the proxy might change before we are restarted
+        await self._close_http_session()
         if not full_shutdown:
             self.trigger_callback('network_updated')
 
@@ -1225,6 +1279,31 @@ class Network(Logger):
                     raise
             await asyncio.sleep(0.1)
 
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """Returns the HTTP session shared by all requests sent through the network.
+        Connections are kept alive and reused; the session is closed in _stop,
+        and replaced if it was made with another proxy.
+        Must be called from the network thread.
+        """
+        if self.main_taskgroup is None:
+            # stopped, or being restarted with new parameters: the proxy is not known
+            raise aiohttp.ClientConnectionError('network is not running')
+        session = self._http_session
+        if session is not None and not session.closed and self._http_session_proxy == self.proxy:
+            return session
+        if session is not None:
+            asyncio.ensure_future(session.close())
+        self._http_session = make_aiohttp_session(self.proxy,
+                                                  limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST)
+        self._http_session_proxy = self.proxy
+        return self._http_session
+
+    async def _close_http_session(self):
+        session, self._http_session = self._http_session, None
+        self._http_session_proxy = None
+        if session is not None:
+            await session.close()
+
     @classmethod
     async def _send_http_on_proxy(cls, method: str, url: str, params: str = None,
                                   body: bytes = None, json: dict = None, headers=None,
@@ -1236,23 +1315,31 @@ class Network(Logger):
             headers = {}
         if on_finish is None:
             on_finish = default_on_finish
-        network = cls.get_instance()
-        proxy = network.proxy if network else None
-        async with make_aiohttp_session(proxy, timeout=timeout) as session:
+        kwargs = {'headers': headers}
+        if timeout is not None:  # otherwise the session default applies
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout) if isinstance(timeout, (int, float)) else timeout
+
+        async def send(session: aiohttp.ClientSession):
             if method == 'get':
-                async with session.get(url, params=params, headers=headers) as resp:
+                async with session.get(url, params=params, **kwargs) as resp:
                     return await on_finish(resp)
             elif method == 'post':
                 assert body is not None or json is not None, 'body or json must be supplied if method is post'
                 if body is not None:
-                    async with session.post(url, data=body, headers=headers) as resp:
+                    async with session.post(url, data=body, **kwargs) as resp:
                         return await on_finish(resp)
                 elif json is not None:
-                    async with session.post(url, json=json, headers=headers) as resp:
+                    async with session.post(url, json=json, **kwargs) as resp:
                         return await on_finish(resp)
             else:
                 assert False
 
+        network = cls.get_instance()
+        if network:
+            return await send(network._get_http_session())
+        async with make_aiohttp_session(None, timeout=timeout) as session:
+            return await send(session)
+
     @classmethod
     def send_http_on_proxy(cls, method, url, **kwargs):
         network = cls.get_instance()
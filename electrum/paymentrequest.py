@@ -39,7 +39,7 @@ except ImportError:
     sys.exit("Error: could not find paymentrequest_pb2.py. Create it with 'protoc --proto_path=electrum/ --python_out=electrum/ electrum/paymentrequest.proto'")
 
 from . import bitcoin, ecc, util, transaction, x509, rsakey
-from .util import bh2u, bfh, export_meta, import_meta, make_aiohttp_session
+from .util import bh2u, bfh, export_meta, import_meta
 from .util import PR_UNPAID, PR_EXPIRED, PR_PAID, PR_UNKNOWN, PR_INFLIGHT
 from .crypto import sha256
 from .bitcoin import address_to_script
@@ -71,21 +71,22 @@ async def get_payment_request(url: str) -> 'PaymentRequest':
     error = None
     if u.scheme in ('http', 'https'):
         resp_content = None
+        async def on_finish(response: aiohttp.ClientResponse):
+            nonlocal resp_content
+            resp_content = await response.read()
+            response.raise_for_status()
+            return response.headers.get("Content-Type")
         try:
-            proxy = Network.get_instance().proxy
-            async with make_aiohttp_session(proxy, headers=REQUEST_HEADERS) as session:
-                async with session.get(url) as response:
-                    resp_content = await response.read()
-                    response.raise_for_status()
-                    # Guard against `bitcoin:`-URIs with invalid payment request URLs
-                    if "Content-Type" not in response.headers \
-                    or response.headers["Content-Type"] != "application/bitcoin-paymentrequest":
-                        data = None
-                        error = "payment URL not pointing to a payment request handling server"
-                    else:
-                        data = resp_content
-                    data_len = len(data) if data is not None else None
-                    _logger.info(f'fetched payment request {url} {data_len}')
+            content_type = await Network._send_http_on_proxy('get', url, headers=REQUEST_HEADERS,
+                                                              on_finish=on_finish)
+            # Guard against `bitcoin:`-URIs with invalid payment request URLs
+            if content_type != "application/bitcoin-paymentrequest":
+                data = None
+                error = "payment URL not pointing to a payment request handling server"
+            else:
+                data = resp_content
+            data_len = len(data) if data is not None else None
+            _logger.info(f'fetched payment request {url} {data_len}')
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             error = f"Error while contacting payment URL: {url}.\nerror type: {type(e)}"
             if isinstance(e, aiohttp.ClientResponseError):
@@ -284,19 +285,20 @@ class PaymentRequest:
         pm = paymnt.SerializeToString()
         payurl = urllib.parse.urlparse(pay_det.payment_url)
         resp_content = None
+        async def on_finish(response: aiohttp.ClientResponse):
+            nonlocal resp_content
+            resp_content = await response.read()
+            response.raise_for_status()
         try:
-            proxy = Network.get_instance().proxy
-            async with make_aiohttp_session(proxy, headers=ACK_HEADERS) as session:
-                async with session.post(payurl.geturl(), data=pm) as response:
-                    resp_content = await response.read()
-                    response.raise_for_status()
-                    try:
-                        paymntack = pb2.PaymentACK()
-                        paymntack.ParseFromString(resp_content)
-                    except Exception:
-                        return False, "PaymentACK could not be processed. Payment was sent; please manually verify that payment was received."
-                    print(f"PaymentACK message received: {paymntack.memo}")
-                    return True, paymntack.memo
+            await Network._send_http_on_proxy('post', payurl.geturl(), body=pm, headers=ACK_HEADERS,
+                                              on_finish=on_finish)
+            try:
+                paymntack = pb2.PaymentACK()
+                paymntack.ParseFromString(resp_content)
+            except Exception:
+                return False, "PaymentACK could not be processed. Payment was sent; please manually verify that payment was received."
+            print(f"PaymentACK message received: {paymntack.memo}")
+            return True, paymntack.memo
         except aiohttp.ClientError as e:
             error = f"Payment Message/PaymentACK Failed:\nerror type: {type(e)}"
             if isinstance(e, aiohttp.ClientResponseError):
@@ -10,7 +10,7 @@ import base64
 from electrum.plugin import BasePlugin, hook
 from electrum.crypto import aes_encrypt_with_iv, aes_decrypt_with_iv
 from electrum.i18n import _
-from electrum.util import log_exceptions, ignore_exceptions, make_aiohttp_session
+from electrum.util import log_exceptions, ignore_exceptions
 from electrum.network import Network
 
 
@@ -79,22 +79,18 @@ class LabelsPlugin(BasePlugin):
 
     async def do_get(self, url = "/labels"):
         url = 'https://' + self.target_host + url
-        network = Network.get_instance()
-        proxy = network.proxy if network else None
-        async with make_aiohttp_session(proxy) as session:
-            async with session.get(url) as result:
-                return await result.json()
+        async def on_finish(result):
+            return await result.json()
+        return await Network._send_http_on_proxy('get', url, on_finish=on_finish)
 
     async def do_post(self, url = "/labels", data=None):
         url = 'https://' + self.target_host + url
-        network = Network.get_instance()
-        proxy = network.proxy if network else None
-        async with make_aiohttp_session(proxy) as session:
-            async with session.post(url, json=data) as result:
-                try:
-                    return await result.json()
-                except Exception as e:
-                    raise Exception('Could not decode: ' + await result.text()) from e
+        async def on_finish(result):
+            try:
+                return await result.json()
+            except Exception as e:
+                raise Exception('Could not decode: ' + await result.text()) from e
+        return await Network._send_http_on_proxy('post', url, json=data, on_finish=on_finish)
 
     async def push_thread(self, wallet):
         wallet_data = self.wallets.get(wallet, None)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#
+# Replay a recorded gossip dump into a scratch ChannelDB and report throughput.
+#
+# The dump is a sequence of raw gossip messages (channel_announcement,
+# node_announcement, channel_update), each prefixed with its length as a
+# 2-byte big-endian integer, i.e. the decrypted BOLT-8 framing.
+#
+# usage: bench_gossip.py <dump file> [--testnet] [--no-verify]
+
+import sys
+import time
+import asyncio
+import tempfile
+
+from electrum import constants
+from electrum.simple_config import SimpleConfig
+from electrum.util import create_and_start_event_loop, chunks
+from electrum.channel_db import ChannelDB
+from electrum.lnmsg import decode_msg
+
+
+def read_dump(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    msgs = []
+    offset = 0
+    while offset + 2 <= len(data):
+        msglen = int.from_bytes(data[offset:offset+2], 'big')
+        msgs.append(data[offset+2:offset+2+msglen])
+        offset += 2 + msglen
+    return msgs
+
+
+class FakeNetwork:
+    interface = None
+
+    def __init__(self, config, asyncio_loop):
+        self.config = config
+        self.asyncio_loop = asyncio_loop
+
+    def trigger_callback(self, *args):
+        pass
+
+    def register_callback(self, *args):
+        pass
+
+
+def main():
+    args = sys.argv[1:]
+    if not args:
+        print("usage: bench_gossip.py <dump file> [--testnet] [--no-verify]")
+        sys.exit(1)
+    if '--testnet' in args:
+        constants.set_testnet()
+    verify = '--no-verify' not in args
+    raw_msgs = read_dump(args[0])
+
+    loop, stopping_fut, loop_thread = create_and_start_event_loop()
+    config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix='electrum-bench-gossip-')})
+    channel_db = ChannelDB(FakeNetwork(config, loop))
+    try:
+        t0 = time.time()
+        chan_anns, node_anns, chan_upds = [], [], []
+        for raw in raw_msgs:
+            name, payload = decode_msg(raw)
+            payload['raw'] = raw
+            if name == 'channel_announcement':
+                chan_anns.append(payload)
+            elif name == 'node_announcement':
+                node_anns.append(payload)
+            elif name == 'channel_update':
+                chan_upds.append(payload)
+        t1 = time.time()
+        # same chunk sizes as Peer.process_gossip
+        for chunk in chunks(chan_anns, 300):
+            channel_db.add_channel_announcement(chunk)
+        for chunk in chunks(node_anns, 100):
+            channel_db.add_node_announcement(chunk)
+        for chunk in chunks(chan_upds, 1000):
+            channel_db.add_channel_updates(chunk, verify=verify)
+        t2 = time.time()
+        # wait until the sql thread has worked through the backlog
+        async def flush():
+            fut = channel_db.save_policies([])
+            while not fut.done():
+                await asyncio.sleep(0.01)
+        asyncio.run_coroutine_threadsafe(flush(), loop).result(timeout=600)
+        t3 = time.time()
+    finally:
+        loop.call_soon_threadsafe(stopping_fut.set_result, 1)
+        loop_thread.join(timeout=5)
+
+    n = len(raw_msgs)
+    print(f"messages: {n} ({len(chan_anns)} chan_ann, {len(node_anns)} node_ann, {len(chan_upds)} chan_upd)")
+    print(f"decode:  {t1 - t0:.3f} s")
+    print(f"ingest:  {t2 - t1:.3f} s")
+    print(f"db sync: {t3 - t2:.3f} s")
+    print(f"total:   {n / max(t3 - t0, 1e-9):.0f} msg/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Measure gossip signature verification: signatures per second, and how long
+# the event loop is blocked, verifying serially on the loop thread versus
+# in the gossip verification thread pool.
+#
+# usage: bench_gossip_verify.py [num_channel_announcements]
+
+import sys
+import time
+import asyncio
+
+from electrum import ecc
+from electrum.ecc_fast import is_using_fast_ecc
+from electrum.crypto import sha256d
+from electrum.lnmsg import encode_msg, decode_msg
+from electrum.lnpeer import Peer, verify_gossip
+
+
+def make_channel_announcements(n):
+    keys = [ecc.ECPrivkey(bytes([i + 1]) * 32) for i in range(4)]
+    node_ids = sorted(key.get_public_key_bytes(compressed=True) for key in keys[:2])
+    node_keys = sorted(keys[:2], key=lambda key: key.get_public_key_bytes(compressed=True))
+    payloads = []
+    for i in range(n):
+        fields = dict(len=0, features=b'', chain_hash=bytes(32), short_channel_id=i.to_bytes(8, 'big'),
+                      node_id_1=node_ids[0], node_id_2=node_ids[1],
+                      bitcoin_key_1=keys[2].get_public_key_bytes(compressed=True),
+                      bitcoin_key_2=keys[3].get_public_key_bytes(compressed=True))
+        unsigned = encode_msg('channel_announcement', node_signature_1=bytes(64), node_signature_2=bytes(64),
+                              bitcoin_signature_1=bytes(64), bitcoin_signature_2=bytes(64), **fields)
+        h = sha256d(unsigned[2+256:])
+        sigs = [key.sign(h) for key in node_keys + keys[2:]]
+        raw = encode_msg('channel_announcement', node_signature_1=sigs[0], node_signature_2=sigs[1],
+                         bitcoin_signature_1=sigs[2], bitcoin_signature_2=sigs[3], **fields)
+        name, payload = decode_msg(raw)
+        payload['raw'] = raw
+        payloads.append(payload)
+    return payloads
+
+
+async def measure(verify):
+    """Run verify(), returning its duration and the longest event loop stall."""
+    max_stall = 0
+    done = False
+
+    async def ticker():
+        nonlocal max_stall
+        while not done:
+            t = time.time()
+            await asyncio.sleep(0.001)
+            max_stall = max(max_stall, time.time() - t)
+
+    ticker_task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0.01)
+    t0 = time.time()
+    await verify()
+    duration = time.time() - t0
+    done = True
+    await ticker_task
+    return duration, max_stall
+
+
+def main():
+    args = [int(x) for x in sys.argv[1:]]
+    num_anns = args[0] if len(args) > 0 else 1000
+    print(f"libsecp256k1: {is_using_fast_ecc()}")
+    payloads = make_channel_announcements(num_anns)
+    num_sigs = 4 * num_anns
+
+    async def serial():
+        # what Peer.process_gossip used to do
+        for payload in payloads:
+            h = sha256d(payload['raw'][2+256:])
+            for i in (1, 2):
+                assert ecc.verify_signature(payload[f'node_id_{i}'], payload[f'node_signature_{i}'], h)
+                assert ecc.verify_signature(payload[f'bitcoin_key_{i}'], payload[f'bitcoin_signature_{i}'], h)
+
+    async def batched():
+        Peer.verify_channel_announcements(payloads)
+
+    async def pool():
+        await verify_gossip(Peer.verify_channel_announcements, payloads)
+
+    loop = asyncio.get_event_loop()
+    for name, verify in (('serial', serial), ('batched', batched), ('pool', pool)):
+        duration, max_stall = loop.run_until_complete(measure(verify))
+        print(f"{name:8} {num_sigs / duration:8.0f} sigs/s, event loop blocked up to {1000 * max_stall:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#
+# Load test for the JSON-RPC interface of a running daemon.
+#
+# Start a daemon first, e.g. an offline one with a test wallet:
+#   ./run_electrum --testnet -o daemon -d
+#   ./run_electrum --testnet -o load_wallet -w <wallet>
+# then run:
+#   bench_jsonrpc.py --testnet --wallet <wallet> --method getbalance
+
+import argparse
+import ast
+import asyncio
+import time
+
+import aiohttp
+
+from electrum import constants
+from electrum.simple_config import SimpleConfig
+from electrum.daemon import get_lockfile, get_rpc_credentials
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--testnet', action='store_true')
+    parser.add_argument('--regtest', action='store_true')
+    parser.add_argument('--dir', dest='electrum_path', help='electrum directory')
+    parser.add_argument('--wallet', dest='wallet_path', help='wallet path (for wallet commands)')
+    parser.add_argument('--method', default='version')
+    parser.add_argument('--requests', type=int, default=2000, help='number of JSON-RPC requests')
+    parser.add_argument('--concurrency', type=int, default=20, help='number of concurrent clients')
+    parser.add_argument('--batch', type=int, default=1, help='number of requests per HTTP POST')
+    args = parser.parse_args()
+
+    config_options = {k: v for k, v in vars(args).items() if k in ('testnet', 'regtest', 'electrum_path') and v}
+    config = SimpleConfig(config_options)
+    if args.testnet:
+        constants.set_testnet()
+    elif args.regtest:
+        constants.set_regtest()
+    with open(get_lockfile(config)) as f:
+        (host, port), create_time = ast.literal_eval(f.read())
+    rpc_user, rpc_password = get_rpc_credentials(config)
+    url = 'http://%s:%d' % (host, port)
+    params = {'wallet_path': args.wallet_path} if args.wallet_path else {}
+
+    def make_request(i):
+        return {'jsonrpc': '2.0', 'id': i, 'method': args.method, 'params': params}
+
+    num_posts = max(1, args.requests // args.batch)
+    errors = 0
+    latencies = []
+
+    async def client(session, queue):
+        nonlocal errors
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if args.batch > 1:
+                payload = [make_request(i * args.batch + j) for j in range(args.batch)]
+            else:
+                payload = make_request(i)
+            t = time.time()
+            async with session.post(url, json=payload) as resp:
+                result = await resp.json(content_type=None)
+            latencies.append(time.time() - t)
+            results = result if isinstance(result, list) else [result]
+            errors += sum(1 for r in results if 'error' in r)
+
+    async def run():
+        queue = asyncio.Queue()
+        for i in range(num_posts):
+            queue.put_nowait(i)
+        auth = aiohttp.BasicAuth(login=rpc_user, password=rpc_password)
+        # one keep-alive connection per client
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(auth=auth, connector=connector) as session:
+            await asyncio.gather(*[client(session, queue) for i in range(args.concurrency)])
+
+    t0 = time.time()
+    asyncio.get_event_loop().run_until_complete(run())
+    duration = time.time() - t0
+    num_requests = num_posts * args.batch
+    latencies.sort()
+    print(f"{num_requests} requests ({num_posts} posts, batch size {args.batch}), "
+          f"concurrency {args.concurrency}, {errors} errors")
+    print(f"{num_requests / duration:.0f} requests/s, "
+          f"median latency {1000 * latencies[len(latencies) // 2]:.1f} ms, "
+          f"max {1000 * latencies[-1]:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
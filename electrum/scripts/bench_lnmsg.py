@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+#
+# Measure encoding and decoding speed of gossip messages.
+#
+# usage: bench_lnmsg.py [num_messages]
+
+import sys
+import time
+
+from electrum.lnmsg import encode_msg, decode_msg
+
+
+def channel_update():
+    return encode_msg('channel_update', signature=bytes(64), chain_hash=bytes(32), short_channel_id=bytes(8),
+                      timestamp=int(time.time()), message_flags=b'\x01', channel_flags=b'\x00',
+                      cltv_expiry_delta=144, htlc_minimum_msat=1000, fee_base_msat=1000,
+                      fee_proportional_millionths=1, htlc_maximum_msat=1_000_000_000)
+
+
+def main():
+    args = [int(x) for x in sys.argv[1:]]
+    num_messages = args[0] if len(args) > 0 else 100_000
+    msgs = [
+        channel_update(),
+        encode_msg('channel_announcement', node_signature_1=bytes(64), node_signature_2=bytes(64),
+                   bitcoin_signature_1=bytes(64), bitcoin_signature_2=bytes(64), len=0, features=b'',
+                   chain_hash=bytes(32), short_channel_id=bytes(8), node_id_1=bytes(33), node_id_2=bytes(33),
+                   bitcoin_key_1=bytes(33), bitcoin_key_2=bytes(33)),
+        encode_msg('node_announcement', signature=bytes(64), flen=0, features=b'', timestamp=0,
+                   node_id=bytes(33), rgb_color=bytes(3), alias=bytes(32), addrlen=7, addresses=bytes(7)),
+    ]
+    t0 = time.time()
+    for i in range(num_messages):
+        decode_msg(msgs[i % len(msgs)])
+    t1 = time.time()
+    for i in range(num_messages):
+        channel_update()
+    t2 = time.time()
+    print(f"decode: {num_messages / (t1 - t0):.0f} msg/s")
+    print(f"encode: {num_messages / (t2 - t1):.0f} msg/s (channel_update)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+#
+# Measure the throughput of the BOLT-8 transport over a local socket pair.
+#
+# usage: bench_lntransport.py [num_messages] [message_size]
+
+import sys
+import time
+import asyncio
+
+from electrum.ecc import ECPrivkey
+from electrum.lnutil import LNPeerAddr
+from electrum.lntransport import LNResponderTransport, LNTransport
+
+
+def main():
+    args = [int(x) for x in sys.argv[1:]]
+    num_messages = args[0] if len(args) > 0 else 100_000
+    message_size = args[1] if len(args) > 1 else 136  # about the size of a channel_update
+    msg = b'\x01' * message_size
+
+    responder_key = ECPrivkey.generate_random_key()
+    initiator_key = ECPrivkey.generate_random_key()
+    done = asyncio.Event()
+    durations = {}
+
+    async def on_connection(reader, writer):
+        t = LNResponderTransport(responder_key.get_secret_bytes(), reader, writer)
+        await t.handshake()
+        n = 0
+        t0 = time.time()
+        async for _ in t.read_messages():
+            n += 1
+            if n == num_messages:
+                break
+        durations['read'] = time.time() - t0
+        t.close()
+        done.set()
+
+    async def run():
+        server = await asyncio.start_server(on_connection, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        peer_addr = LNPeerAddr('127.0.0.1', port, responder_key.get_public_key_bytes())
+        t = LNTransport(initiator_key.get_secret_bytes(), peer_addr)
+        await t.handshake()
+        t0 = time.time()
+        for i in range(num_messages):
+            t.send_bytes(msg)
+            if i % 1000 == 0:
+                await t.writer.drain()
+        await t.writer.drain()
+        durations['write'] = time.time() - t0
+        await done.wait()
+        server.close()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    total_bytes = num_messages * message_size
+    print(f"{num_messages} messages of {message_size} bytes")
+    print(f"write: {durations['write']:.3f} s")
+    print(f"read:  {durations['read']:.3f} s, "
+          f"{num_messages / durations['read']:.0f} msg/s, "
+          f"{total_bytes / durations['read'] / 1e6:.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
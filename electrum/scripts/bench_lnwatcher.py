@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# Watch many open channels the way a watchtower does, and measure how long
+# an LNWatcher spends per new block and per unrelated wallet event, checking
+# every channel versus only the channels that need to be looked at.
+#
+# usage: bench_lnwatcher.py [num_channels] [num_blocks]
+
+import sys
+import time
+import asyncio
+import tempfile
+
+from electrum.simple_config import SimpleConfig
+from electrum.lnwatcher import LNWatcher, WatchTower
+
+
+class FakeNetwork:
+
+    def __init__(self, config):
+        self.config = config
+        self.height = 1000
+        self.num_callbacks = 0
+
+    def register_callback(self, callback, events):
+        pass
+
+    def trigger_callback(self, event, *args):
+        self.num_callbacks += 1
+
+    def notify(self, key):
+        pass
+
+    def get_local_height(self):
+        return self.height
+
+
+class FakeSynchronizer:
+
+    def add(self, address):
+        pass
+
+
+class FakeWatchTower(LNWatcher):
+    CHECK_OPEN_CHANNELS_ON_NEW_BLOCK = WatchTower.CHECK_OPEN_CHANNELS_ON_NEW_BLOCK
+
+
+async def check_all_channels(watcher):
+    # what LNWatcher.on_network_update used to do
+    for address, outpoint in watcher.channels.items():
+        await watcher.check_onchain_situation(address, outpoint)
+
+
+def main():
+    args = [int(x) for x in sys.argv[1:]]
+    num_channels = args[0] if len(args) > 0 else 10000
+    num_blocks = args[1] if len(args) > 1 else 10
+    config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix='electrum-bench-lnwatcher-')})
+    loop = asyncio.get_event_loop()
+    print(f"{num_channels} open channels, {num_blocks} blocks")
+    for name, cls, update in (('all channels', LNWatcher, check_all_channels),
+                              ('wallet', LNWatcher, None),
+                              ('watchtower', FakeWatchTower, None)):
+        network = FakeNetwork(config)
+        watcher = cls(network)
+        watcher.synchronizer = FakeSynchronizer()
+        for i in range(num_channels):
+            watcher.add_channel(f'{i:064x}:0', f'address{i}')
+        watcher.up_to_date = True
+        update = update or (lambda watcher: watcher.on_network_update('blockchain_updated'))
+        loop.run_until_complete(update(watcher))
+        network.num_callbacks = 0
+        t0 = time.time()
+        for i in range(num_blocks):
+            network.height += 1
+            loop.run_until_complete(update(watcher))
+            # a few unrelated events per block
+            for j in range(3):
+                loop.run_until_complete(update(watcher))
+        duration = time.time() - t0
+        num_events = 4 * num_blocks
+        print(f"{name:12}: {1000 * duration / num_events:8.2f} ms/event, "
+              f"{network.num_callbacks / num_events:8.0f} channels checked/event")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# Benchmark LNPathFinder.find_path_for_payment on a synthetic graph,
+# and retries after a failure with and without the path cache.
+#
+# usage: bench_pathfinding.py [num_channels] [num_nodes] [num_queries]
+
+import sys
+import time
+import random
+import tempfile
+
+from electrum.simple_config import SimpleConfig
+from electrum.util import create_and_start_event_loop
+from electrum.channel_db import ChannelDB, ChannelInfo, Policy
+from electrum.lnrouter import LNPathFinder
+from electrum.lnutil import ShortChannelID
+
+
+class FakeNetwork:
+    interface = None
+
+    def __init__(self, config, asyncio_loop):
+        self.config = config
+        self.asyncio_loop = asyncio_loop
+
+    def trigger_callback(self, *args):
+        pass
+
+    def register_callback(self, *args):
+        pass
+
+
+def populate(channel_db: ChannelDB, num_channels: int, num_nodes: int):
+    # the graph is put in memory directly, the same way load_data does
+    rand = random.Random(0)
+    node_ids = [bytes([2]) + rand.getrandbits(256).to_bytes(32, 'big') for i in range(num_nodes)]
+    now = int(time.time())
+    for i in range(num_channels):
+        node1_id, node2_id = sorted(rand.sample(node_ids, 2))
+        short_channel_id = ShortChannelID.from_components(500_000 + i // 1000, i % 1000, 0)
+        ci = ChannelInfo(short_channel_id, node1_id, node2_id, rand.randint(10_000, 10_000_000))
+        channel_db._channels[short_channel_id] = ci
+        channel_db._channels_for_node[node1_id].add(short_channel_id)
+        channel_db._channels_for_node[node2_id].add(short_channel_id)
+        for start_node in (node1_id, node2_id):
+            p = Policy(key=short_channel_id + start_node,
+                       cltv_expiry_delta=rand.choice([40, 144]),
+                       htlc_minimum_msat=1000,
+                       htlc_maximum_msat=None,
+                       fee_base_msat=rand.choice([0, 1000]),
+                       fee_proportional_millionths=rand.randint(1, 1000),
+                       channel_flags=0,
+                       message_flags=0,
+                       timestamp=now)
+            channel_db._policies[(start_node, short_channel_id)] = p
+    channel_db.rebuild_edges()
+    return node_ids
+
+
+def main():
+    args = [int(x) for x in sys.argv[1:]]
+    num_channels = args[0] if len(args) > 0 else 50_000
+    num_nodes = args[1] if len(args) > 1 else num_channels // 5
+    num_queries = args[2] if len(args) > 2 else 20
+
+    loop, stopping_fut, loop_thread = create_and_start_event_loop()
+    config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix='electrum-bench-pathfinding-')})
+    try:
+        channel_db = ChannelDB(FakeNetwork(config, loop))
+        t0 = time.time()
+        node_ids = populate(channel_db, num_channels, num_nodes)
+        t1 = time.time()
+        print(f"graph: {num_channels} channels, {num_nodes} nodes, built in {t1 - t0:.2f} s")
+        path_finder = LNPathFinder(channel_db)
+        rand = random.Random(1)
+        found = 0
+        durations = []
+        for i in range(num_queries):
+            node_a, node_b = rand.sample(node_ids, 2)
+            t = time.time()
+            path = path_finder.find_path_for_payment(node_a, node_b, 100_000_000)
+            durations.append(time.time() - t)
+            found += path is not None
+        # a payment attempt failing at the second hop, then retried: the
+        # path is computed again, or taken from the alternatives cached
+        # by find_paths_for_payment
+        retry_durations = {'recompute': [], 'cached': []}
+        for i in range(num_queries):
+            node_a, node_b = rand.sample(node_ids, 2)
+            paths = path_finder.find_paths_for_payment(node_a, node_b, 100_000_000, num_paths=3)
+            if len(paths) < 2:
+                continue
+            path_finder.add_to_blacklist(paths[0][1][1])
+            t = time.time()
+            path_finder.find_path_for_payment(node_a, node_b, 100_000_000)
+            retry_durations['recompute'].append(time.time() - t)
+            t = time.time()
+            path_finder.find_paths_for_payment(node_a, node_b, 100_000_000, num_paths=3)
+            retry_durations['cached'].append(time.time() - t)
+    finally:
+        loop.call_soon_threadsafe(stopping_fut.set_result, 1)
+        loop_thread.join(timeout=5)
+    durations.sort()
+    print(f"queries: {num_queries}, paths found: {found}")
+    print(f"median: {1000 * durations[len(durations) // 2]:.1f} ms, max: {1000 * durations[-1]:.1f} ms")
+    for name, durations in retry_durations.items():
+        if durations:
+            durations.sort()
+            print(f"retry, {name:9}: median {1000 * durations[len(durations) // 2]:.2f} ms, "
+                  f"max: {1000 * durations[-1]:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Load a scratch watchtower sweep store the way clients upload to it,
+# one sweep tx per request versus bulk uploads, and measure lookups.
+#
+# usage: bench_watchtower.py [num_channels] [num_ctns] [sweeps_per_ctn]
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+from electrum.util import create_and_start_event_loop
+from electrum.lnwatcher import SweepStore
+from electrum.lnworker import WATCHTOWER_UPLOAD_BATCH_SIZE
+
+
+class FakeNetwork:
+
+    def __init__(self, asyncio_loop):
+        self.asyncio_loop = asyncio_loop
+
+
+def make_sweeps(num_channels, num_ctns, sweeps_per_ctn):
+    raw_tx = os.urandom(300).hex()
+    channels = {}
+    for i in range(num_channels):
+        outpoint = f'{i:064x}:0'
+        channels[outpoint] = [(ctn, f'{ctn:064x}:{j}', raw_tx)
+                              for ctn in range(1, num_ctns + 1) for j in range(sweeps_per_ctn)]
+    return channels
+
+
+def main():
+    args = [int(x) for x in sys.argv[1:]]
+    num_channels = args[0] if len(args) > 0 else 20
+    num_ctns = args[1] if len(args) > 1 else 100
+    sweeps_per_ctn = args[2] if len(args) > 2 else 2
+    channels = make_sweeps(num_channels, num_ctns, sweeps_per_ctn)
+    num_sweeps = num_channels * num_ctns * sweeps_per_ctn
+    loop, stopping_fut, loop_thread = create_and_start_event_loop()
+    network = FakeNetwork(loop)
+    tmpdir = tempfile.mkdtemp(prefix='electrum-bench-watchtower-')
+
+    async def one_by_one(store):
+        for outpoint, sweeps in channels.items():
+            await store.get_ctn(outpoint, 'address')
+            for ctn, prevout, tx in sweeps:
+                await store.add_sweep_tx(outpoint, ctn, prevout, tx)
+
+    async def bulk(store):
+        for outpoint, sweeps in channels.items():
+            await store.get_ctn(outpoint, 'address')
+            for i in range(0, len(sweeps), WATCHTOWER_UPLOAD_BATCH_SIZE):
+                await store.add_sweep_txs(outpoint, sweeps[i:i+WATCHTOWER_UPLOAD_BATCH_SIZE])
+
+    async def lookups(store):
+        for outpoint, sweeps in channels.items():
+            await store.get_ctn(outpoint, 'address')
+            for ctn, prevout, tx in sweeps[::sweeps_per_ctn]:
+                assert len(await store.get_sweep_tx(outpoint, prevout)) == 1
+
+    def run(coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    try:
+        print(f"{num_channels} channels, {num_ctns} ctns, {num_sweeps} sweep txs")
+        for name, upload in (('one by one', one_by_one), ('bulk', bulk)):
+            store = SweepStore(os.path.join(tmpdir, name.replace(' ', '_')), network)
+            t0 = time.time()
+            run(upload(store))
+            duration = time.time() - t0
+            print(f"upload {name:10}: {num_sweeps / duration:8.0f} sweep txs/s")
+        t0 = time.time()
+        run(lookups(store))
+        duration = time.time() - t0
+        print(f"lookups          : {num_channels * num_ctns / duration:8.0f} prevouts/s")
+    finally:
+        loop.call_soon_threadsafe(stopping_fut.set_result, 1)
+        loop_thread.join(timeout=1)
+
+
+if __name__ == '__main__':
+    main()
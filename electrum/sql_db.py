@@ -4,19 +4,39 @@ import queue
 import threading
 import asyncio
 import sqlite3
+import time
 
 from .logging import Logger
 
 
+COMMIT_MAX_DELAY = 5  # seconds
+
+
 def sql(func):
     """wrapper for sql methods"""
     def wrapper(self, *args, **kwargs):
         assert threading.currentThread() != self.sql_thread
-        f = asyncio.Future()
-        self.db_requests.put((f, func, args, kwargs))
+        loop = asyncio.get_event_loop()
+        f = loop.create_future()
+        self.db_requests.put((loop, f, func, args, kwargs))
         return f
     return wrapper
 
+def _set_result(future, result):
+    if not future.cancelled():
+        future.set_result(result)
+
+def _set_exception(future, e):
+    if not future.cancelled():
+        future.set_exception(e)
+
+def _call_soon_threadsafe(loop, callback, *args):
+    # the loop of the caller might be closed already, e.g. during shutdown
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        pass
+
 class SqlDB(Logger):
     
     def __init__(self, network, path, commit_interval=None):
@@ -34,25 +54,52 @@ class SqlDB(Logger):
         self.logger.info("Creating database")
         self.create_database()
         i = 0
+        first_uncommitted = None
         while self.network.asyncio_loop.is_running():
+            # under light load commit_interval may take long to reach,
+            # so pending writes are also flushed after COMMIT_MAX_DELAY
+            if first_uncommitted and time.monotonic() - first_uncommitted >= COMMIT_MAX_DELAY:
+                self.conn.commit()
+                i = 0
+                first_uncommitted = None
             try:
-                future, func, args, kwargs = self.db_requests.get(timeout=0.1)
+                loop, future, func, args, kwargs = self.db_requests.get(timeout=0.1)
             except queue.Empty:
                 continue
-            try:
-                result = func(self, *args, **kwargs)
-            except BaseException as e:
-                future.set_exception(e)
-                continue
-            if not future.cancelled():
-                future.set_result(result)
+            self._execute(loop, future, func, args, kwargs)
             # note: in sweepstore session.commit() is called inside
             # the sql-decorated methods, so commiting to disk is awaited
             if self.commit_interval:
                 i = (i + 1) % self.commit_interval
                 if i == 0:
                     self.conn.commit()
+                    first_uncommitted = None
+                elif first_uncommitted is None:
+                    first_uncommitted = time.monotonic()
+        # requests made just before the event loop stopped are still written
+        while True:
+            try:
+                loop, future, func, args, kwargs = self.db_requests.get_nowait()
+            except queue.Empty:
+                break
+            self._execute(loop, future, func, args, kwargs)
         # write
         self.conn.commit()
         self.conn.close()
+        self.on_clean_close()
         self.logger.info("SQL thread terminated")
+
+    def _execute(self, loop, future, func, args, kwargs):
+        # futures belong to the event loop of the caller,
+        # they must be resolved from that loop's thread
+        try:
+            result = func(self, *args, **kwargs)
+        except BaseException as e:
+            _call_soon_threadsafe(loop, _set_exception, future, e)
+            return
+        _call_soon_threadsafe(loop, _set_result, future, result)
+
+    def on_clean_close(self):
+        """Called in the sql thread once every request has been written and
+        the database is closed."""
+        pass
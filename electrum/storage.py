@@ -23,15 +23,18 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import shutil
 import threading
 import stat
 import hashlib
 import base64
 import zlib
+import json
 from enum import IntEnum
+from typing import Optional
 
 from . import ecc
-from .util import profiler, InvalidPassword, WalletFileException, bfh, standardize_path
+from .util import profiler, InvalidPassword, WalletFileException, bfh, bh2u, standardize_path
 from .plugin import run_hook, plugin_loaders
 
 from .json_db import JsonDB
@@ -53,6 +56,34 @@ class StorageEncryptionVersion(IntEnum):
 class StorageReadWriteError(Exception): pass
 
 
+# Channel states are appended to a journal next to the wallet file, so that
+# saving a channel does not rewrite the whole file. The journal is folded
+# into the wallet file by the next full write, or when it gets this big.
+JOURNAL_MAX_SIZE = 10 * 1000 * 1000  # bytes
+
+
+def get_journal_path(wallet_path: str) -> str:
+    return wallet_path + '.journal'
+
+
+def delete_wallet_file(path: str) -> None:
+    """Delete a wallet file, and the channel journal that goes with it."""
+    os.unlink(path)
+    try:
+        os.unlink(get_journal_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def copy_wallet_file(path: str, new_path: str) -> None:
+    """Copy a wallet file, and the channel journal that goes with it."""
+    shutil.copy2(path, new_path)
+    if os.path.exists(get_journal_path(path)):
+        shutil.copy2(get_journal_path(path), get_journal_path(new_path))
+    elif os.path.exists(get_journal_path(new_path)):
+        os.unlink(get_journal_path(new_path))
+
+
 class WalletStorage(Logger):
 
     def __init__(self, path, *, manual_upgrades: bool = False):
@@ -65,6 +96,8 @@ class WalletStorage(Logger):
         DB_Class = JsonDB
         self.logger.info(f"wallet path {self.path}")
         self.pubkey = None
+        self._journal_size = 0
+        self._needs_full_write = False  # e.g. if the encryption key changed
         self._test_read_write_permissions(self.path)
         if self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
@@ -72,6 +105,7 @@ class WalletStorage(Logger):
             self._encryption_version = self._init_encryption_version()
             if not self.is_encrypted():
                 self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades)
+                self._replay_journal(None)
                 self.load_plugins()
         else:
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
@@ -116,13 +150,18 @@ class WalletStorage(Logger):
         with self.lock:
             self._write()
 
-    def _write(self):
+    def _write(self, *, new_journal_id=False):
         if threading.currentThread().isDaemon():
             self.logger.warning('daemon thread cannot write db')
             return
         if not self.db.modified():
             return
         self.db.commit()
+        journal_path = self._get_journal_path()
+        journal_exists = os.path.exists(journal_path)
+        if journal_exists or new_journal_id:
+            # records of the current journal will not match anymore
+            self.db.put('journal_id', bh2u(os.urandom(16)))
         s = self.encrypt_before_writing(self.db.dump())
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w", encoding='utf-8') as f:
@@ -139,6 +178,63 @@ class WalletStorage(Logger):
         self._file_exists = True
         self.logger.info(f"saved {self.path}")
         self.db.set_modified(False)
+        if journal_exists:
+            os.unlink(journal_path)
+        self._journal_size = 0
+        self._needs_full_write = False
+
+    def _get_journal_path(self) -> str:
+        return get_journal_path(self.path)
+
+    def write_channel(self, serialized: dict) -> None:
+        """Saves one channel. Unlike write(), this only appends the
+        channel state to the journal, which is synced to disk before
+        returning."""
+        with self.lock:
+            self.db.put_channel(serialized)
+            if (not self.file_exists()
+                    or self._needs_full_write
+                    or self._journal_size > JOURNAL_MAX_SIZE
+                    or self.db.get('journal_id') is None):
+                self._write(new_journal_id=True)
+                return
+            record = json.dumps({'journal_id': self.db.get('journal_id'), 'channel': serialized})
+            line = bytes(self.encrypt_before_writing(record) + '\n', 'utf8')
+            fd = os.open(self._get_journal_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, stat.S_IREAD | stat.S_IWRITE)
+            with open(fd, 'ab') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_size += len(line)
+
+    def _replay_journal(self, ec_key: Optional[ecc.ECPrivkey]) -> None:
+        journal_path = self._get_journal_path()
+        if not os.path.exists(journal_path):
+            return
+        journal_id = self.db.get('journal_id')
+        num_records = 0
+        offset = 0
+        with open(journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    s = line.rstrip(b'\n')
+                    if ec_key:
+                        s = zlib.decompress(ec_key.decrypt_message(s, self._get_encryption_magic()))
+                    record = json.loads(s.decode('utf8'))
+                except Exception:
+                    # the last record was not fully written
+                    self.logger.warning(f"truncating journal at offset {offset}")
+                    break
+                offset += len(line)
+                if journal_id is None or record.get('journal_id') != journal_id:
+                    continue  # from before the last full write
+                self.db.put_channel(record['channel'])
+                num_records += 1
+        if offset != os.path.getsize(journal_path):
+            with open(journal_path, 'r+b') as f:
+                f.truncate(offset)
+        self._journal_size = offset
+        self.logger.info(f"replayed {num_records} journal records")
 
     def file_exists(self) -> bool:
         return self._file_exists
@@ -215,6 +311,7 @@ class WalletStorage(Logger):
         self.pubkey = ec_key.get_public_key_hex()
         s = s.decode('utf8')
         self.db = JsonDB(s, manual_upgrades=self._manual_upgrades)
+        self._replay_journal(ec_key)
         self.load_plugins()
 
     def encrypt_before_writing(self, plaintext: str) -> str:
@@ -253,6 +350,8 @@ class WalletStorage(Logger):
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
         # make sure next storage.write() saves changes
         self.db.set_modified(True)
+        # the journal must not mix records encrypted with different keys
+        self._needs_full_write = True
 
     def basename(self) -> str:
         return os.path.basename(self.path)
@@ -24,14 +24,18 @@
 # SOFTWARE.
 import asyncio
 import hashlib
-from typing import Dict, List, TYPE_CHECKING, Tuple
-from collections import defaultdict
+import os
+import json
+import time
+import itertools
+from typing import Dict, List, TYPE_CHECKING, Tuple, NamedTuple, Optional, Deque, Set, Sequence
+from collections import defaultdict, deque
 import logging
 
 from aiorpcx import TaskGroup, run_in_thread, RPCError
 
 from .transaction import Transaction, PartialTransaction
-from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer
+from .util import bh2u, NetworkJobOnDefaultServer
 from .bitcoin import address_to_scripthash, is_address
 from .network import UntrustedServerReturnedError
 from .logging import Logger
@@ -42,6 +46,12 @@ if TYPE_CHECKING:
     from .address_synchronizer import AddressSynchronizer
 
 
+NOTIFIER_MAX_CONCURRENT_REQUESTS = 10
+NOTIFIER_MAX_ATTEMPTS = 20
+NOTIFIER_RETRY_DELAY_MIN = 1
+NOTIFIER_RETRY_DELAY_MAX = 3600
+
+
 class SynchronizerFailure(Exception): pass
 
 
@@ -90,6 +100,14 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     def add(self, addr):
         asyncio.run_coroutine_threadsafe(self._add_address(addr), self.asyncio_loop)
 
+    def add_many(self, addrs: Sequence[str]):
+        # one hop to the event loop for all addresses
+        asyncio.run_coroutine_threadsafe(self._add_addresses(list(addrs)), self.asyncio_loop)
+
+    async def _add_addresses(self, addrs: Sequence[str]):
+        for addr in addrs:
+            await self._add_address(addr)
+
     async def _add_address(self, addr: str):
         if not is_address(addr): raise ValueError(f"invalid bitcoin address {addr}")
         if addr in self.requested_addrs: return
@@ -255,35 +273,215 @@ class Synchronizer(SynchronizerBase):
                 self.wallet.network.trigger_callback('wallet_updated', self.wallet)
 
 
+class PendingNotification(NamedTuple):
+    address: str
+    status: Optional[str]
+    timestamp: float  # when the status change was seen
+
+
 class Notifier(SynchronizerBase):
     """Watch addresses. Every time the status of an address changes,
     an HTTP POST is sent to the corresponding URL.
+
+    Notifications are queued per URL and delivered in order, with at most
+    NOTIFIER_MAX_CONCURRENT_REQUESTS requests in flight. Failed deliveries
+    are retried with exponential backoff. Watched addresses and undelivered
+    notifications are saved to disk, so they survive a restart.
+    If the 'notify_batch_size' config key is larger than one, up to that many
+    pending notifications for the same URL are sent as a JSON list in one POST.
     """
-    def __init__(self, network):
+    def __init__(self, network: 'Network'):
         SynchronizerBase.__init__(self, network)
         self.watched_addresses = defaultdict(list)  # type: Dict[str, List[str]]
         self.start_watching_queue = asyncio.Queue()
+        self.batch_size = max(1, int(network.config.get('notify_batch_size', 1)))
+        # url -> notifications not yet accepted by url
+        self._pending = defaultdict(deque)  # type: Dict[str, Deque[PendingNotification]]
+        # addr -> last status we notified about
+        self._last_status = {}  # type: Dict[str, Optional[str]]
+        # url -> (number of failed attempts, time of next attempt)
+        self._retry_state = {}  # type: Dict[str, Tuple[int, float]]
+        self._urls_in_flight = set()  # type: Set[str]
+        self._delivery_semaphore = asyncio.Semaphore(NOTIFIER_MAX_CONCURRENT_REQUESTS)
+        self._pending_changed = asyncio.Event()
+        self._needs_save = False
+        # metrics
+        self.num_delivered = 0
+        self.num_dropped = 0
+        self.last_delivery_lag = None  # type: Optional[float]
+        self.max_delivery_lag = 0.
+        self._total_delivery_lag = 0.
+        self._path = self.get_path(network.config)
+        self._load()
+
+    @staticmethod
+    def get_path(config) -> Optional[str]:
+        return os.path.join(config.path, 'notifier') if config.path else None
+
+    @classmethod
+    def has_saved_state(cls, config) -> bool:
+        path = cls.get_path(config)
+        return bool(path) and os.path.exists(path)
+
+    def _load(self):
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                data = json.loads(f.read())
+        except Exception as e:
+            self.logger.warning(f'cannot load notifier queue: {repr(e)}')
+            return
+        for addr, urls in data.get('watched_addresses', {}).items():
+            self.watched_addresses[addr] = urls
+        self._last_status = data.get('last_status', {})
+        for url, items in data.get('pending', {}).items():
+            self._pending[url] = deque(PendingNotification(*item) for item in items)
+        self.logger.info(f'loaded {len(self.watched_addresses)} watched addresses, '
+                         f'{self.num_pending()} pending notifications')
+
+    async def _save(self):
+        if not self._path:
+            return
+        # copied here, serialized and written in a worker thread
+        data = {
+            'watched_addresses': {addr: list(urls) for addr, urls in self.watched_addresses.items()},
+            'last_status': dict(self._last_status),
+            'pending': {url: list(map(list, items)) for url, items in self._pending.items() if items},
+        }
+        await self.asyncio_loop.run_in_executor(None, self._write, data)
+
+    def _write(self, data: dict):
+        tmp_path = self._path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            self.logger.warning(f'cannot save notifier queue: {repr(e)}')
 
     async def main(self):
+        await self.group.spawn(self._deliver_notifications())
+        await self.group.spawn(self._save_periodically())
         # resend existing subscriptions if we were restarted
         for addr in self.watched_addresses:
             await self._add_address(addr)
         # main loop
         while True:
             addr, url = await self.start_watching_queue.get()
-            self.watched_addresses[addr].append(url)
+            if url not in self.watched_addresses[addr]:
+                self.watched_addresses[addr].append(url)
+                # if we are already subscribed, the new url still gets the current status
+                if addr in self._last_status:
+                    self._pending[url].append(PendingNotification(addr, self._last_status[addr], time.time()))
+                    self._pending_changed.set()
+            self._needs_save = True
             await self._add_address(addr)
 
     async def _on_address_status(self, addr, status):
+        # subscriptions are re-sent on every reconnection; only notify on actual changes
+        if addr in self._last_status and self._last_status[addr] == status:
+            return
         self.logger.info(f'new status for addr {addr}')
-        headers = {'content-type': 'application/json'}
-        data = {'address': addr, 'status': status}
+        self._last_status[addr] = status
+        now = time.time()
         for url in self.watched_addresses[addr]:
+            self._pending[url].append(PendingNotification(addr, status, now))
+        self._needs_save = True
+        self._pending_changed.set()
+
+    async def _save_periodically(self):
+        # note: this bounds what can be lost in a crash to about a second of events
+        while True:
+            await asyncio.sleep(1)
+            if self._needs_save:
+                self._needs_save = False
+                await self._save()
+
+    async def _deliver_notifications(self):
+        while True:
+            self._pending_changed.clear()
+            now = time.time()
+            next_wakeup = now + 60
+            for url, items in list(self._pending.items()):
+                if not items:
+                    del self._pending[url]
+                    continue
+                if url in self._urls_in_flight:
+                    continue
+                num_failures, next_attempt = self._retry_state.get(url, (0, 0))
+                if next_attempt > now:
+                    next_wakeup = min(next_wakeup, next_attempt)
+                    continue
+                self._urls_in_flight.add(url)
+                await self.group.spawn(self._deliver_to_url(url))
             try:
-                async with make_aiohttp_session(proxy=self.network.proxy, headers=headers) as session:
-                    async with session.post(url, json=data, headers=headers) as resp:
-                        await resp.text()
-            except Exception as e:
-                self.logger.info(repr(e))
-            else:
-                self.logger.info(f'Got Response for {addr}')
+                await asyncio.wait_for(self._pending_changed.wait(), next_wakeup - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver_to_url(self, url: str):
+        try:
+            async with self._delivery_semaphore:
+                items = list(itertools.islice(self._pending[url], self.batch_size))
+                data = [{'address': item.address, 'status': item.status} for item in items]
+                if self.batch_size == 1:
+                    data = data[0]
+                headers = {'content-type': 'application/json'}
+                try:
+                    await self.network._send_http_on_proxy('post', url, json=data, headers=headers)
+                except Exception as e:
+                    self._on_delivery_failed(url, e)
+                else:
+                    self._on_delivered(url, items)
+        finally:
+            self._urls_in_flight.discard(url)
+            self._pending_changed.set()
+
+    def _on_delivered(self, url: str, items: List[PendingNotification]):
+        now = time.time()
+        self._retry_state.pop(url, None)
+        pending = self._pending[url]
+        for item in items:
+            pending.popleft()
+            lag = now - item.timestamp
+            self.num_delivered += 1
+            self.last_delivery_lag = lag
+            self.max_delivery_lag = max(self.max_delivery_lag, lag)
+            self._total_delivery_lag += lag
+        self._needs_save = True
+        self.logger.info(f'delivered {len(items)} notifications to {url}')
+
+    def _on_delivery_failed(self, url: str, e: Exception):
+        num_failures, _ = self._retry_state.get(url, (0, 0))
+        num_failures += 1
+        if num_failures >= NOTIFIER_MAX_ATTEMPTS:
+            # give up on the oldest notification, so that a single bad one does not block the url
+            self._pending[url].popleft()
+            self.num_dropped += 1
+            self._needs_save = True
+            self.logger.warning(f'dropping notification for {url} after {num_failures} attempts: {repr(e)}')
+            num_failures = 0
+        delay = min(NOTIFIER_RETRY_DELAY_MAX, NOTIFIER_RETRY_DELAY_MIN * 2 ** num_failures)
+        self._retry_state[url] = (num_failures, time.time() + delay)
+        self.logger.info(f'failed to notify {url} (attempt {num_failures}), retrying in {delay} s: {repr(e)}')
+
+    def num_pending(self) -> int:
+        return sum(len(items) for items in self._pending.values())
+
+    def get_stats(self) -> dict:
+        now = time.time()
+        oldest = min((items[0].timestamp for items in self._pending.values() if items), default=None)
+        return {
+            'watched_addresses': len(self.watched_addresses),
+            'pending': self.num_pending(),
+            'failing_urls': len(self._retry_state),
+            'delivered': self.num_delivered,
+            'dropped': self.num_dropped,
+            'oldest_pending_age': now - oldest if oldest is not None else None,
+            'last_delivery_lag': self.last_delivery_lag,
+            'max_delivery_lag': self.max_delivery_lag,
+            'average_delivery_lag': self._total_delivery_lag / self.num_delivered if self.num_delivered else None,
+        }
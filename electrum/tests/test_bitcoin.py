@@ -184,6 +184,32 @@ class Test_bitcoin(ElectrumTestCase):
         self.assertFalse(ecc.verify_message_with_address(addr1, b'wrong', msg1))
         self.assertFalse(ecc.verify_message_with_address(addr1, sig2, msg1))
 
+    @needs_test_with_all_ecc_implementations
+    def test_verify_signatures(self):
+        keys = [ecc.ECPrivkey(bytes([i]) * 32) for i in range(1, 4)]
+        items = []
+        for i, key in enumerate(keys):
+            h = sha256d(bytes([i]))
+            items.append((key.get_public_key_bytes(compressed=True), key.sign(h), h))
+        # a high-S signature is accepted, like by verify_signature
+        pubkey, sig, h = items[0]
+        r, s = ecc.get_r_and_s_from_sig_string(sig)
+        items.append((pubkey, ecc.sig_string_from_r_and_s(r, ecc.CURVE_ORDER - s), h))
+        self.assertTrue(ecc.verify_signatures(items))
+        self.assertTrue(ecc.verify_signatures([]))
+        bad_items = [
+            (pubkey, sig, sha256d(b'other message')),
+            (keys[1].get_public_key_bytes(compressed=True), sig, h),
+            (pubkey, sig[:63], h),
+            (pubkey, bytes(64), h),
+            (pubkey, b'\xff' * 64, h),
+            (b'\x02' + b'\xff' * 32, sig, h),
+            (pubkey[:32], sig, h),
+        ]
+        for bad_item in bad_items:
+            self.assertFalse(ecc.verify_signature(*bad_item))
+            self.assertFalse(ecc.verify_signatures(items + [bad_item]))
+
     @needs_test_with_all_aes_implementations
     @needs_test_with_all_ecc_implementations
     def test_decrypt_message(self):
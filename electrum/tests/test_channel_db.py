@@ -0,0 +1,278 @@
+import asyncio
+import sqlite3
+import time
+from unittest import mock
+
+from electrum.util import create_and_start_event_loop
+from electrum.ecc import ECPrivkey
+from electrum.crypto import sha256d
+from electrum.channel_db import ChannelDB
+from electrum.constants import BitcoinTestnet
+from electrum.simple_config import SimpleConfig
+from electrum.sql_db import sql
+from electrum import sql_db
+
+from . import TestCaseForTestnet
+
+
+class MockNetwork:
+    def __init__(self, config):
+        self.config = config
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.interface = None
+
+    def trigger_callback(self, *args):
+        pass
+
+    def register_callback(self, *args):
+        pass
+
+
+@sql
+def select_all(self, table):
+    # runs in the sql thread, so uncommitted rows are visible
+    return self.conn.execute(f"SELECT * FROM {table}").fetchall()
+
+
+@sql
+def commit(self):
+    self.conn.commit()
+
+
+class TestChannelDB(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.cdb = ChannelDB(MockNetwork(self.config))
+        self.other_dbs = []
+        keys = [ECPrivkey.generate_random_key() for i in range(2)]
+        self.keys = sorted(keys, key=lambda k: k.get_public_key_bytes())
+        self.node1, self.node2 = [k.get_public_key_bytes() for k in self.keys]
+        self.scid = bytes.fromhex('0000010000010000')
+        self.cdb.add_channel_announcement({
+            'node_id_1': self.node1, 'node_id_2': self.node2,
+            'bitcoin_key_1': self.node1, 'bitcoin_key_2': self.node2,
+            'short_channel_id': self.scid,
+            'chain_hash': BitcoinTestnet.rev_genesis_bytes(),
+            'len': b'\x00\x00', 'features': b''}, trusted=True)
+
+    def tearDown(self):
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        for cdb in [self.cdb] + self.other_dbs:
+            cdb.sql_thread.join(timeout=1)
+        super().tearDown()
+
+    def run_in_loop(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result(timeout=5)
+
+    def run_sql(self, func, *args):
+        # sql requests must be made from the event loop thread
+        async def f():
+            return await func(*args)
+        return self.run_in_loop(f())
+
+    def select_all(self, table):
+        return self.run_sql(select_all, self.cdb, table)
+
+    def channel_update(self, direction, timestamp, *, fee_base_msat=1000, sign=True):
+        body = b'update %d %d %d' % (direction, timestamp, fee_base_msat)
+        key = self.keys[direction]
+        signature = key.sign(sha256d(body)) if sign else bytes(64)
+        return {
+            'short_channel_id': self.scid,
+            'chain_hash': BitcoinTestnet.rev_genesis_bytes(),
+            'message_flags': b'\x00',
+            'channel_flags': bytes([direction]),
+            'cltv_expiry_delta': (144).to_bytes(2, 'big'),
+            'htlc_minimum_msat': (1).to_bytes(8, 'big'),
+            'fee_base_msat': fee_base_msat.to_bytes(4, 'big'),
+            'fee_proportional_millionths': (10).to_bytes(4, 'big'),
+            'timestamp': timestamp.to_bytes(4, 'big'),
+            'signature': signature,
+            'raw': b'\x01\x02' + signature + body,
+        }
+
+    def test_channel_updates_saved_in_one_request(self):
+        now = int(time.time())
+        with mock.patch.object(self.cdb, 'save_policies', wraps=self.cdb.save_policies) as save_policies:
+            categorized = self.cdb.add_channel_updates([self.channel_update(0, now), self.channel_update(1, now)])
+        self.assertEqual(2, len(categorized.good))
+        self.assertEqual(1, save_policies.call_count)
+        rows = self.select_all('policy')
+        self.assertEqual({self.scid + self.node1, self.scid + self.node2}, {row[0] for row in rows})
+
+    def test_node_announcements_saved_in_one_request(self):
+        def node_ann(node_id, timestamp):
+            return {'node_id': node_id, 'features': b'', 'alias': b'alice\x00\x00',
+                    'timestamp': timestamp.to_bytes(4, 'big'),
+                    # two IPv4 addresses
+                    'addresses': b'\x01\x01\x02\x03\x04\x26\x07' + b'\x01\x05\x06\x07\x08\x26\x07'}
+        with mock.patch.object(self.cdb, 'save_nodes', wraps=self.cdb.save_nodes) as save_nodes, \
+                mock.patch.object(self.cdb, 'save_node_addresses', wraps=self.cdb.save_node_addresses) as save_node_addresses:
+            # the older announcement of node1 is ignored; the unknown node is not saved
+            self.cdb.add_node_announcement([node_ann(self.node1, 2), node_ann(self.node1, 1),
+                                            node_ann(self.node2, 1), node_ann(b'\x02' * 33, 1)])
+        self.assertEqual(1, save_nodes.call_count)
+        self.assertEqual(1, save_node_addresses.call_count)
+        nodes = self.select_all('node_info')
+        self.assertEqual({(self.node1, 2), (self.node2, 1)}, {(row[0], row[2]) for row in nodes})
+        addresses = self.select_all('address')
+        self.assertEqual({(node_id, host) for node_id in (self.node1, self.node2) for host in ('1.2.3.4', '5.6.7.8')},
+                         {(row[0], row[1]) for row in addresses})
+
+    def test_channel_updates_verified_before_applied(self):
+        now = int(time.time())
+        self.cdb.add_channel_updates([self.channel_update(0, now)])
+        # only the good updates are verified; the deprecated one has a bad signature
+        categorized = self.cdb.categorize_channel_updates(
+            [self.channel_update(0, now - 1, sign=False), self.channel_update(1, now)])
+        self.assertEqual(1, len(categorized.deprecated))
+        self.assertEqual(1, len(categorized.good))
+        self.cdb.verify_channel_updates(categorized.good)
+        # a bad signature fails the whole batch, and nothing is applied
+        with self.assertRaises(Exception) as ctx:
+            self.cdb.add_channel_updates([self.channel_update(1, now),
+                                          self.channel_update(0, now + 1, fee_base_msat=5, sign=False)])
+        self.assertIn('failed verifying channel update', str(ctx.exception))
+        self.assertIsNone(self.cdb.get_policy_for_node(self.scid, self.node2))
+        self.assertEqual(1000, self.cdb.get_policy_for_node(self.scid, self.node1).fee_base_msat)
+        # a wrong chain hash is rejected too
+        update = self.channel_update(1, now)
+        update['chain_hash'] = bytes(32)
+        with self.assertRaises(Exception):
+            self.cdb.add_channel_updates([update])
+        self.assertIsNone(self.cdb.get_policy_for_node(self.scid, self.node2))
+
+    def test_writes_are_committed_under_light_load(self):
+        now = int(time.time())
+        with mock.patch.object(sql_db, 'COMMIT_MAX_DELAY', 0.2):
+            self.cdb.add_channel_updates([self.channel_update(0, now)])
+            self.select_all('policy')
+            conn = sqlite3.connect(self.cdb.path)
+            try:
+                # far below commit_interval: not committed right away
+                self.assertEqual([], conn.execute("SELECT * FROM policy").fetchall())
+                time.sleep(0.5)
+                self.assertEqual(1, len(conn.execute("SELECT * FROM policy").fetchall()))
+            finally:
+                conn.close()
+
+    def reload(self):
+        self.run_sql(commit, self.cdb)
+        cdb = ChannelDB(MockNetwork(self.config))
+        self.other_dbs.append(cdb)
+        return cdb
+
+    def test_graph_complete_when_data_loaded_is_set(self):
+        now = int(time.time())
+        self.cdb.add_channel_updates([self.channel_update(0, now), self.channel_update(1, now)])
+        cdb = self.reload()
+        calls = []
+        def on_data_loaded():
+            calls.append('data_loaded')
+            # everything path finding uses is in place
+            self.assertEqual({self.scid}, cdb.get_channels_for_node(self.node1))
+            self.assertEqual({self.scid}, cdb.get_channels_for_node(self.node2))
+            self.assertIsNotNone(cdb.get_policy_for_node(self.scid, self.node1))
+            self.assertIsNotNone(cdb.get_policy_for_node(self.scid, self.node2))
+            self.assertEqual([self.scid], [edge.short_channel_id for edge in cdb.get_edges_to_node(self.node1)])
+            self.assertEqual(1, cdb.num_channels)
+        cdb.data_loaded.set = on_data_loaded
+        count_incomplete_channels = cdb.count_incomplete_channels
+        def on_count():
+            calls.append('count_incomplete_channels')
+            count_incomplete_channels()
+        cdb.count_incomplete_channels = on_count
+        self.run_sql(cdb.load_data)
+        # the statistic does not delay path finding
+        self.assertEqual(['data_loaded', 'count_incomplete_channels'], calls)
+
+    def test_snapshot_used_while_database_unchanged(self):
+        now = int(time.time())
+        self.cdb.add_channel_updates([self.channel_update(0, now), self.channel_update(1, now)])
+        self.cdb.data_loaded.set()
+        self.run_sql(commit, self.cdb)
+        self.cdb.write_snapshot()
+        cdb = self.reload()
+        with mock.patch.object(cdb, '_load_from_database') as load_from_database:
+            self.run_sql(cdb.load_data)
+        load_from_database.assert_not_called()
+        self.assertEqual(self.cdb._channels, cdb._channels)
+        self.assertEqual(self.cdb._policies, cdb._policies)
+        self.assertEqual(self.cdb._channels_for_node, cdb._channels_for_node)
+        self.assertTrue(cdb.data_loaded.is_set())
+
+    def test_snapshot_ignored_once_database_changes(self):
+        now = int(time.time())
+        self.cdb.add_channel_updates([self.channel_update(0, now)])
+        self.cdb.data_loaded.set()
+        self.run_sql(commit, self.cdb)
+        self.cdb.write_snapshot()
+        self.cdb.add_channel_updates([self.channel_update(0, now + 1, fee_base_msat=5)])
+        cdb = self.reload()
+        self.run_sql(cdb.load_data)
+        self.assertEqual(5, cdb.get_policy_for_node(self.scid, self.node1).fee_base_msat)
+
+    def test_snapshot_written_on_clean_shutdown(self):
+        now = int(time.time())
+        self.cdb.add_channel_updates([self.channel_update(0, now)])
+        self.cdb.data_loaded.set()
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        self.cdb.sql_thread.join(timeout=1)
+        # the event loop has stopped, so the new sql thread exits right away
+        cdb = ChannelDB(MockNetwork(self.config))
+        cdb.sql_thread.join(timeout=1)
+        self.assertTrue(cdb._load_snapshot())
+        self.assertEqual(1000, cdb.get_policy_for_node(self.scid, self.node1).fee_base_msat)
+
+    def edges(self, cdb):
+        return {node_id: dict(edges) for node_id, edges in cdb._edges_to_node.items() if edges}
+
+    def assertEdgesRebuilt(self):
+        # the edges updated along the way are those built from scratch
+        edges = self.edges(self.cdb)
+        self.cdb.rebuild_edges()
+        self.assertEqual(self.edges(self.cdb), edges)
+        return edges
+
+    def test_edges_follow_graph_changes(self):
+        now = int(time.time())
+        self.assertEqual({}, self.assertEdgesRebuilt())
+        self.cdb.add_channel_updates([self.channel_update(0, now)])
+        edges = self.assertEdgesRebuilt()
+        edge, = edges[self.node2].values()
+        self.assertEqual((self.scid, self.node1, 1000, 10, 144, 1, None, False), edge)
+        self.assertNotIn(self.node1, edges)
+        self.cdb.add_channel_updates([self.channel_update(1, now)])
+        edges = self.assertEdgesRebuilt()
+        self.assertTrue(edges[self.node2][self.scid].has_end_policy)
+        self.assertEqual(self.node2, edges[self.node1][self.scid].start_node)
+        self.assertEqual([edges[self.node2][self.scid]], list(self.cdb.get_edges_to_node(self.node2)))
+        # disabled directions cannot be used
+        update = self.channel_update(1, now + 1)
+        update['channel_flags'] = b'\x03'
+        self.cdb.add_channel_updates([update])
+        edges = self.assertEdgesRebuilt()
+        self.assertNotIn(self.node1, edges)
+        self.assertIn(self.scid, edges[self.node2])
+        self.cdb.prune_old_policies(0)
+        self.assertEqual({}, self.assertEdgesRebuilt())
+        self.cdb.add_channel_updates([self.channel_update(0, now + 2), self.channel_update(1, now + 2)])
+        self.assertEqual(2, len(self.assertEdgesRebuilt()))
+        self.cdb.remove_channel(self.scid)
+        self.assertEqual({}, self.assertEdgesRebuilt())
+        self.assertEqual((), self.cdb.get_edges_to_node(self.node2))
+
+    def test_count_incomplete_channels_while_graph_changes(self):
+        get_policy_for_node = self.cdb.get_policy_for_node
+        def add_channel(short_channel_id, node_id):
+            # gossip adding a channel from the event loop thread
+            self.cdb._channels[bytes(8) + node_id] = self.cdb._channels[self.scid]
+            return get_policy_for_node(short_channel_id, node_id)
+        self.cdb.get_policy_for_node = add_channel
+        self.cdb.count_incomplete_channels()
+        self.assertEqual(3, len(self.cdb._channels))
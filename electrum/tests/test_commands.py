@@ -1,8 +1,10 @@
 import unittest
+import json
 from unittest import mock
 from decimal import Decimal
 
-from electrum.util import create_and_start_event_loop
+from electrum.util import create_and_start_event_loop, TxMinedInfo
+from electrum.address_synchronizer import HistoryItem
 from electrum.commands import Commands, eval_bool
 from electrum import storage
 from electrum.wallet import restore_wallet_from_text
@@ -127,6 +129,68 @@ class TestCommands(ElectrumTestCase):
         self.assertEqual(['p2wpkh:L15oxP24NMNAXxq5r2aom24pHPtt3Fet8ZutgL155Bad93GSubM2', 'p2wpkh:L4rYY5QpfN6wJEF4SEKDpcGhTPnCe9zcGs6hiSnhpprZqVywFifN'],
                          cmds._run('getprivatekeys', (['bc1q3g5tmkmlvxryhh843v4dz026avatc0zzr6h3af', 'bc1q9pzjpjq4nqx5ycnywekcmycqz0wjp2nq604y2n'], ), wallet=wallet))
 
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_listaddresses_pagination(self, mock_write):
+        wallet = restore_wallet_from_text('bitter grass shiver impose acquire brush forget axis eager alone wine silver',
+                                          gap_limit=5,
+                                          path='if_this_exists_mocking_failed_648151893',
+                                          config=self.config)['wallet']
+        cmds = Commands(config=self.config)
+        all_addresses = cmds._run('listaddresses', (), wallet=wallet)
+        self.assertEqual(wallet.get_addresses(), all_addresses)
+        pages = []
+        after_address = None
+        while True:
+            page = cmds._run('listaddresses', (), limit=3, after_address=after_address, wallet=wallet)
+            if not page:
+                break
+            pages.append(page)
+            after_address = page[-1]
+        self.assertEqual([3, 3, 3, 2], [len(page) for page in pages])
+        self.assertEqual(all_addresses, sum(pages, []))
+        self.assertEqual(all_addresses[:2], cmds._run('listaddresses', (), receiving=True, limit=2, wallet=wallet))
+        with self.assertRaises(Exception):
+            cmds._run('listaddresses', (), after_address='bc1qgfam82qk7uwh5j2xxmcd8cmklpe0zackyj6r23', wallet=wallet)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_onchain_history_pagination(self, mock_write):
+        wallet = restore_wallet_from_text('bitter grass shiver impose acquire brush forget axis eager alone wine silver',
+                                          gap_limit=2,
+                                          path='if_this_exists_mocking_failed_648151893',
+                                          config=self.config)['wallet']
+        history = []
+        balance = 0
+        for i in range(7):
+            delta = 1000 * (i + 1) if i % 3 else -500
+            balance += delta
+            history.append(HistoryItem(txid=f'{i:064x}', tx_mined_status=TxMinedInfo(height=100 + i, conf=10, timestamp=1500000000 + i),
+                                       delta=delta, fee=None, balance=balance))
+        wallet.get_history = lambda domain=None: history
+        cmds = Commands(config=self.config)
+        full = json.loads(cmds._run('onchain_history', (), wallet=wallet))
+        self.assertEqual([item.txid for item in history], [item['txid'] for item in full['transactions']])
+        self.assertNotIn('summary_scope', full)
+        pages = []
+        after_txid = None
+        while True:
+            page = json.loads(cmds._run('onchain_history', (), limit=3, after_txid=after_txid, wallet=wallet))
+            if not page['transactions']:
+                break
+            self.assertEqual('page', page['summary_scope'])
+            pages.append(page)
+            after_txid = page['transactions'][-1]['txid']
+        self.assertEqual([3, 3, 1], [len(page['transactions']) for page in pages])
+        self.assertEqual(full['transactions'], sum([page['transactions'] for page in pages], []))
+        # the summary covers the page only
+        self.assertEqual(full['summary']['end_balance'], pages[-1]['summary']['end_balance'])
+        self.assertEqual(pages[1]['summary']['start_balance'], pages[0]['summary']['end_balance'])
+        self.assertEqual(str(Decimal(11000) / 10**8), pages[1]['summary']['incoming'])
+        # the range filters apply to every page
+        page = json.loads(cmds._run('onchain_history', (), from_height=102, limit=2, wallet=wallet))
+        self.assertEqual([history[2].txid, history[3].txid], [item['txid'] for item in page['transactions']])
+        with self.assertRaises(Exception):
+            cmds._run('onchain_history', (), after_txid='ff' * 32, wallet=wallet)
+
 
 class TestCommandsTestnet(TestCaseForTestnet):
 
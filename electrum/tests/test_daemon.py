@@ -0,0 +1,245 @@
+import asyncio
+import base64
+import json
+import threading
+from unittest import mock
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from electrum.util import create_and_start_event_loop, TxMinedInfo
+from electrum.address_synchronizer import HistoryItem
+from electrum.transaction import PartialTransaction, PartialTxOutput
+from electrum.simple_config import SimpleConfig
+from electrum.commands import Commands
+from electrum.wallet import restore_wallet_from_text
+from electrum import daemon, storage
+from electrum.daemon import Daemon
+
+from . import ElectrumTestCase
+
+
+class MockRequest:
+    def __init__(self, remote, password):
+        self.remote = remote
+        credentials = base64.b64encode(f'user:{password}'.encode('utf8')).decode('ascii')
+        self.headers = {'Authorization': 'Basic ' + credentials}
+
+
+class DaemonTestCase(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path, 'offline': True})
+        self.daemon = Daemon(self.config, listen_jsonrpc=False)
+        self.daemon.rpc_user, self.daemon.rpc_password = 'user', 'secret'
+
+    def tearDown(self):
+        self.run_in_loop(self.daemon.taskgroup.cancel_remaining())
+        self.daemon.command_executor.shutdown(wait=True)
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        super().tearDown()
+
+    def run_in_loop(self, coro, timeout=10):
+        return asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result(timeout=timeout)
+
+
+class TestDaemonAuth(DaemonTestCase):
+
+    def check_auth(self, remote, password):
+        response = self.run_in_loop(self.daemon._check_auth(MockRequest(remote, password)))
+        return 200 if response is None else response.status
+
+    def test_requests_with_bad_credentials_are_rejected(self):
+        async def f():
+            app = web.Application()
+            app.router.add_post('/', self.daemon.handle)
+            app.router.add_post('/stream', self.daemon.handle_stream)
+            statuses = []
+            async with TestClient(TestServer(app)) as client:
+                for path in ('/', '/stream'):
+                    response = await client.post(path, json={'method': 'listaddresses'},
+                                                  auth=aiohttp.BasicAuth('user', 'guess'))
+                    statuses.append(response.status)
+                    response = await client.post(path, json={'method': 'listaddresses'})
+                    statuses.append(response.status)
+            return statuses
+        self.assertEqual([403, 401, 403, 401], self.run_in_loop(f()))
+
+    def test_client_is_throttled_after_failures(self):
+        for i in range(daemon.RPC_AUTH_MAX_FAILURES):
+            self.assertEqual(403, self.check_auth('1.2.3.4', 'guess'))
+        self.assertEqual(429, self.check_auth('1.2.3.4', 'guess'))
+        # even with the right password
+        self.assertEqual(429, self.check_auth('1.2.3.4', 'secret'))
+        # other clients are not affected
+        self.assertEqual(200, self.check_auth('5.6.7.8', 'secret'))
+
+    def test_concurrent_bad_auth_requests_are_throttled(self):
+        async def f():
+            requests = [self.daemon._check_auth(MockRequest('1.2.3.4', f'guess{i}')) for i in range(50)]
+            return [r.status for r in await asyncio.gather(*requests)]
+        statuses = self.run_in_loop(f())
+        self.assertEqual(daemon.RPC_AUTH_MAX_FAILURES, statuses.count(403))
+        self.assertEqual(50 - daemon.RPC_AUTH_MAX_FAILURES, statuses.count(429))
+        self.assertEqual({}, dict(self.daemon._auth_pending))
+        self.assertEqual(429, self.check_auth('1.2.3.4', 'secret'))
+
+    def test_expired_failures_are_pruned(self):
+        self.assertEqual(403, self.check_auth('1.2.3.4', 'guess'))
+        self.assertEqual(403, self.check_auth('5.6.7.8', 'guess'))
+        # make them older than the window
+        for client, (num_failures, last_failure) in list(self.daemon._auth_failures.items()):
+            self.daemon._auth_failures[client] = (num_failures, last_failure - daemon.RPC_AUTH_FAILURE_WINDOW - 1)
+        self.daemon._auth_failures_pruned -= daemon.RPC_AUTH_FAILURE_WINDOW + 1
+        self.assertEqual(403, self.check_auth('9.9.9.9', 'guess'))
+        self.assertEqual(['9.9.9.9'], list(self.daemon._auth_failures))
+
+
+class WalletDaemonTestCase(DaemonTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(storage.WalletStorage, '_write')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.wallet = restore_wallet_from_text('bitter grass shiver impose acquire brush forget axis eager alone wine silver',
+                                               gap_limit=2,
+                                               path='if_this_exists_mocking_failed_648151893',
+                                               config=self.config)['wallet']
+        self.daemon.add_wallet(self.wallet)
+        self.cmds = Commands(config=self.config, daemon=self.daemon)
+
+
+class TestBlockingCommands(WalletDaemonTestCase):
+
+    def run_command(self, name, **kwargs):
+        return self.run_in_loop(getattr(self.cmds, name)(wallet_path=self.wallet.storage.path, **kwargs))
+
+    def test_commands_run_in_executor(self):
+        threads = set()
+        get_addresses = self.wallet.get_addresses
+        def f():
+            threads.add(threading.current_thread().name)
+            return get_addresses()
+        with mock.patch.object(self.wallet, 'get_addresses', f):
+            self.assertEqual(get_addresses(), self.run_command('listaddresses'))
+            self.assertEqual(get_addresses()[:2], self.run_command('listaddresses', limit=2))
+        self.assertEqual([], self.run_command('listunspent'))
+        self.assertEqual({'confirmed': '0'}, self.run_command('getbalance'))
+        self.assertEqual([], self.run_command('list_requests'))
+        self.assertEqual([], json.loads(self.run_command('onchain_history'))['transactions'])
+        self.assertTrue(threads)
+        self.assertTrue(all(name.startswith('Command') for name in threads))
+
+    def test_transactions_are_built_and_signed_in_executor(self):
+        threads = []
+        def make_unsigned_transaction(**kwargs):
+            threads.append(threading.current_thread().name)
+            return PartialTransaction.from_io([], [PartialTxOutput.from_address_and_value(address, 1000)])
+        def sign_transaction(tx, password):
+            threads.append(threading.current_thread().name)
+        address = self.wallet.get_receiving_address()
+        with mock.patch.object(self.wallet, 'make_unsigned_transaction', make_unsigned_transaction), \
+                mock.patch.object(self.wallet, 'sign_transaction', sign_transaction):
+            tx = self.run_command('payto', destination=address, amount='0.00001')
+            self.run_command('paytomany', outputs=[(address, '0.00001')], unsigned=True)
+            self.run_command('signtransaction', tx=tx)
+        self.assertEqual(4, len(threads))
+        self.assertTrue(all(name.startswith('Command') for name in threads))
+
+    def test_stop_wallet_drops_lock(self):
+        self.assertEqual([], self.run_command('listunspent'))
+        self.assertIn(self.wallet.storage.path, self.daemon._command_locks)
+        self.assertTrue(self.daemon.stop_wallet(self.wallet.storage.path))
+        self.assertNotIn(self.wallet.storage.path, self.daemon._command_locks)
+
+    def test_per_wallet_lock(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def f(name):
+            calls.append(name)
+            started.set()
+            release.wait(5)
+            return name
+        async def run_both():
+            first = asyncio.ensure_future(self.daemon.run_blocking_command(lambda: f('first'), wallet=self.wallet))
+            second = asyncio.ensure_future(self.daemon.run_blocking_command(lambda: f('second'), wallet=self.wallet))
+            other = asyncio.ensure_future(self.daemon.run_blocking_command(lambda: 'other', wallet=None))
+            # calls without a wallet are not serialized
+            self.assertEqual('other', await other)
+            await asyncio.sleep(0.1)
+            self.assertEqual(['first'], calls)
+            release.set()
+            return await asyncio.gather(first, second)
+        self.assertEqual(['first', 'second'], self.run_in_loop(run_both()))
+        self.assertTrue(started.is_set())
+        self.assertEqual(['first', 'second'], calls)
+
+
+class TestStream(WalletDaemonTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.daemon.cmd_runner = self.cmds
+        history = []
+        for i in range(5):
+            history.append(HistoryItem(txid=f'{i:064x}', tx_mined_status=TxMinedInfo(height=100 + i, conf=10, timestamp=1500000000 + i),
+                                       delta=1000, fee=None, balance=1000 * (i + 1)))
+        self.history = history
+        self.wallet.get_history = lambda domain=None: history
+
+    def stream(self, body):
+        """Returns the status and the lines of the response."""
+        body['params'] = dict(body.get('params', {}), wallet_path=self.wallet.storage.path)
+        async def f():
+            app = web.Application()
+            app.router.add_post('/stream', self.daemon.handle_stream)
+            async with TestClient(TestServer(app)) as client:
+                response = await client.post('/stream', json=body, auth=aiohttp.BasicAuth('user', 'secret'))
+                text = (await response.read()).decode('utf8')
+                return response.status, [json.loads(line) for line in text.splitlines()]
+        return self.run_in_loop(f())
+
+    def test_items_are_streamed_in_chunks(self):
+        writes = []
+        write = web.StreamResponse.write
+        async def record_write(response, data):
+            writes.append(data.count(b'\n'))
+            await write(response, data)
+        with mock.patch.object(daemon, 'STREAM_CHUNK_SIZE', 2), \
+                mock.patch.object(web.StreamResponse, 'write', record_write):
+            status, lines = self.stream({'method': 'onchain_history', 'params': {'from_height': 101}})
+        self.assertEqual(200, status)
+        self.assertEqual([item.txid for item in self.history[1:]], [line['txid'] for line in lines])
+        self.assertEqual([2, 2], writes)
+
+    def test_limit_and_cursor(self):
+        status, lines = self.stream({'method': 'onchain_history',
+                                     'params': {'limit': 2, 'after_txid': self.history[0].txid}})
+        self.assertEqual(200, status)
+        self.assertEqual([self.history[1].txid, self.history[2].txid], [line['txid'] for line in lines])
+        status, lines = self.stream({'method': 'listaddresses', 'params': {'limit': 3}})
+        self.assertEqual(self.wallet.get_addresses()[:3], lines)
+
+    def test_errors(self):
+        status, lines = self.stream({'method': 'getbalance'})
+        self.assertEqual(400, status)
+        self.assertEqual([{'error': 'command cannot be streamed: getbalance'}], lines)
+        # the first chunk is computed before the response is started
+        status, lines = self.stream({'method': 'onchain_history', 'params': {'after_txid': 'ff' * 32}})
+        self.assertEqual(400, status)
+        self.assertEqual([{'error': f'transaction not in history: {"ff" * 32}'}], lines)
+        # later errors end the stream with an error line
+        def iter_addresses(wallet):
+            yield from wallet.get_addresses()[:2]
+            raise Exception('wallet closed')
+        with mock.patch.object(daemon, 'STREAM_CHUNK_SIZE', 2), \
+                mock.patch.object(self.cmds, '_iter_addresses', iter_addresses):
+            status, lines = self.stream({'method': 'listaddresses'})
+        self.assertEqual(200, status)
+        self.assertEqual(self.wallet.get_addresses()[:2] + [{'error': 'wallet closed'}], lines)
@@ -20,7 +20,9 @@
 # THE SOFTWARE.
 
 import unittest
+from unittest import mock
 import os
+import copy
 import binascii
 from pprint import pformat
 import logging
@@ -165,6 +167,79 @@ def create_test_channels(feerate=6000, local=None, remote=None):
 
     return alice, bob
 
+class TestCommitmentCache(ElectrumTestCase):
+
+    def test_ctx_is_rebuilt_only_when_state_changes(self):
+        built = []
+        class FakeCommitment:
+            def __init__(self, *args, **kwargs):
+                self.args = args
+                built.append(self)
+            def outputs(self):
+                return []
+        with mock.patch.object(lnchannel, 'make_commitment', FakeCommitment), \
+                mock.patch.object(lnchannel, 'sign_and_get_sig_string', lambda *args: bytes(64)):
+            alice, bob = create_test_channels()
+            ctx1 = alice.get_latest_commitment(LOCAL)
+            alice.get_latest_commitment(REMOTE)
+            alice.get_next_commitment(REMOTE)
+            num_built = len(built)
+            ctx2 = alice.get_latest_commitment(LOCAL)
+            alice.get_latest_commitment(REMOTE)
+            alice.get_next_commitment(REMOTE)
+            self.assertEqual(num_built, len(built))
+            # callers get their own copy
+            self.assertIsNot(ctx1, ctx2)
+            self.assertEqual(ctx1.args, ctx2.args)
+            # a new htlc changes the next remote ctx only
+            alice.add_htlc({
+                'payment_hash': bitcoin.sha256(b'\x42' * 32),
+                'amount_msat': 1000 * 1000,
+                'cltv_expiry': 5,
+                'timestamp': 0,
+            })
+            alice.get_latest_commitment(REMOTE)
+            self.assertEqual(num_built, len(built))
+            alice.get_next_commitment(REMOTE)
+            self.assertEqual(num_built + 1, len(built))
+            alice.get_next_commitment(REMOTE)
+            self.assertEqual(num_built + 1, len(built))
+            # so does a fee update
+            alice.update_fee(12000, True)
+            alice.get_next_commitment(REMOTE)
+            self.assertEqual(num_built + 2, len(built))
+            self.assertEqual(ctx1.args, alice.get_latest_commitment(LOCAL).args)
+            self.assertEqual(num_built + 2, len(built))
+
+    def test_cached_ctx_and_signatures_match_uncached(self):
+        alice, bob = create_test_channels()
+        htlc_dict = {
+            'payment_hash': bitcoin.sha256(b'\x42' * 32),
+            'amount_msat': one_bitcoin_in_msat,
+            'cltv_expiry': 5,
+            'timestamp': 0,
+        }
+        alice.add_htlc(htlc_dict)
+        bob.receive_htlc(htlc_dict)
+        ctn = alice.get_next_ctn(REMOTE)
+        cached = alice.get_next_commitment(REMOTE)
+        self.assertEqual(cached.serialize(), alice.get_next_commitment(REMOTE).serialize())
+        alice._commitment_cache.clear()
+        uncached = alice.get_next_commitment(REMOTE)
+        self.assertEqual(uncached.serialize(), cached.serialize())
+        # the signatures are those of the uncached ctx, and bob accepts them
+        expected_sigs = alice._sign_commitment(uncached, ctn)
+        hm = copy.deepcopy(alice.hm)
+        sig, htlc_sigs = alice.sign_next_commitment()
+        self.assertEqual(expected_sigs, (sig, htlc_sigs))
+        self.assertEqual(1, len(htlc_sigs))
+        bob.receive_new_commitment(sig, htlc_sigs)
+        # signing the same ctx again, e.g. after a reconnection, reuses them
+        alice.hm = hm
+        with mock.patch.object(alice, '_sign_commitment', wraps=alice._sign_commitment) as sign_commitment:
+            self.assertEqual(expected_sigs, alice.sign_next_commitment())
+        sign_commitment.assert_not_called()
+
 class TestFee(ElectrumTestCase):
     """
     test
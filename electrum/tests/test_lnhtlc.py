@@ -1,8 +1,9 @@
 from pprint import pprint
+import random
 import unittest
 from typing import NamedTuple
 
-from electrum.lnutil import RECEIVED, LOCAL, REMOTE, SENT, HTLCOwner, Direction
+from electrum.lnutil import RECEIVED, LOCAL, REMOTE, SENT, HTLCOwner, Direction, UpdateAddHtlc
 from electrum.lnhtlc import HTLCManager
 
 from . import ElectrumTestCase
@@ -12,6 +13,20 @@ class H(NamedTuple):
     owner : str
     htlc_id : int
 
+def htlcs_by_direction_full_scan(hm: HTLCManager, subject, direction, ctn):
+    party = subject if direction == SENT else subject.inverted()
+    settles = hm.log[party]['settles']
+    fails = hm.log[party]['fails']
+    d = {}
+    for htlc_id, ctns in hm.log[party]['locked_in'].items():
+        if ctns[subject] is not None and ctns[subject] <= ctn:
+            not_settled = htlc_id not in settles or settles[htlc_id][subject] is None or settles[htlc_id][subject] > ctn
+            not_failed = htlc_id not in fails or fails[htlc_id][subject] is None or fails[htlc_id][subject] > ctn
+            if not_settled and not_failed:
+                d[htlc_id] = hm.log[party]['adds'][htlc_id]
+    return d
+
+
 class TestHTLCManager(ElectrumTestCase):
     def test_adding_htlcs_race(self):
         A = HTLCManager()
@@ -246,3 +261,74 @@ class TestHTLCManager(ElectrumTestCase):
         B.send_rev()
         A.recv_rev()
         self.assertEqual({2: [b"upd_msg2"]}, A.get_unacked_local_updates())
+
+    def test_queries_match_full_scan(self):
+        rand = random.Random(0)
+        A = HTLCManager()
+        B = HTLCManager()
+        A.channel_open_finished()
+        B.channel_open_finished()
+        peers = {'A': (A, B), 'B': (B, A)}
+
+        def check(hm: HTLCManager):
+            for subject in (LOCAL, REMOTE):
+                for ctn in range(hm.ctn_latest(subject) + 2):
+                    for direction in (SENT, RECEIVED):
+                        self.assertEqual(htlcs_by_direction_full_scan(hm, subject, direction, ctn),
+                                         hm.htlcs_by_direction(subject, direction, ctn))
+                        self.assertEqual(sum(x.amount_msat for x in hm.all_settled_htlcs_ever_by_direction(subject, direction, ctn)),
+                                         hm.get_settled_msat(subject, direction, ctn))
+            for ctn in range(hm.ctn_latest(LOCAL) + 2):
+                for party, method in ((REMOTE, hm.received_in_ctn), (LOCAL, hm.sent_in_ctn)):
+                    expected = [hm.log[party]['adds'][htlc_id]
+                                for htlc_id, ctns in hm.log[party]['settles'].items() if ctns[LOCAL] == ctn]
+                    self.assertEqual(sorted(expected), sorted(method(ctn)))
+
+        for i in range(600):
+            name = rand.choice('AB')
+            X, Y = peers[name]
+            action = rand.choice(['add', 'remove', 'remove', 'sign', 'revoke', 'reload'])
+            if action == 'add':
+                htlc = UpdateAddHtlc(amount_msat=rand.randint(1, 10**6), payment_hash=bytes(32),
+                                     cltv_expiry=1, htlc_id=X.get_next_htlc_id(LOCAL), timestamp=0)
+                Y.recv_htlc(X.send_htlc(htlc))
+            elif action == 'remove':
+                # X removes an htlc it received, once it is irrevocably committed
+                ctn = X.ctn_oldest_unrevoked(LOCAL)
+                committed = [htlc_id for htlc_id in htlcs_by_direction_full_scan(X, LOCAL, RECEIVED, ctn)
+                             if htlc_id in X.htlcs_by_direction(REMOTE, SENT, X.ctn_oldest_unrevoked(REMOTE))
+                             and htlc_id not in X.log[REMOTE]['settles'] and htlc_id not in X.log[REMOTE]['fails']]
+                if not committed:
+                    continue
+                htlc_id = rand.choice(committed)
+                if rand.random() < 0.7:
+                    X.send_settle(htlc_id)
+                    Y.recv_settle(htlc_id)
+                else:
+                    X.send_fail(htlc_id)
+                    Y.recv_fail(htlc_id)
+            elif action == 'sign':
+                if X.is_revack_pending(REMOTE):
+                    continue
+                X.send_ctx()
+                Y.recv_ctx()
+            elif action == 'revoke':
+                if not X.is_revack_pending(LOCAL):
+                    continue
+                X.send_rev()
+                Y.recv_rev()
+            elif action == 'reload':
+                X = HTLCManager(log=X.to_save())
+                peers[name] = (X, Y)
+                other = 'B' if name == 'A' else 'A'
+                peers[other] = (Y, X)
+            check(X)
+            check(Y)
+        # the index only holds the htlcs still in flight
+        A = peers['A'][0]
+        self.assertGreater(len(A.log[LOCAL]['adds']), 50)
+        removals = {**A.log[LOCAL]['settles'], **A.log[LOCAL]['fails']}
+        in_flight = [htlc_id for htlc_id in A.log[LOCAL]['adds']
+                     if htlc_id not in removals or removals[htlc_id][LOCAL] is None
+                     or removals[htlc_id][LOCAL] >= A.ctn_oldest_unrevoked(LOCAL)]
+        self.assertEqual(in_flight, list(A._active_htlc_ids[LOCAL][LOCAL]))
@@ -7,6 +7,7 @@ from collections import defaultdict
 import logging
 import concurrent
 from concurrent import futures
+from unittest import mock
 
 from electrum.network import Network
 from electrum.ecc import ECPrivkey
@@ -131,8 +132,10 @@ class MockLNWallet:
     save_preimage = LNWallet.save_preimage
     get_preimage = LNWallet.get_preimage
     _create_route_from_invoice = LNWallet._create_route_from_invoice
+    _create_routes_from_invoice = LNWallet._create_routes_from_invoice
     _check_invoice = staticmethod(LNWallet._check_invoice)
     _pay_to_route = LNWallet._pay_to_route
+    _handle_failed_htlc = LNWallet._handle_failed_htlc
     force_close_channel = LNWallet.force_close_channel
     get_first_timestamp = lambda self: 0
 
@@ -263,5 +266,48 @@ class TestPeer(ElectrumTestCase):
         with self.assertRaises(PaymentFailure):
             run(f())
 
+class MockLNGossip:
+    def __init__(self):
+        self.node_keypair = keypair()
+        self.localfeatures = LnLocalFeatures(0)
+        self.network = MockNetwork(tx_queue=None)
+
+class TestPeerGossip(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+
+    def tearDown(self):
+        super().tearDown()
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+
+    def test_message_loop_waits_for_gossip_queue(self):
+        t1, t2 = transport_pair('alice', 'bob')
+        p1 = Peer(MockLNGossip(), keypair().pubkey, t1)
+        async def initialize():
+            p1._sent_init = p1._received_init = True
+        p1.initialize = initialize
+        p1.process_message = lambda msg: p1.gossip_queue.put_nowait(msg)
+        for i in range(10):
+            p1.transport.queue.put_nowait(b'gossip %d' % i)
+        async def f():
+            task = asyncio.ensure_future(p1._message_loop())
+            try:
+                await asyncio.sleep(0.5)
+                # reading stops while the gossip queue is full
+                self.assertEqual(3, p1.gossip_queue.qsize())
+                self.assertEqual(7, p1.transport.queue.qsize())
+                while not p1.gossip_queue.empty():
+                    p1.gossip_queue.get_nowait()
+                await asyncio.sleep(1.5)
+                self.assertEqual(3, p1.gossip_queue.qsize())
+                self.assertEqual(4, p1.transport.queue.qsize())
+            finally:
+                task.cancel()
+        with mock.patch('electrum.lnpeer.GOSSIP_QUEUE_MAX_SIZE', 3):
+            run(f())
+
 def run(coro):
     return asyncio.run_coroutine_threadsafe(coro, loop=asyncio.get_event_loop()).result()
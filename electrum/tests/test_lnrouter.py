@@ -2,6 +2,7 @@ import unittest
 import tempfile
 import shutil
 import asyncio
+import time
 
 from electrum.util import bh2u, bfh, create_and_start_event_loop
 from electrum.lnonion import (OnionHopsDataSingle, new_onion_packet, OnionPerHop,
@@ -105,6 +106,23 @@ class Test_LNRouter(TestCaseForTestnet):
         self.assertEqual(route[0].node_id, start_node)
         self.assertEqual(route[0].short_channel_id, bfh('0000000000000003'))
 
+        # apart from the first hop, paths do not share channels
+        node_a, node_e = b'\x02aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa', b'\x02eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee'
+        paths = path_finder.find_paths_for_payment(node_a, node_e, 100000, num_paths=3)
+        self.assertEqual([path, [(b'\x02bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb', bfh('0000000000000003')),
+                                 (node_e, bfh('0000000000000002'))]], paths)
+        # cached paths are returned while they are usable
+        path_finder.add_to_blacklist(bfh('0000000000000004'))
+        self.assertEqual(paths[1:], path_finder.find_paths_for_payment(node_a, node_e, 100000, num_paths=3))
+        self.assertEqual(paths[1], path_finder.find_path_for_payment(node_a, node_e, 100000))
+        # failures are forgotten over time
+        now = time.time()
+        self.assertAlmostEqual(1, path_finder.get_failure_score(bfh('0000000000000004'), now), places=2)
+        self.assertAlmostEqual(0.5, path_finder.get_failure_score(bfh('0000000000000004'), now + 600), places=2)
+        self.assertEqual(0, path_finder.get_failure_score(bfh('0000000000000004'), now + 6000))
+        self.assertEqual(0, path_finder.get_failure_score(bfh('0000000000000004'), now))
+        self.assertEqual(path, path_finder.find_path_for_payment(node_a, node_e, 100000))
+
         # need to duplicate tear_down here, as we also need to wait for the sql thread to stop
         self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
         self._loop_thread.join(timeout=1)
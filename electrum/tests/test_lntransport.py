@@ -1,7 +1,7 @@
 import asyncio
 
 from electrum.ecc import ECPrivkey
-from electrum.lnutil import LNPeerAddr
+from electrum.lnutil import LNPeerAddr, LightningPeerConnectionClosed
 from electrum.lntransport import LNResponderTransport, LNTransport
 
 from . import ElectrumTestCase
@@ -62,3 +62,33 @@ class TestLNTransport(ElectrumTestCase):
         connect_future = asyncio.ensure_future(connect())
         loop.run_until_complete(responder_shaked.wait())
         loop.run_until_complete(server_shaked.wait())
+
+    def test_read_messages_burst(self):
+        # more than 500 messages, so that the keys are rotated, sent in one go
+        msgs = [bytes([i % 256]) * (i % 300) for i in range(1200)] + [b'\x01' * 65535]
+        loop = asyncio.get_event_loop()
+        responder_key = ECPrivkey.generate_random_key()
+        initiator_key = ECPrivkey.generate_random_key()
+        received = []
+        async def cb(reader, writer):
+            t = LNResponderTransport(responder_key.get_secret_bytes(), reader, writer)
+            await t.handshake()
+            async for msg in t.read_messages():
+                received.append(msg)
+                if len(received) == len(msgs):
+                    break
+            t.close()
+        server = loop.run_until_complete(asyncio.start_server(cb, '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+        async def connect():
+            peer_addr = LNPeerAddr('127.0.0.1', port, responder_key.get_public_key_bytes())
+            t = LNTransport(initiator_key.get_secret_bytes(), peer_addr)
+            await t.handshake()
+            for msg in msgs:
+                t.send_bytes(msg)
+            await t.writer.drain()
+            with self.assertRaises(LightningPeerConnectionClosed):
+                await t.read_messages().__anext__()
+        loop.run_until_complete(asyncio.wait_for(connect(), 10))
+        server.close()
+        self.assertEqual(msgs, received)
@@ -0,0 +1,192 @@
+import os
+import asyncio
+import sqlite3
+
+from electrum.util import create_and_start_event_loop, TxMinedInfo
+from electrum.lnwatcher import SweepStore, LNWatcher, WatchTower, DEEP_CONFIRMATIONS
+from electrum.simple_config import SimpleConfig
+from electrum.transaction import Transaction
+
+from . import ElectrumTestCase
+
+
+class TestSweepStore(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        class fake_network:
+            asyncio_loop = self.asyncio_loop
+        self.store = SweepStore(os.path.join(self.electrum_path, 'watchtower_db'), fake_network())
+
+    def tearDown(self):
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        self.store.sql_thread.join(timeout=1)
+        super().tearDown()
+
+    def run_in_loop(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result(timeout=5)
+
+    def test_add_sweep_txs(self):
+        outpoint = '00' * 32 + ':0'
+        async def f():
+            self.assertEqual(0, await self.store.get_ctn(outpoint, 'address'))
+            await self.store.add_sweep_tx(outpoint, 1, 'aa' * 32 + ':0', '01')
+            await self.store.add_sweep_txs(outpoint, [(2, 'bb' * 32 + ':0', '02'), (2, 'bb' * 32 + ':1', '03'),
+                                                      (3, 'cc' * 32 + ':0', '04')])
+            self.assertEqual(3, await self.store.get_ctn(outpoint, 'address'))
+            self.assertEqual(4, await self.store.get_num_tx(outpoint))
+            txs = await self.store.get_sweep_tx(outpoint, 'bb' * 32 + ':1')
+            self.assertEqual(['03'], [tx.serialize() for tx in txs])
+            # a batch that sqlite rejects halfway is not stored at all
+            with self.assertRaises(sqlite3.Error):
+                await self.store.add_sweep_txs(outpoint, [(4, 'dd' * 32 + ':0', '05'), (4, object(), '06')])
+            self.assertEqual(4, await self.store.get_num_tx(outpoint))
+            self.assertEqual([(outpoint, 'address')], await self.store.list_channels())
+        self.run_in_loop(f())
+
+
+# spends 7740319cdde2a72401347c4d7d5719633024dc11afd6ce84f884dfd2311a2318:0
+spending_tx = '010000000118231a31d2df84f884ced6af11dc24306319577d4d7c340124a7e2dd9c314077000000004847304402200b6c45891aed48937241907bc3e3868ee4c792819821fcde33311e5a3da4789a02205021b59692b652a01f5f009bd481acac2f647a7d9c076d71d85869763337882e01fdffffff016c95052a010000001976a9149c4891e7791da9e622532c97f43863768264faaf88ac00000000'
+# unrelated to the channels, plays the role of a penalty tx
+penalty_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+
+
+class MockNetwork:
+    def __init__(self, config):
+        self.config = config
+        self.height = 1000
+        self.callbacks = []
+        self.broadcast_attempts = 0
+        self.broadcast_fails = False
+
+    def register_callback(self, callback, events):
+        pass
+
+    def trigger_callback(self, event, *args):
+        self.callbacks.append((event, args[0]))
+
+    def notify(self, key):
+        pass
+
+    def get_local_height(self):
+        return self.height
+
+    async def broadcast_transaction(self, tx):
+        self.broadcast_attempts += 1
+        if self.broadcast_fails:
+            raise Exception('server disconnected')
+        return tx.txid()
+
+
+class MockSynchronizer:
+    def add(self, address):
+        pass
+
+
+class TestLNWatcher(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.network = MockNetwork(SimpleConfig({'electrum_path': self.electrum_path}))
+        self.tx = Transaction(spending_tx)
+        self.funding_outpoint = self.tx.inputs()[0].prevout.to_str()
+        self.other_outpoints = [f'{i:064x}:0' for i in range(1, 4)]
+
+    def create_watcher(self, cls):
+        watcher = cls(self.network)
+        watcher.synchronizer = MockSynchronizer()
+        watcher.add_channel(self.funding_outpoint, self.tx.outputs()[0].address)
+        for outpoint in self.other_outpoints:
+            watcher.add_channel(outpoint, self.tx.outputs()[0].address)
+        return watcher
+
+    def checked_channels(self, watcher, event='blockchain_updated'):
+        self.network.callbacks.clear()
+        watcher.up_to_date = True
+        asyncio.get_event_loop().run_until_complete(watcher.on_network_update(event))
+        return sorted(outpoint for event, outpoint in self.network.callbacks)
+
+    def test_only_affected_channels_are_checked(self):
+        watcher = self.create_watcher(LNWatcher)
+        all_outpoints = sorted([self.funding_outpoint] + self.other_outpoints)
+        self.assertEqual(all_outpoints, self.checked_channels(watcher))
+        self.assertEqual([], self.checked_channels(watcher, 'fee'))
+        # open channels are looked at once per block
+        self.network.height += 1
+        self.assertEqual(all_outpoints, self.checked_channels(watcher))
+        self.assertEqual([], self.checked_channels(watcher))
+        # the funding outpoint gets spent
+        watcher.add_transaction(self.tx, allow_unrelated=True)
+        self.assertEqual([self.funding_outpoint], self.checked_channels(watcher))
+        self.assertEqual('closed (0)', watcher.get_channel_status(self.funding_outpoint))
+        self.network.height += 1
+        self.assertEqual(self.other_outpoints, self.checked_channels(watcher))
+        # the closing tx gets mined, and is watched until it is deep
+        watcher.add_verified_tx(self.tx.txid(), TxMinedInfo(height=self.network.height, conf=1,
+                                                             timestamp=0, txpos=0, header_hash='00' * 32))
+        self.assertEqual([self.funding_outpoint], self.checked_channels(watcher))
+        self.network.height += DEEP_CONFIRMATIONS - 1
+        self.assertEqual(self.other_outpoints, self.checked_channels(watcher))
+        self.network.height += 1
+        self.assertEqual(all_outpoints, self.checked_channels(watcher))
+        self.assertEqual('closed (deep)', watcher.get_channel_status(self.funding_outpoint))
+        self.network.height += 1
+        self.assertEqual(self.other_outpoints, self.checked_channels(watcher))
+        # timers requested for csv/cltv
+        watcher.schedule_check(self.tx.txid(), self.network.height + 10)
+        self.network.height += 10
+        self.assertEqual(all_outpoints, self.checked_channels(watcher))
+
+    def test_channels_not_checked_are_kept_dirty(self):
+        watcher = self.create_watcher(LNWatcher)
+        all_outpoints = sorted([self.funding_outpoint] + self.other_outpoints)
+        check_onchain_situation = watcher.check_onchain_situation
+        checked = []
+        async def fail_once(address, funding_outpoint):
+            if not checked:
+                checked.append(funding_outpoint)
+                raise Exception('server disconnected')
+            await check_onchain_situation(address, funding_outpoint)
+        watcher.check_onchain_situation = fail_once
+        with self.assertRaises(Exception):
+            self.checked_channels(watcher)
+        # the failing channel and the ones after it are checked at the next update
+        self.assertEqual(all_outpoints, self.checked_channels(watcher, 'fee'))
+        self.assertEqual([], self.checked_channels(watcher, 'fee'))
+
+    def test_watchtower_ignores_blocks(self):
+        class MockWatchTower(LNWatcher):
+            CHECK_OPEN_CHANNELS_ON_NEW_BLOCK = WatchTower.CHECK_OPEN_CHANNELS_ON_NEW_BLOCK
+        watcher = self.create_watcher(MockWatchTower)
+        self.assertEqual(4, len(self.checked_channels(watcher)))
+        self.network.height += 1
+        self.assertEqual([], self.checked_channels(watcher))
+        watcher.add_transaction(self.tx, allow_unrelated=True)
+        self.assertEqual([self.funding_outpoint], self.checked_channels(watcher))
+
+    def test_failed_broadcast_is_retried_at_next_block(self):
+        class MockWatchTower(WatchTower):
+            def __init__(self, network):
+                # no sweepstore
+                LNWatcher.__init__(self, network)
+                self.tx_progress = {}
+            async def do_breach_remedy(self, funding_outpoint, spenders):
+                await self.broadcast_or_log(funding_outpoint, Transaction(penalty_tx))
+        watcher = self.create_watcher(MockWatchTower)
+        self.checked_channels(watcher)
+        self.network.broadcast_fails = True
+        watcher.add_transaction(self.tx, allow_unrelated=True)
+        self.assertEqual([self.funding_outpoint], self.checked_channels(watcher))
+        self.assertEqual(1, self.network.broadcast_attempts)
+        self.assertEqual([], self.checked_channels(watcher, 'fee'))
+        # the penalty tx is broadcast again at the next block
+        self.network.broadcast_fails = False
+        self.network.height += 1
+        self.assertEqual([self.funding_outpoint], self.checked_channels(watcher))
+        self.assertEqual(2, self.network.broadcast_attempts)
+        # and not anymore once it went through
+        self.network.height += 1
+        self.assertEqual([], self.checked_channels(watcher))
+        self.assertEqual(2, self.network.broadcast_attempts)
@@ -0,0 +1,276 @@
+import asyncio
+import random
+import threading
+from collections import defaultdict
+from decimal import Decimal
+from unittest import mock
+
+from electrum.json_db import JsonDB
+from electrum.lnhtlc import HTLCManager
+from electrum.lnutil import (UpdateAddHtlc, SENT, RECEIVED, UnknownPaymentHash, ShortChannelID,
+                             PaymentAttemptFailureDetails)
+from electrum.lnrouter import RouteEdge
+from electrum.lnworker import LNWallet
+from electrum.util import bh2u
+
+from . import ElectrumTestCase
+
+
+class MockStorage:
+    def __init__(self):
+        self.db = JsonDB('', manual_upgrades=False)
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+
+class MockWallet:
+    def get_label(self, key):
+        return 'label ' + key[:4]
+
+
+class MockLNWallet:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.storage = MockStorage()
+        self.wallet = MockWallet()
+        self.channels = {}
+        self.channel_timestamps = {}
+        self.payment_ledger = {}
+        self.ledger_marks = {}
+        self._history_index = []
+        self._history_balances = []
+
+    def get_payment_info(self, payment_hash):
+        raise UnknownPaymentHash(payment_hash)
+
+    _init_history_index = LNWallet._init_history_index
+    _history_sort_key = staticmethod(LNWallet._history_sort_key)
+    _update_history_balances = LNWallet._update_history_balances
+    _put_ledger_item = LNWallet._put_ledger_item
+    _add_htlc_to_ledger = LNWallet._add_htlc_to_ledger
+    _add_channel_payments_to_ledger = LNWallet._add_channel_payments_to_ledger
+    _add_channel_events_to_ledger = LNWallet._add_channel_events_to_ledger
+    _get_history_item = LNWallet._get_history_item
+    iter_history = LNWallet.iter_history
+    get_history = LNWallet.get_history
+
+
+def full_history(ledger: dict):
+    """how the history used to be computed: everything, on every call"""
+    out = sorted(ledger.items(), key=lambda x: (x[1]['timestamp'] or float("inf"), x[0]))
+    balance_msat = 0
+    result = []
+    for key, item in out:
+        balance_msat += item['amount_msat']
+        result.append((key, item['amount_msat'], balance_msat))
+    return result
+
+
+class TestPaymentLedger(ElectrumTestCase):
+
+    def test_history_index(self):
+        rand = random.Random(0)
+        lnworker = MockLNWallet()
+        payment_hashes = [bytes([i]) * 32 for i in range(30)]
+        for i in range(100):
+            payment_hash = rand.choice(payment_hashes)
+            htlc = UpdateAddHtlc(amount_msat=rand.randrange(1, 10**6), payment_hash=payment_hash, cltv_expiry=5,
+                                 htlc_id=rand.randrange(5), timestamp=rand.randrange(1000))
+            lnworker._add_htlc_to_ledger(rand.choice([b'\x01' * 32, b'\x02' * 32]), htlc, rand.choice([SENT, RECEIVED]))
+            history = lnworker.get_history()
+            self.assertEqual(full_history(lnworker.payment_ledger),
+                             [(x['payment_hash'], x['amount_msat'], x['balance_msat']) for x in history])
+        # pages
+        history = lnworker.get_history()
+        self.assertEqual(history[:7], lnworker.get_history(limit=7))
+        self.assertEqual(history[8:13], lnworker.get_history(limit=5, after_key=history[7]['payment_hash']))
+        self.assertEqual([], lnworker.get_history(after_key=history[-1]['payment_hash']))
+        # the ledger is saved, and the index can be rebuilt from it
+        ledger = lnworker.storage.db.get('lightning_payment_ledger')
+        self.assertEqual(lnworker.payment_ledger, ledger)
+        lnworker2 = MockLNWallet()
+        lnworker2.payment_ledger = ledger
+        lnworker2._init_history_index()
+        self.assertEqual(history, lnworker2.get_history())
+
+    def test_forwarding(self):
+        lnworker = MockLNWallet()
+        payment_hash = bytes(32)
+        lnworker._add_htlc_to_ledger(b'\x01' * 32, UpdateAddHtlc(1000, payment_hash, 5, 0, 20), RECEIVED)
+        lnworker._add_htlc_to_ledger(b'\x01' * 32, UpdateAddHtlc(1000, payment_hash, 5, 0, 20), RECEIVED)
+        item, = lnworker.get_history()
+        self.assertEqual('received', item['direction'])
+        self.assertEqual(1000, item['balance_msat'])
+        lnworker._add_htlc_to_ledger(b'\x02' * 32, UpdateAddHtlc(900, payment_hash, 5, 3, 10), SENT)
+        item, = lnworker.get_history()
+        self.assertEqual('forwarding', item['direction'])
+        self.assertEqual(100, item['amount_msat'])
+        self.assertEqual(10, item['timestamp'])
+
+
+class MockLedgerChannel:
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.hm = HTLCManager()
+
+
+class TestLedgerMarks(ElectrumTestCase):
+
+    def htlc(self, htlc_id):
+        return UpdateAddHtlc(amount_msat=1000 * (htlc_id + 1), payment_hash=bytes([htlc_id]) * 32,
+                             cltv_expiry=5, htlc_id=htlc_id, timestamp=100 + htlc_id)
+
+    def restart(self, lnworker, chan):
+        """Builds the history index again, from what was saved."""
+        lnworker2 = MockLNWallet()
+        lnworker2.storage = lnworker.storage
+        lnworker2.payment_ledger = lnworker.storage.db.get('lightning_payment_ledger', {})
+        lnworker2.ledger_marks = lnworker.storage.db.get('lightning_ledger_marks', {})
+        lnworker2.channels = {chan.channel_id: chan}
+        replayed = []
+        add_htlc_to_ledger = lnworker2._add_htlc_to_ledger
+        def record(chan_id, htlc, direction, **kwargs):
+            replayed.append(htlc.htlc_id)
+            add_htlc_to_ledger(chan_id, htlc, direction, **kwargs)
+        lnworker2._add_htlc_to_ledger = record
+        lnworker2._init_history_index()
+        return lnworker2, replayed
+
+    def test_only_htlcs_after_the_marks_are_replayed(self):
+        chan = MockLedgerChannel(b'\x01' * 32)
+        for i in range(3):
+            chan.hm.send_htlc(self.htlc(i))
+        chan.hm.recv_settle(0)
+        chan.hm.recv_settle(2)
+        chan.hm.recv_htlc(self.htlc(0))
+        chan.hm.send_fail(0)
+        lnworker = MockLNWallet()
+        lnworker, replayed = self.restart(lnworker, chan)
+        self.assertEqual([0, 2], replayed)
+        # the in-flight htlc 1 holds back the local mark
+        self.assertEqual({bh2u(chan.channel_id): [1, 1]}, lnworker.storage.db.get('lightning_ledger_marks'))
+        self.assertEqual([bh2u(bytes([i]) * 32) for i in (0, 2)],
+                         [item['payment_hash'] for item in lnworker.get_history()])
+        chan.hm.recv_settle(1)
+        chan.hm.send_htlc(self.htlc(3))
+        chan.hm.recv_settle(3)
+        lnworker, replayed = self.restart(lnworker, chan)
+        self.assertEqual([1, 2, 3], replayed)
+        self.assertEqual({bh2u(chan.channel_id): [4, 1]}, lnworker.storage.db.get('lightning_ledger_marks'))
+        self.assertEqual([bh2u(bytes([i]) * 32) for i in range(4)],
+                         [item['payment_hash'] for item in lnworker.get_history()])
+        self.assertEqual(-10000, lnworker.get_history()[-1]['balance_msat'])
+        lnworker, replayed = self.restart(lnworker, chan)
+        self.assertEqual([], replayed)
+        self.assertEqual(4, len(lnworker.get_history()))
+
+
+class MockChannel:
+    def __init__(self, short_channel_id, available_msat):
+        self.short_channel_id = short_channel_id
+        self.available_msat = available_msat
+
+    def can_pay(self, amount_msat):
+        return amount_msat <= self.available_msat
+
+
+class MockPeer:
+    """Resolves htlcs after a delay, failing at the hop given for their first channel."""
+    def __init__(self, lnworker, outcomes):
+        self.lnworker = lnworker
+        self.outcomes = outcomes  # short_channel_id -> (delay, sender_idx) or exception
+        self.sent = []
+
+    async def pay(self, route, chan, amount_msat, payment_hash, min_final_cltv_expiry):
+        outcome = self.outcomes[chan.short_channel_id]
+        if isinstance(outcome, Exception):
+            raise outcome
+        self.sent.append(chan.short_channel_id)
+        delay, sender_idx = outcome
+        future = self.lnworker.pending_payments[payment_hash]
+        asyncio.get_event_loop().call_later(delay, future.set_result, (False, None, sender_idx))
+        return payment_hash
+
+
+class MockInvoice:
+    amount = Decimal('0.001')
+
+    def get_min_final_cltv_expiry(self):
+        return 9
+
+
+class MockProbingLNWallet:
+    def __init__(self, channels, outcomes):
+        self.channels = {chan.short_channel_id: chan for chan in channels}
+        self.pending_payments = defaultdict(asyncio.Future)
+        self.peer = MockPeer(self, outcomes)
+        self.peers = {b'\x02' * 33: self.peer}
+
+    def get_channel_by_short_id(self, short_channel_id):
+        return self.channels.get(short_channel_id)
+
+    def _handle_failed_htlc(self, route, chan, htlc, reason, peer):
+        return PaymentAttemptFailureDetails(sender_idx=reason, failure_msg=None, is_blacklisted=False)
+
+    _probe_routes = LNWallet._probe_routes
+    _probe_route = LNWallet._probe_route
+
+
+def scid(n):
+    return ShortChannelID.from_components(n, 0, 0)
+
+
+def route_via(first_channel, last_channel):
+    return [RouteEdge(b'\x02' * 33, scid(first_channel), 0, 0, 0),
+            RouteEdge(b'\x03' * 33, scid(last_channel), 1000, 0, 0)]
+
+
+class TestProbeRoutes(ElectrumTestCase):
+
+    amount_msat = 100_000_000
+
+    def probe(self, lnworker, routes):
+        return asyncio.get_event_loop().run_until_complete(lnworker._probe_routes(routes, MockInvoice()))
+
+    def test_first_route_that_reaches_destination(self):
+        lnworker = MockProbingLNWallet([MockChannel(scid(1), 10 * self.amount_msat),
+                                        MockChannel(scid(2), 10 * self.amount_msat)],
+                                       {scid(1): (0.05, 0), scid(2): (0.01, 1)})
+        routes = [route_via(1, 11), route_via(2, 12)]
+        route, logs = self.probe(lnworker, routes)
+        self.assertIs(routes[1], route)
+        # the slower probe was awaited, and its failure is logged
+        self.assertEqual([routes[0]], [log.route for log in logs])
+        self.assertEqual({}, lnworker.pending_payments)
+
+    def test_skip_route_if_first_channel_cannot_hold_probes_and_payment(self):
+        # room for one probe and the payment
+        lnworker = MockProbingLNWallet([MockChannel(scid(1), 3 * self.amount_msat)],
+                                       {scid(1): (0.01, 0)})
+        route, logs = self.probe(lnworker, [route_via(1, 11), route_via(1, 12)])
+        self.assertIsNone(route)
+        self.assertEqual([scid(1)], lnworker.peer.sent)
+        self.assertEqual(1, len(logs))
+
+    def test_unexpected_exception(self):
+        lnworker = MockProbingLNWallet([MockChannel(scid(1), 10 * self.amount_msat),
+                                        MockChannel(scid(2), 10 * self.amount_msat)],
+                                       {scid(1): ValueError('oops'), scid(2): (0.01, 0)})
+        route, logs = self.probe(lnworker, [route_via(1, 11), route_via(2, 12)])
+        self.assertIsNone(route)
+        self.assertEqual(2, len(logs))
+        self.assertIsInstance(logs[0].exception, ValueError)
+        self.assertEqual({}, lnworker.pending_payments)
+
+    def test_timeout_keeps_pending_payment_until_resolved(self):
+        lnworker = MockProbingLNWallet([MockChannel(scid(1), 10 * self.amount_msat)],
+                                       {scid(1): (0.1, 0)})
+        with mock.patch('electrum.lnworker.PAYMENT_PROBE_TIMEOUT', 0.01):
+            route, logs = self.probe(lnworker, [route_via(1, 11), route_via(1, 12)])
+        self.assertIsNone(route)
+        self.assertIsInstance(logs[0].exception, asyncio.TimeoutError)
+        # the htlcs are still in flight
+        self.assertEqual(2, len(lnworker.pending_payments))
+        asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.2))
+        self.assertEqual({}, lnworker.pending_payments)
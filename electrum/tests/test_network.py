@@ -1,11 +1,18 @@
 import asyncio
+import json
 import tempfile
 import unittest
+from unittest import mock
+from collections import OrderedDict
+
+import aiohttp
+from aiorpcx import Notification, RPCError
 
 from electrum import constants
 from electrum.simple_config import SimpleConfig
 from electrum import blockchain
-from electrum.interface import Interface
+from electrum.interface import Interface, NotificationSession
+from electrum.network import Network
 from electrum.crypto import sha256
 from electrum.util import bh2u
 
@@ -117,6 +124,170 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
 
 
+class TestNotificationSession(ElectrumTestCase):
+
+    def test_subscriptions_are_shared(self):
+        method = 'blockchain.scripthash.subscribe'
+        requests = []
+        async def send_request(method, params):
+            requests.append((method, params))
+            await asyncio.sleep(0.01)
+            return 'status1'
+        session = NotificationSession(mock.Mock())
+        session.send_request = send_request
+        queues = [asyncio.Queue() for i in range(3)]
+        async def f():
+            await asyncio.gather(*[session.subscribe(method, ['h'], q) for q in queues])
+            session.unsubscribe(queues[0])
+            await session.handle_request(Notification(method, ['h', 'status2']))
+        asyncio.get_event_loop().run_until_complete(f())
+        self.assertEqual([(method, ['h'])], requests)
+        self.assertEqual(['h', 'status1'], queues[0].get_nowait())
+        for q in queues[1:]:
+            self.assertEqual([['h', 'status1'], ['h', 'status2']], [q.get_nowait(), q.get_nowait()])
+        self.assertTrue(queues[0].empty())
+
+    def test_failed_subscription_request_is_not_reused(self):
+        method = 'blockchain.scripthash.subscribe'
+        results = [Exception('server error'), 'status1']
+        async def send_request(method, params):
+            await asyncio.sleep(0.01)
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        session = NotificationSession(mock.Mock())
+        session.send_request = send_request
+        q1, q2, q3 = asyncio.Queue(), asyncio.Queue(), asyncio.Queue()
+        async def f():
+            # the first subscriber gives up, the others still get the result
+            t1 = asyncio.ensure_future(session.subscribe(method, ['h'], q1))
+            t2 = asyncio.ensure_future(session.subscribe(method, ['h'], q2))
+            await asyncio.sleep(0)
+            t1.cancel()
+            with self.assertRaises(Exception):
+                await t2
+            self.assertEqual({}, session._subscription_requests)
+            await session.subscribe(method, ['h'], q3)
+        asyncio.get_event_loop().run_until_complete(f())
+        self.assertEqual([], results)
+        self.assertEqual(['h', 'status1'], q3.get_nowait())
+        self.assertNotIn(session.get_hashable_key_for_rpc_call(method, ['h']), session._subscription_requests)
+
+    def test_request_batch(self):
+        method = 'blockchain.scripthash.listunspent'
+        batches = []
+        results = ([], [{'tx_hash': 'aa'}])
+        async def send_concurrent(message, future, count):
+            batches.append(json.loads(message))
+            return results
+        session = NotificationSession(mock.Mock())
+        session._send_concurrent = send_concurrent
+        loop = asyncio.get_event_loop()
+        self.assertEqual(list(results), loop.run_until_complete(
+            session.send_request_batch(method, [['h1'], ['h2']])))
+        self.assertEqual(1, len(batches))
+        self.assertEqual([(method, ['h1']), (method, ['h2'])],
+                         [(r['method'], r['params']) for r in batches[0]])
+        # an error response fails the whole batch
+        results = ([], RPCError(1, 'server error'))
+        with self.assertRaises(RPCError):
+            loop.run_until_complete(session.send_request_batch(method, [['h1'], ['h2']]))
+
+
+class MockTxInterface:
+    def __init__(self, name):
+        self.name = name
+        self.ready = asyncio.Future()
+        self.ready.set_result(1)
+        self.got_disconnected = asyncio.Future()
+        self.requests = []
+        self.hang = False
+
+    async def send_request(self, method, params, *, timeout=None):
+        self.requests.append(params[0])
+        if self.hang:
+            await asyncio.Future()
+        await asyncio.sleep(0.01)
+        return f'raw of {params[0]} from {self.name}'
+
+
+class TestGetTransaction(ElectrumTestCase):
+
+    TXID = 'aa' * 32
+
+    def create_network(self):
+        # only what get_transaction needs
+        network = Network.__new__(Network)
+        network.interface = None
+        network._raw_tx_cache = OrderedDict()
+        network._raw_tx_requests = {}
+        async def _request_transaction(iface, tx_hash, *, timeout=None):
+            return await iface.send_request('blockchain.transaction.get', [tx_hash], timeout=timeout)
+        network._request_transaction = _request_transaction
+        return network
+
+    def test_concurrent_requests_are_shared(self):
+        network = self.create_network()
+        network.interface = iface = MockTxInterface('a')
+        async def f():
+            return await asyncio.gather(*[network.get_transaction(self.TXID) for i in range(3)])
+        results = asyncio.get_event_loop().run_until_complete(f())
+        self.assertEqual(3 * [f'raw of {self.TXID} from a'], results)
+        self.assertEqual([self.TXID], iface.requests)
+        self.assertEqual({}, network._raw_tx_requests)
+
+    def test_retry_on_new_interface_makes_new_request(self):
+        network = self.create_network()
+        network.interface = iface1 = MockTxInterface('a')
+        iface1.hang = True
+        iface2 = MockTxInterface('b')
+        async def f():
+            t = asyncio.ensure_future(network.get_transaction(self.TXID))
+            await asyncio.sleep(0.01)
+            # the interface goes away, best_effort_reliable retries on the next one
+            network.interface = iface2
+            iface1.got_disconnected.set_result(1)
+            return await asyncio.wait_for(t, 1)
+        result = asyncio.get_event_loop().run_until_complete(f())
+        self.assertEqual(f'raw of {self.TXID} from b', result)
+        self.assertEqual([self.TXID], iface2.requests)
+
+
+class TestHttpSession(ElectrumTestCase):
+
+    def create_network(self):
+        # only what _get_http_session needs
+        network = Network.__new__(Network)
+        network.main_taskgroup = None
+        network.proxy = None
+        network._http_session = None
+        network._http_session_proxy = None
+        return network
+
+    def test_session_is_shared_and_keyed_on_proxy(self):
+        network = self.create_network()
+        async def f():
+            with self.assertRaises(aiohttp.ClientConnectionError):
+                network._get_http_session()  # not started
+            network.main_taskgroup = MockTaskGroup()
+            session = network._get_http_session()
+            self.assertIs(session, network._get_http_session())
+            network.proxy = {'mode': 'socks5', 'host': 'localhost', 'port': '9050'}
+            session2 = network._get_http_session()
+            self.assertIsNot(session, session2)
+            await asyncio.sleep(0)
+            self.assertTrue(session.closed)
+            # stopped: the session is closed, and no new one is made
+            network.main_taskgroup = None
+            await network._close_http_session()
+            self.assertTrue(session2.closed)
+            with self.assertRaises(aiohttp.ClientConnectionError):
+                network._get_http_session()
+            self.assertIsNone(network._http_session)
+        asyncio.get_event_loop().run_until_complete(f())
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
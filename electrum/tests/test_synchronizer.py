@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from electrum import synchronizer
+from electrum.synchronizer import Notifier, PendingNotification
+from electrum.simple_config import SimpleConfig
+
+from . import ElectrumTestCase
+
+
+ADDR = '1BoatSLRHtKNngkdXEeobR76b53LETtpyT'
+
+
+class MockNetwork:
+    def __init__(self, config):
+        self.config = config
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.interface = None
+        self.posted = []
+        self.fail = False
+
+    def register_callback(self, callback, events):
+        pass
+
+    async def _send_http_on_proxy(self, method, url, **kwargs):
+        if self.fail:
+            raise Exception('connection refused')
+        self.posted.append((url, kwargs['json']))
+
+
+class TestNotifier(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.network = MockNetwork(self.config)
+
+    def run_in_loop(self, coro):
+        return self.network.asyncio_loop.run_until_complete(coro)
+
+    def create_notifier(self):
+        notifier = Notifier(self.network)
+        notifier.group = synchronizer.TaskGroup()
+        return notifier
+
+    def add_pending(self, notifier, url, statuses):
+        notifier.watched_addresses[ADDR].append(url)
+        for status in statuses:
+            notifier._pending[url].append(PendingNotification(ADDR, status, time.time()))
+
+    def test_batch_size_from_cli(self):
+        self.config.set_key('notify_batch_size', '5')
+        self.assertEqual(5, self.create_notifier().batch_size)
+
+    def test_backoff(self):
+        notifier = self.create_notifier()
+        url = 'http://localhost/hook'
+        self.add_pending(notifier, url, ['s1'])
+        self.network.fail = True
+        delays = []
+        for i in range(4):
+            self.run_in_loop(notifier._deliver_to_url(url))
+            num_failures, next_attempt = notifier._retry_state[url]
+            self.assertEqual(i + 1, num_failures)
+            delays.append(round(next_attempt - time.time()))
+        self.assertEqual([2, 4, 8, 16], delays)
+        # the delay is capped
+        for i in range(10):
+            notifier._on_delivery_failed(url, Exception())
+        self.assertLessEqual(notifier._retry_state[url][1] - time.time(), synchronizer.NOTIFIER_RETRY_DELAY_MAX)
+        # delivered once the url is back
+        self.network.fail = False
+        self.run_in_loop(notifier._deliver_to_url(url))
+        self.assertEqual([(url, {'address': ADDR, 'status': 's1'})], self.network.posted)
+        self.assertNotIn(url, notifier._retry_state)
+        self.assertEqual(0, notifier.num_pending())
+
+    def test_max_attempts(self):
+        notifier = self.create_notifier()
+        url = 'http://localhost/hook'
+        self.add_pending(notifier, url, ['s1', 's2'])
+        self.network.fail = True
+        for i in range(synchronizer.NOTIFIER_MAX_ATTEMPTS - 1):
+            self.run_in_loop(notifier._deliver_to_url(url))
+        self.assertEqual(2, notifier.num_pending())
+        # the oldest notification is dropped, the next one gets a fresh start
+        self.run_in_loop(notifier._deliver_to_url(url))
+        self.assertEqual(1, notifier.num_dropped)
+        self.assertEqual(['s2'], [item.status for item in notifier._pending[url]])
+        self.assertEqual(0, notifier._retry_state[url][0])
+
+    def test_batches(self):
+        self.config.set_key('notify_batch_size', 2)
+        notifier = self.create_notifier()
+        url = 'http://localhost/hook'
+        self.add_pending(notifier, url, ['s1', 's2', 's3'])
+        self.run_in_loop(notifier._deliver_to_url(url))
+        self.run_in_loop(notifier._deliver_to_url(url))
+        self.assertEqual([[ADDR, ADDR], [ADDR]], [[item['address'] for item in data] for url, data in self.network.posted])
+        self.assertEqual(3, notifier.num_delivered)
+
+    def test_resume_from_saved_state(self):
+        self.assertFalse(Notifier.has_saved_state(self.config))
+        notifier = self.create_notifier()
+        url = 'http://localhost/hook'
+        self.add_pending(notifier, url, ['s1', 's2'])
+        notifier._last_status[ADDR] = 's2'
+        self.run_in_loop(notifier._save())
+        self.assertTrue(Notifier.has_saved_state(self.config))
+        notifier2 = self.create_notifier()
+        self.assertEqual({ADDR: [url]}, dict(notifier2.watched_addresses))
+        self.assertEqual({ADDR: 's2'}, notifier2._last_status)
+        self.assertEqual(['s1', 's2'], [item.status for item in notifier2._pending[url]])
+        # an unchanged status is not notified again after the restart
+        self.run_in_loop(notifier2._on_address_status(ADDR, 's2'))
+        self.assertEqual(2, notifier2.num_pending())
+        self.run_in_loop(notifier2._on_address_status(ADDR, 's3'))
+        self.assertEqual(3, notifier2.num_pending())
@@ -1,23 +1,31 @@
 import shutil
 import tempfile
+import asyncio
 import sys
 import os
 import json
 from decimal import Decimal
+from datetime import datetime, date
 import time
+from unittest import mock
 
 from io import StringIO
-from electrum.storage import WalletStorage
+from electrum.storage import WalletStorage, StorageEncryptionVersion, copy_wallet_file, delete_wallet_file
 from electrum.json_db import FINAL_SEED_VERSION
 from electrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
-                             restore_wallet_from_text, Imported_Wallet)
-from electrum.exchange_rate import ExchangeBase, FxThread
-from electrum.util import TxMinedInfo
+                             restore_wallet_from_text, Imported_Wallet,
+                             sweep_preparations_async, SWEEP_MAX_CONCURRENT_REQUESTS,
+                             SWEEP_BATCH_SIZE)
+from electrum.exchange_rate import ExchangeBase, FxThread, FX_QUOTE_MAX_AGE
+from electrum import exchange_rate
+from electrum.util import TxMinedInfo, PR_UNPAID, PR_PAID, PR_EXPIRED, bfh
 from electrum.bitcoin import COIN
+from electrum.transaction import Transaction
+from electrum import bitcoin
 from electrum.json_db import JsonDB
 from electrum.simple_config import SimpleConfig
 
-from . import ElectrumTestCase
+from . import ElectrumTestCase, TestCaseForTestnet
 
 
 class FakeSynchronizer(object):
@@ -28,6 +36,9 @@ class FakeSynchronizer(object):
     def add(self, address):
         self.store.append(address)
 
+    def add_many(self, addresses):
+        self.store.append(list(addresses))
+
 
 class WalletTestCase(ElectrumTestCase):
 
@@ -81,20 +92,82 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def test_channels_are_journaled(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('seed_version', FINAL_SEED_VERSION)
+        storage.write()
+        storage.write_channel({'channel_id': 'aa', 'state': 'OPENING'})  # does a full write, to set journal_id
+        storage.write_channel({'channel_id': 'bb', 'state': 'OPENING'})
+        storage.write_channel({'channel_id': 'aa', 'state': 'OPEN'})
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertEqual([{'channel_id': 'aa', 'state': 'OPENING'}], json.loads(contents)['channels'])
+        # a record that was not fully written is dropped
+        with open(self.wallet_path + '.journal', "a") as f:
+            f.write('{"journal_id": ')
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual([{'channel_id': 'aa', 'state': 'OPEN'}, {'channel_id': 'bb', 'state': 'OPENING'}],
+                         storage.get('channels'))
+        storage.write_channel({'channel_id': 'bb', 'state': 'OPEN'})
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(['OPEN', 'OPEN'], [c['state'] for c in storage.get('channels')])
+        # a full write folds the journal into the wallet file
+        storage.write()
+        self.assertFalse(os.path.exists(self.wallet_path + '.journal'))
+        self.assertEqual(['OPEN', 'OPEN'], [c['state'] for c in WalletStorage(self.wallet_path).get('channels')])
+
+    def test_channel_journal_is_encrypted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('seed_version', FINAL_SEED_VERSION)
+        storage.set_password('secret', enc_version=StorageEncryptionVersion.USER_PASSWORD)
+        storage.write()
+        storage.write_channel({'channel_id': 'aa', 'state': 'OPENING'})
+        storage.write_channel({'channel_id': 'aa', 'state': 'OPEN'})
+        with open(self.wallet_path + '.journal', "r") as f:
+            self.assertNotIn('OPEN', f.read())
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt('secret')
+        self.assertEqual([{'channel_id': 'aa', 'state': 'OPEN'}], storage.get('channels'))
+
+    def test_journal_goes_with_wallet_file(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('seed_version', FINAL_SEED_VERSION)
+        storage.write()
+        storage.write_channel({'channel_id': 'aa', 'state': 'OPENING'})
+        storage.write_channel({'channel_id': 'aa', 'state': 'OPEN'})
+        copy_path = self.wallet_path + '_copy'
+        copy_wallet_file(self.wallet_path, copy_path)
+        self.assertEqual([{'channel_id': 'aa', 'state': 'OPEN'}], WalletStorage(copy_path).get('channels'))
+        delete_wallet_file(self.wallet_path)
+        self.assertFalse(os.path.exists(self.wallet_path))
+        self.assertFalse(os.path.exists(self.wallet_path + '.journal'))
+        # a journal left at the destination is not mixed with a copy that has none
+        WalletStorage(copy_path).write()
+        copy_wallet_file(copy_path, self.wallet_path)
+        self.assertFalse(os.path.exists(self.wallet_path + '.journal'))
+        with open(copy_path + '.journal', 'w') as f:
+            f.write('garbage')
+        copy_wallet_file(self.wallet_path, copy_path)
+        self.assertFalse(os.path.exists(copy_path + '.journal'))
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
-        super().__init__(lambda self: None, lambda self: None)
+        super().__init__(lambda *args: None, lambda *args: None)
         self.quotes = {'TEST': rate}
 
 class FakeFxThread:
     def __init__(self, exchange):
         self.exchange = exchange
+        self.extra_exchanges = {}
         self.ccy = 'TEST'
 
     remove_thousands_separator = staticmethod(FxThread.remove_thousands_separator)
     timestamp_rate = FxThread.timestamp_rate
+    timestamp_rates = FxThread.timestamp_rates
     ccy_amount_str = FxThread.ccy_amount_str
     history_rate = FxThread.history_rate
+    exchange_rate = FxThread.exchange_rate
+    get_exchanges = FxThread.get_exchanges
 
 class FakeWallet:
     def __init__(self, fiat_value):
@@ -110,6 +183,8 @@ class FakeWallet:
 
     default_fiat_value = Abstract_Wallet.default_fiat_value
     price_at_timestamp = Abstract_Wallet.price_at_timestamp
+    _acquisition_prices = {}
+    _clear_acquisition_prices = Abstract_Wallet._clear_acquisition_prices
     class storage:
         put = lambda self, x: None
 
@@ -147,6 +222,50 @@ class TestFiat(ElectrumTestCase):
         self.assertEqual(False, Abstract_Wallet.set_fiat_value(self.wallet, txid, ccy, 'garbage', self.fx, self.value_sat))
         self.assertNotIn(ccy, self.fiat_value)
 
+    def test_historical_rates(self):
+        exchange = self.fx.exchange
+        exchange._set_history(ccy, {'2019-01-01': '3000.5', '2019-01-03': 3500, '2018-12-31': '2900', 'timestamp': 0})
+        self.assertEqual('3000.5', exchange.historical_rate(ccy, datetime(2019, 1, 1, 23, 59)))
+        self.assertEqual('NaN', exchange.historical_rate(ccy, datetime(2019, 1, 2)))
+        self.assertEqual('NaN', exchange.historical_rate('OTHER', datetime(2019, 1, 1)))
+        days = [date(2019, 1, x).toordinal() for x in (3, 1, 2, 3, 4)] + [date(2018, 12, 31).toordinal()]
+        self.assertEqual([3500, '3000.5', 'NaN', 3500, 'NaN', '2900'], exchange.historical_rates(ccy, days))
+        timestamps = [datetime(2019, 1, x, 12).timestamp() for x in (3, 1, 2)] + [time.time()]
+        # note: the spot rate is used for recent days
+        self.assertEqual(['3500', '3000.5', 'NaN', '1000.001'], [str(x) for x in self.fx.timestamp_rates(timestamps)])
+        self.assertEqual([str(self.fx.timestamp_rate(t)) for t in timestamps],
+                         [str(x) for x in self.fx.timestamp_rates(timestamps)])
+
+    def test_exchange_rate_is_median_of_fresh_quotes(self):
+        extra = {name: FakeExchange(Decimal(rate)) for name, rate in
+                 (('extra1', '900'), ('extra2', '1200'), ('extra3', '1'), ('stale', '5000'))}
+        extra['extra3'].quotes = {'OTHER': Decimal('1')}
+        extra['stale'].quotes_timestamp = time.time() - FX_QUOTE_MAX_AGE - 1
+        self.fx.extra_exchanges = extra
+        with mock.patch.dict(exchange_rate.CURRENCIES, {name: ['TEST'] for name in extra}):
+            self.assertEqual(Decimal('1000.001'), self.fx.exchange_rate())
+            del extra['extra2']
+            self.assertEqual(Decimal('950.0005'), self.fx.exchange_rate())
+        # sources that do not support the currency are not used
+        self.assertEqual(Decimal('1000.001'), self.fx.exchange_rate())
+
+    def test_history_downloads_are_coalesced(self):
+        requests = []
+        async def request_history(ccy):
+            requests.append(ccy)
+            await asyncio.sleep(0.01)
+            return {'2019-01-01': '3000.5'}
+        exchanges = [FakeExchange(Decimal('1')) for i in range(3)]
+        for exchange in exchanges:
+            exchange.request_history = request_history
+        async def f():
+            await asyncio.gather(*[exchange.get_historical_rates_safe(ccy, self.electrum_path)
+                                   for exchange in exchanges])
+        asyncio.get_event_loop().run_until_complete(f())
+        self.assertEqual([ccy], requests)
+        for exchange in exchanges:
+            self.assertEqual('3000.5', exchange.historical_rate(ccy, datetime(2019, 1, 1)))
+
 
 class TestCreateRestoreWallet(WalletTestCase):
 
@@ -227,3 +346,147 @@ class TestCreateRestoreWallet(WalletTestCase):
         # also test addr deletion
         wallet.delete_address('bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c')
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
+
+    def test_imported_addresses_are_synchronized_in_one_batch(self):
+        text = 'p2wpkh:L4jkdiXszG26SUYvwwJhzGwg37H2nLhrbip7u6crmgNeJysv5FHL'
+        wallet = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        wallet.synchronizer = FakeSynchronizer()
+        good_addr, bad_keys = wallet.import_private_keys(
+            ['p2wpkh:L24GxnN7NNUAfCXA6hFzB1jt59fYAAiFZMcLaJ2ZSawGpM3uqhb1', 'garbage',
+             'p2pkh:L4jkdiXszG26SUYvwwJhzGwg37H2nLhrbip7u6crmgNeJysv5FHL'], password=None)
+        self.assertEqual(['bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c', 's1V4U6ik5TxpQShKWwfkLcodDdWa2q82YTj'], good_addr)
+        self.assertEqual(['garbage'], [key for key, msg in bad_keys])
+        self.assertEqual([good_addr], wallet.synchronizer.store)
+        good_addr, bad_addr = wallet.import_addresses(
+            ['bc1q2ccr34wzep58d4239tl3x3734ttle92a8srmuw', 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'])
+        self.assertEqual(['bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'], good_addr)
+        self.assertEqual([good_addr], wallet.synchronizer.store[1:])
+        self.assertEqual(4, len(wallet.get_receiving_addresses()))
+
+
+class TestPaymentRequests(WalletTestCase):
+
+    def _make_tx_paying(self, address, amount_sat):
+        # tx with a single (p2pk, unknown) input and a single output
+        return Transaction('02000000'
+                           '01' + '11' * 32 + '00000000' + '0403300102' + 'ffffffff'
+                           '01' + amount_sat.to_bytes(8, 'little').hex()
+                           + bitcoin.var_int(len(bitcoin.address_to_script(address)) // 2)
+                           + bitcoin.address_to_script(address)
+                           + '00000000')
+
+    def test_request_status_index(self):
+        text = 'bitter grass shiver impose acquire brush forget axis eager alone wine silver'
+        wallet = restore_wallet_from_text(text, path=self.wallet_path, gap_limit=5, config=self.config)['wallet']
+        wallet.network = mock.Mock()
+        wallet.network.get_local_height.return_value = 600_000
+        addr1, addr2, addr3 = wallet.get_receiving_addresses()[0:3]
+        req1 = wallet.make_payment_request(addr1, 100_000, 'unpaid', 3600)
+        req2 = wallet.make_payment_request(addr2, 200_000, 'expired', 60)
+        req2['time'] -= 120
+        req3 = wallet.make_payment_request(addr3, 300_000, 'paid', 0)
+        for req in (req1, req2, req3):
+            wallet.add_payment_request(req)
+        self.assertEqual([addr1, addr3], [r['address'] for r in wallet.iter_sorted_requests(status=PR_UNPAID)])
+        self.assertEqual([addr2], [r['address'] for r in wallet.iter_sorted_requests(status=PR_EXPIRED)])
+        self.assertEqual([], list(wallet.iter_sorted_requests(status=PR_PAID)))
+        # a transaction paying the request updates the index
+        tx = self._make_tx_paying(addr3, 300_000)
+        wallet.add_unverified_tx(tx.txid(), 0)
+        wallet.add_transaction(tx)
+        self.assertEqual((PR_PAID, 0), wallet.get_request_status(addr3))
+        wallet.add_verified_tx(tx.txid(), TxMinedInfo(height=599_999, conf=None,
+                                                      timestamp=0, txpos=0, header_hash=''))
+        self.assertEqual((PR_PAID, 2), wallet.get_request_status(addr3))
+        self.assertEqual([addr3], [r['address'] for r in wallet.iter_sorted_requests(status=PR_PAID)])
+        self.assertEqual([addr1], [r['address'] for r in wallet.iter_sorted_requests(status=PR_UNPAID)])
+        # requests expire as time passes
+        now = time.time()
+        with mock.patch('time.time', return_value=now + 1800):
+            self.assertEqual([addr2], [r['address'] for r in wallet.iter_sorted_requests(status=PR_EXPIRED)])
+        with mock.patch('time.time', return_value=now + 7200):
+            self.assertEqual([addr2, addr1], [r['address'] for r in wallet.iter_sorted_requests(status=PR_EXPIRED)])
+            self.assertEqual([], list(wallet.iter_sorted_requests(status=PR_UNPAID)))
+            wallet.remove_payment_request(addr2)
+            self.assertEqual([addr1], [r['address'] for r in wallet.iter_sorted_requests(status=PR_EXPIRED)])
+        # re-adding a paid request with a higher amount makes it unpaid again
+        req3 = dict(req3, amount=400_000)
+        wallet.add_payment_request(req3)
+        self.assertEqual((PR_UNPAID, None), wallet.get_request_status(addr3))
+        self.assertEqual([addr3], [r['address'] for r in wallet.iter_sorted_requests(status=PR_UNPAID)])
+
+
+class TestCapitalGains(WalletTestCase):
+
+    def _make_tx(self, prevout_hash, address, amount_sat):
+        # tx with a single (p2pk) input and a single output
+        return Transaction('02000000'
+                           '01' + bfh(prevout_hash)[::-1].hex() + '00000000' + '0403300102' + 'ffffffff'
+                           '01' + amount_sat.to_bytes(8, 'little').hex()
+                           + bitcoin.var_int(len(bitcoin.address_to_script(address)) // 2)
+                           + bitcoin.address_to_script(address)
+                           + '00000000')
+
+    def test_acquisition_price_of_long_self_transfer_chain(self):
+        text = 'bitter grass shiver impose acquire brush forget axis eager alone wine silver'
+        wallet = restore_wallet_from_text(text, path=self.wallet_path, gap_limit=5, config=self.config)['wallet']
+        wallet.network = mock.Mock()
+        wallet.network.get_local_height.return_value = 200
+        addresses = wallet.get_receiving_addresses()[0:5]
+        txids = []
+        prevout_hash = '11' * 32
+        # deeper than the recursion limit would allow for a recursive walk
+        for i in range(sys.getrecursionlimit()):
+            tx = self._make_tx(prevout_hash, addresses[i % 5], 100_000)
+            wallet.add_unverified_tx(tx.txid(), 0)
+            self.assertTrue(wallet.add_transaction(tx))
+            prevout_hash = tx.txid()
+            txids.append(prevout_hash)
+        timestamps = []
+        def price_func(timestamp):
+            timestamps.append(timestamp)
+            return Decimal(5000) if timestamp == 1234 else Decimal(1000)
+        for tx_hash in reversed(txids[1:]):
+            self.assertEqual(Decimal(1000), wallet.average_price(tx_hash, price_func, ccy))
+        # the funding transaction is priced once
+        self.assertEqual(1, len(timestamps))
+        # prices are updated when it gets mined
+        wallet.add_verified_tx(txids[0], TxMinedInfo(height=100, conf=None, timestamp=1234,
+                                                     txpos=0, header_hash=''))
+        self.assertEqual(Decimal(5000), wallet.average_price(txids[-1], price_func, ccy))
+        self.assertEqual(Decimal(500), wallet.coin_price(txids[-1], price_func, ccy, COIN // 10))
+
+
+class TestSweepPreparations(TestCaseForTestnet):
+
+    def test_lookups_are_batched_concurrent_and_bounded(self):
+
+        class NetworkMock:
+            num_in_flight = 0
+            max_in_flight = 0
+            batch_sizes = []
+            async def listunspent_for_scripthashes(self, scripthashes):
+                self.batch_sizes.append(len(scripthashes))
+                self.num_in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.num_in_flight)
+                await asyncio.sleep(0.01)
+                self.num_in_flight -= 1
+                return [[{'tx_hash': 'ac24de8b58e826f60bd7b9ba31670bdfc3e8aedb2f28d0e91599d741569e3429', 'tx_pos': 1, 'height': 1325785, 'value': 1000000}]
+                        if sh == '460e4fb540b657d775d84ff4955c9b13bd954c2adc26a6b998331343f85b6a45' else []
+                        for sh in scripthashes]
+
+        network = NetworkMock()
+        progress = []
+        num_keys = SWEEP_BATCH_SIZE * SWEEP_MAX_CONCURRENT_REQUESTS
+        privkeys = ['93NQ7CFbwTPyKDJLXe97jczw33fiLijam2SCZL3Uinz1NSbHrTu'] * num_keys
+        inputs, keypairs = asyncio.get_event_loop().run_until_complete(
+            sweep_preparations_async(privkeys, network, imax=3,
+                                     progress_callback=lambda num_done, num_total: progress.append((num_done, num_total))))
+        self.assertEqual(3, len(inputs))
+        self.assertEqual(1000000, inputs[0].value_sats())
+        self.assertEqual(1, len(keypairs))
+        # p2pkh and p2pk lookup for each key, in full batches
+        self.assertEqual([SWEEP_BATCH_SIZE] * 2 * SWEEP_MAX_CONCURRENT_REQUESTS, network.batch_sizes)
+        self.assertEqual([(SWEEP_BATCH_SIZE * i, 2 * num_keys) for i in range(1, len(network.batch_sizes) + 1)],
+                         progress)
+        self.assertEqual(SWEEP_MAX_CONCURRENT_REQUESTS, network.max_in_flight)
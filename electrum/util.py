@@ -1047,7 +1047,7 @@ class TxMinedInfo(NamedTuple):
     header_hash: Optional[str] = None  # hash of block that mined tx
 
 
-def make_aiohttp_session(proxy: Optional[dict], headers=None, timeout=None):
+def make_aiohttp_session(proxy: Optional[dict], headers=None, timeout=None, *, limit_per_host=0):
     if headers is None:
         headers = {'User-Agent': 'Electrum'}
     if timeout is None:
@@ -1067,9 +1067,10 @@ def make_aiohttp_session(proxy: Optional[dict], headers=None, timeout=None):
             password=proxy.get('password', None),
             rdns=True,
             ssl=ssl_context,
+            limit_per_host=limit_per_host,
         )
     else:
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
+        connector = aiohttp.TCPConnector(ssl=ssl_context, limit_per_host=limit_per_host)
 
     return aiohttp.ClientSession(headers=headers, timeout=timeout, connector=connector)
 
@@ -35,11 +35,13 @@ import copy
 import errno
 import traceback
 import operator
+import heapq
+import asyncio
 from functools import partial
 from collections import defaultdict
 from numbers import Number
 from decimal import Decimal
-from typing import TYPE_CHECKING, List, Optional, Tuple, Union, NamedTuple, Sequence, Dict, Any, Set
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union, NamedTuple, Sequence, Dict, Any, Set, Callable
 from abc import ABC, abstractmethod
 import itertools
 
@@ -88,8 +90,17 @@ TX_STATUS = [
     _('Local'),
 ]
 
+# granularity (in seconds) of the timer wheel that expires payment requests
+REQUEST_EXPIRY_BUCKET_SIZE = 60
 
-def _append_utxos_to_inputs(inputs: List[PartialTxInput], network: 'Network', pubkey, txin_type, imax):
+
+# number of listunspent lookups sent in one JSON-RPC batch when sweeping
+SWEEP_BATCH_SIZE = 50
+# maximum number of concurrent listunspent batches when sweeping
+SWEEP_MAX_CONCURRENT_REQUESTS = 4
+
+
+def _get_sweep_scripthash(pubkey, txin_type) -> Tuple[str, Optional[str]]:
     if txin_type in ('p2pkh', 'p2wpkh', 'p2wpkh-p2sh'):
         address = bitcoin.pubkey_to_address(txin_type, pubkey)
         scripthash = bitcoin.address_to_scripthash(address)
@@ -99,14 +110,17 @@ def _append_utxos_to_inputs(inputs: List[PartialTxInput], network: 'Network', pu
         address = None
     else:
         raise Exception(f'unexpected txin_type to sweep: {txin_type}')
+    return scripthash, address
 
-    u = network.run_from_another_thread(network.listunspent_for_scripthash(scripthash))
-    for item in u:
+
+def _append_utxos_to_inputs(inputs: List[PartialTxInput], utxos: Sequence[dict], *,
+                            pubkey, txin_type, address, imax):
+    for item in utxos:
         if len(inputs) >= imax:
             break
         prevout_str = item['tx_hash'] + ':%d' % item['tx_pos']
         prevout = TxOutpoint.from_str(prevout_str)
-        utxo = PartialTxInput(prevout=prevout)
+        utxo = PartialTxInput(prevout=prevout, txxsg=None)
         utxo._trusted_value_sats = int(item['value'])
         utxo._trusted_address = address
         utxo.block_height = int(item['height'])
@@ -117,36 +131,74 @@ def _append_utxos_to_inputs(inputs: List[PartialTxInput], network: 'Network', pu
             utxo.redeem_script = bfh(bitcoin.p2wpkh_nested_script(pubkey))
         inputs.append(utxo)
 
-def sweep_preparations(privkeys, network: 'Network', imax=100):
 
-    def find_utxos_for_privkey(txin_type, privkey, compressed):
-        pubkey = ecc.ECPrivkey(privkey).get_public_key_hex(compressed=compressed)
-        _append_utxos_to_inputs(inputs, network, pubkey, txin_type, imax)
-        keypairs[pubkey] = privkey, compressed
-    inputs = []  # type: List[PartialTxInput]
-    keypairs = {}
+async def sweep_preparations_async(privkeys, network: 'Network', imax=100, *,
+                                   progress_callback: Callable[[int, int], None] = None):
+    """Looks up the UTXOs of privkeys in JSON-RPC batches of SWEEP_BATCH_SIZE,
+    with up to SWEEP_MAX_CONCURRENT_REQUESTS batches in flight.
+    progress_callback is called with the number of completed and total
+    lookups after each batch.
+    """
+    lookups = []  # type: List[Tuple[str, bytes, bool]]
     for sec in privkeys:
         txin_type, privkey, compressed = bitcoin.deserialize_privkey(sec)
-        find_utxos_for_privkey(txin_type, privkey, compressed)
+        lookups.append((txin_type, privkey, compressed))
         # do other lookups to increase support coverage
         if is_minikey(sec):
             # minikeys don't have a compressed byte
             # we lookup both compressed and uncompressed pubkeys
-            find_utxos_for_privkey(txin_type, privkey, not compressed)
+            lookups.append((txin_type, privkey, not compressed))
         elif txin_type == 'p2pkh':
             # WIF serialization does not distinguish p2pkh and p2pk
             # we also search for pay-to-pubkey outputs
-            find_utxos_for_privkey('p2pk', privkey, compressed)
+            lookups.append(('p2pk', privkey, compressed))
+    pubkeys, scripthashes, addresses = [], [], []
+    for txin_type, privkey, compressed in lookups:
+        pubkey = ecc.ECPrivkey(privkey).get_public_key_hex(compressed=compressed)
+        scripthash, address = _get_sweep_scripthash(pubkey, txin_type)
+        pubkeys.append(pubkey)
+        scripthashes.append(scripthash)
+        addresses.append(address)
+    semaphore = asyncio.Semaphore(SWEEP_MAX_CONCURRENT_REQUESTS)
+    num_done = 0
+
+    async def find_utxos_for_batch(batch_scripthashes):
+        nonlocal num_done
+        async with semaphore:
+            utxos = await network.listunspent_for_scripthashes(batch_scripthashes)
+        num_done += len(batch_scripthashes)
+        if progress_callback:
+            progress_callback(num_done, len(lookups))
+        return utxos
+
+    batches = [scripthashes[i:i+SWEEP_BATCH_SIZE]
+               for i in range(0, len(scripthashes), SWEEP_BATCH_SIZE)]
+    results = await asyncio.gather(*[find_utxos_for_batch(x) for x in batches])
+    inputs = []  # type: List[PartialTxInput]
+    keypairs = {}
+    utxos_per_lookup = (utxos for batch_utxos in results for utxos in batch_utxos)
+    for (txin_type, privkey, compressed), pubkey, address, utxos in zip(lookups, pubkeys, addresses, utxos_per_lookup):
+        _append_utxos_to_inputs(inputs, utxos, pubkey=pubkey, txin_type=txin_type,
+                                address=address, imax=imax)
+        keypairs[pubkey] = privkey, compressed
     if not inputs:
         raise Exception(_('No inputs found. (Note that inputs need to be confirmed)'))
         # FIXME actually inputs need not be confirmed now, see https://github.com/kyuupichan/electrumx/issues/365
     return inputs, keypairs
 
 
-def sweep(privkeys, *, network: 'Network', config: 'SimpleConfig',
-          to_address: str, fee: int = None, imax=100,
-          locktime=None, tx_version=None) -> PartialTransaction:
-    inputs, keypairs = sweep_preparations(privkeys, network, imax)
+def sweep_preparations(privkeys, network: 'Network', imax=100, *,
+                       progress_callback: Callable[[int, int], None] = None):
+    return network.run_from_another_thread(
+        sweep_preparations_async(privkeys, network, imax, progress_callback=progress_callback))
+
+
+async def sweep_async(privkeys, *, network: 'Network', config: 'SimpleConfig',
+                      to_address: str, fee: int = None, imax=100,
+                      locktime=None, tx_version=None,
+                      progress_callback: Callable[[int, int], None] = None) -> PartialTransaction:
+    inputs, keypairs = await sweep_preparations_async(privkeys, network, imax,
+                                                      progress_callback=progress_callback)
     total = sum(txin.value_sats() for txin in inputs)
     if fee is None:
         outputs = [PartialTxOutput(scriptpubkey=bfh(bitcoin.address_to_script(to_address)),
@@ -169,6 +221,14 @@ def sweep(privkeys, *, network: 'Network', config: 'SimpleConfig',
     return tx
 
 
+def sweep(privkeys, *, network: 'Network', config: 'SimpleConfig',
+          to_address: str, fee: int = None, imax=100,
+          locktime=None, tx_version=None) -> PartialTransaction:
+    return network.run_from_another_thread(
+        sweep_async(privkeys, network=network, config=config, to_address=to_address,
+                    fee=fee, imax=imax, locktime=locktime, tx_version=tx_version))
+
+
 def get_locktime_for_new_transaction(network: 'Network') -> int:
     # if no network or not up to date, just set locktime to zero
     if not network:
@@ -235,6 +295,10 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         # load addresses needs to be called before constructor for sanity checks
         self.storage.db.load_addresses(self.wallet_type)
         self.keystore = None  # type: Optional[KeyStore]  # will be set by load_keystore
+        # the payment request index is built on first use, see _build_request_index
+        self._request_index_ready = False
+        # ccy -> txid -> average acquisition price of the coins spent by txid
+        self._acquisition_prices = {}  # type: Dict[str, Dict[str, Decimal]]
         AddressSynchronizer.__init__(self, storage.db)
 
         # saved fields
@@ -264,7 +328,6 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         if self.storage.get('wallet_type') is None:
             self.storage.put('wallet_type', self.wallet_type)
         self.contacts = Contacts(self.storage)
-        self._coin_price_cache = {}
         # lightning
         ln_xprv = self.storage.get('lightning_privkey2')
         self.lnworker = LNWallet(self, ln_xprv) if ln_xprv else None
@@ -408,6 +471,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
                 self.fiat_value[ccy] = {}
             self.fiat_value[ccy][txid] = text
         self.storage.put('fiat_value', self.fiat_value)
+        self._clear_acquisition_prices([txid])
         return reset
 
     def get_fiat_value(self, txid, ccy):
@@ -714,8 +778,38 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
 
         if tx_was_added:
             self._maybe_set_tx_label_based_on_invoices(tx)
+            self._update_request_status(self.db.get_txo_addresses(tx.txid()))
+            self._clear_acquisition_prices([tx.txid()])
         return tx_was_added
 
+    def remove_transaction(self, tx_hash):
+        addresses = self.db.get_txo_addresses(tx_hash)
+        # before the outpoints it spends are forgotten
+        self._clear_acquisition_prices([tx_hash])
+        super().remove_transaction(tx_hash)
+        self._update_request_status(addresses)
+
+    def add_unverified_tx(self, tx_hash, tx_height):
+        super().add_unverified_tx(tx_hash, tx_height)
+        self._update_request_status(self.db.get_txo_addresses(tx_hash))
+        self._clear_acquisition_prices([tx_hash])
+
+    def add_verified_tx(self, tx_hash, info):
+        super().add_verified_tx(tx_hash, info)
+        self._update_request_status(self.db.get_txo_addresses(tx_hash))
+        self._clear_acquisition_prices([tx_hash])
+
+    def undo_verifications(self, blockchain, above_height):
+        txs = super().undo_verifications(blockchain, above_height)
+        self._update_request_status(set(itertools.chain.from_iterable(
+            self.db.get_txo_addresses(tx_hash) for tx_hash in txs)))
+        self._clear_acquisition_prices(txs)
+        return txs
+
+    def receive_history_callback(self, addr, hist, tx_fees):
+        super().receive_history_callback(addr, hist, tx_fees)
+        self._update_request_status([addr])
+
     @profiler
     def get_full_history(self, fx=None, *, onchain_domain=None, include_lightning=True):
         transactions = OrderedDictWithIndex()
@@ -744,7 +838,9 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
                 transactions[key] = tx_item
         now = time.time()
         balance = 0
-        for item in transactions.values():
+        if fx:
+            fiat_rates = fx.timestamp_rates([item['timestamp'] or now for item in transactions.values()])
+        for i, item in enumerate(transactions.values()):
             # add on-chain and lightning values
             value = Decimal(0)
             if item.get('bc_value'):
@@ -755,91 +851,127 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
             balance += value
             item['balance'] = Satoshis(balance)
             if fx:
-                timestamp = item['timestamp'] or now
-                fiat_value = value / Decimal(bitcoin.COIN) * fx.timestamp_rate(timestamp)
+                fiat_value = value / Decimal(bitcoin.COIN) * fiat_rates[i]
                 item['fiat_value'] = Fiat(fiat_value, fx.ccy)
                 item['fiat_default'] = True
         return transactions
 
-    @profiler
-    def get_detailed_history(self, from_timestamp=None, to_timestamp=None,
-                             fx=None, show_addresses=False):
-        # History with capital gains, using utxo pricing
-        # FIXME: Lightning capital gains would requires FIFO
-        out = []
-        income = 0
-        expenditures = 0
-        capital_gains = Decimal(0)
-        fiat_income = Decimal(0)
-        fiat_expenditures = Decimal(0)
+    def iter_detailed_history(self, *, from_timestamp=None, to_timestamp=None,
+                              from_height=None, to_height=None, after_txid=None,
+                              fx=None, show_addresses=False):
+        """Yields the transactions of get_detailed_history, oldest first.
+        Fiat values and addresses are only computed for the items that are
+        consumed, so that callers can page through large histories.
+        """
+        show_fiat = fx and fx.is_enabled() and fx.get_history_config()
         now = time.time()
-        for item in self.get_onchain_history():
+        history = self.get_onchain_history()
+        if after_txid is not None:
+            for item in history:
+                if item['txid'] == after_txid:
+                    break
+            else:
+                raise Exception(f'transaction not in history: {after_txid}')
+        for item in history:
             timestamp = item['timestamp']
             if from_timestamp and (timestamp or now) < from_timestamp:
                 continue
             if to_timestamp and (timestamp or now) >= to_timestamp:
                 continue
+            height = item['height']
+            if from_height is not None and from_height > height > 0:
+                continue
+            if to_height is not None and (height >= to_height or height <= 0):
+                continue
             tx_hash = item['txid']
-            tx = self.db.get_transaction(tx_hash)
             tx_fee = item['fee_sat']
             item['fee'] = Satoshis(tx_fee) if tx_fee is not None else None
             if show_addresses:
+                tx = self.db.get_transaction(tx_hash)
                 item['inputs'] = list(map(lambda x: x.to_json(), tx.inputs()))
                 item['outputs'] = list(map(lambda x: {'address': x.get_ui_address_str(), 'value': Satoshis(x.value)},
                                            tx.outputs()))
+            if show_fiat:
+                item.update(self.get_tx_item_fiat(tx_hash, item['bc_value'].value, fx, tx_fee))
+            yield item
+
+    @profiler
+    def get_detailed_history(self, from_timestamp=None, to_timestamp=None,
+                             fx=None, show_addresses=False, *,
+                             from_height=None, to_height=None, after_txid=None, limit=None):
+        """Returns the transactions of the given range, and their summary.
+        With limit or after_txid, only one page of the range is returned,
+        and the summary covers that page only; the result then has
+        summary_scope set to 'page'.
+        """
+        # History with capital gains, using utxo pricing
+        # FIXME: Lightning capital gains would requires FIFO
+        out = list(itertools.islice(
+            self.iter_detailed_history(from_timestamp=from_timestamp, to_timestamp=to_timestamp,
+                                       from_height=from_height, to_height=to_height,
+                                       after_txid=after_txid, fx=fx, show_addresses=show_addresses),
+            limit))
+        result = {
+            'transactions': out,
+            'summary': self.get_history_summary(out, from_timestamp, to_timestamp, fx=fx),
+        }
+        if limit is not None or after_txid is not None:
+            result['summary_scope'] = 'page'
+        return result
+
+    def get_history_summary(self, out, from_timestamp=None, to_timestamp=None, *, fx=None):
+        """Totals of a list of items returned by iter_detailed_history."""
+        if not out:
+            return {}
+        show_fiat = fx and fx.is_enabled() and fx.get_history_config()
+        income = 0
+        expenditures = 0
+        capital_gains = Decimal(0)
+        fiat_income = Decimal(0)
+        fiat_expenditures = Decimal(0)
+        for item in out:
             # fixme: use in and out values
             value = item['bc_value'].value
             if value < 0:
                 expenditures += -value
             else:
                 income += value
-            # fiat computations
-            if fx and fx.is_enabled() and fx.get_history_config():
-                fiat_fields = self.get_tx_item_fiat(tx_hash, value, fx, tx_fee)
-                fiat_value = fiat_fields['fiat_value'].value
-                item.update(fiat_fields)
+            if show_fiat:
+                fiat_value = item['fiat_value'].value
                 if value < 0:
-                    capital_gains += fiat_fields['capital_gain'].value
+                    capital_gains += item['capital_gain'].value
                     fiat_expenditures += -fiat_value
                 else:
                     fiat_income += fiat_value
-            out.append(item)
-        # add summary
-        if out:
-            b, v = out[0]['bc_balance'].value, out[0]['bc_value'].value
-            start_balance = None if b is None or v is None else b - v
-            end_balance = out[-1]['bc_balance'].value
-            if from_timestamp is not None and to_timestamp is not None:
-                start_date = timestamp_to_datetime(from_timestamp)
-                end_date = timestamp_to_datetime(to_timestamp)
-            else:
-                start_date = None
-                end_date = None
-            summary = {
-                'start_date': start_date,
-                'end_date': end_date,
-                'start_balance': Satoshis(start_balance),
-                'end_balance': Satoshis(end_balance),
-                'incoming': Satoshis(income),
-                'outgoing': Satoshis(expenditures)
-            }
-            if fx and fx.is_enabled() and fx.get_history_config():
-                unrealized = self.unrealized_gains(None, fx.timestamp_rate, fx.ccy)
-                summary['fiat_currency'] = fx.ccy
-                summary['fiat_capital_gains'] = Fiat(capital_gains, fx.ccy)
-                summary['fiat_incoming'] = Fiat(fiat_income, fx.ccy)
-                summary['fiat_outgoing'] = Fiat(fiat_expenditures, fx.ccy)
-                summary['fiat_unrealized_gains'] = Fiat(unrealized, fx.ccy)
-                summary['fiat_start_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
-                summary['fiat_end_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
-                summary['fiat_start_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
-                summary['fiat_end_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
+        b, v = out[0]['bc_balance'].value, out[0]['bc_value'].value
+        start_balance = None if b is None or v is None else b - v
+        end_balance = out[-1]['bc_balance'].value
+        if from_timestamp is not None and to_timestamp is not None:
+            start_date = timestamp_to_datetime(from_timestamp)
+            end_date = timestamp_to_datetime(to_timestamp)
         else:
-            summary = {}
-        return {
-            'transactions': out,
-            'summary': summary
+            start_date = None
+            end_date = None
+        summary = {
+            'start_date': start_date,
+            'end_date': end_date,
+            'start_balance': Satoshis(start_balance),
+            'end_balance': Satoshis(end_balance),
+            'incoming': Satoshis(income),
+            'outgoing': Satoshis(expenditures)
         }
+        if show_fiat:
+            unrealized = self.unrealized_gains(None, fx.timestamp_rate, fx.ccy)
+            summary['fiat_currency'] = fx.ccy
+            summary['fiat_capital_gains'] = Fiat(capital_gains, fx.ccy)
+            summary['fiat_incoming'] = Fiat(fiat_income, fx.ccy)
+            summary['fiat_outgoing'] = Fiat(fiat_expenditures, fx.ccy)
+            summary['fiat_unrealized_gains'] = Fiat(unrealized, fx.ccy)
+            summary['fiat_start_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
+            summary['fiat_end_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
+            summary['fiat_start_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
+            summary['fiat_end_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
+        return summary
 
     def default_fiat_value(self, tx_hash, fx, value_sat):
         return value_sat / Decimal(COIN) * self.price_at_timestamp(tx_hash, fx.timestamp_rate)
@@ -1496,26 +1628,35 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
     def create_new_address(self, for_change: bool = False):
         raise Exception("this wallet cannot generate new addresses")
 
-    def get_payment_status(self, address, amount):
-        local_height = self.get_local_height()
+    def _get_payment_height(self, address, amount) -> Tuple[bool, Optional[int]]:
+        """Returns whether address received amount, and the height of the
+        last output needed to reach it (0 if that output is not verified).
+        """
         received, sent = self.get_addr_io(address)
         l = []
         for txo, x in received.items():
             h, v, is_cb = x
             txid, n = txo.split(':')
             info = self.db.get_verified_tx(txid)
-            if info:
-                conf = local_height - info.height + 1
-            else:
-                conf = 0
-            l.append((conf, v))
+            l.append((info.height if info else 0, v))
+        # most confirmed first, unverified last
+        l.sort(key=lambda x: (x[0] <= 0, x[0]))
         vsum = 0
-        for conf, v in reversed(sorted(l)):
+        for height, v in l:
             vsum += v
             if vsum >= amount:
-                return True, conf
+                return True, height
         return False, None
 
+    def get_payment_status(self, address, amount):
+        paid, height = self._get_payment_height(address, amount)
+        if not paid:
+            return False, None
+        return True, self._payment_conf(height)
+
+    def _payment_conf(self, height):
+        return self.get_local_height() - height + 1 if height > 0 else 0
+
     def get_request_URI(self, addr):
         req = self.receive_requests[addr]
         message = self.labels.get(addr, '')
@@ -1533,25 +1674,116 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         uri = create_bip21_uri(addr, amount, message, extra_query_params=extra_query_params)
         return str(uri)
 
-    def get_request_status(self, address):
+    def _build_request_index(self):
+        """Index the on-chain payment requests by status, and their
+        expiry times in a timer wheel, so that requests can be listed by
+        status without recomputing the status of every request.
+        """
+        with self.lock:
+            # address -> (paid, height), see _get_payment_height
+            self._request_payment_height = {}  # type: Dict[str, Tuple[bool, Optional[int]]]
+            # key -> status, and status -> keys
+            self._request_status = {}  # type: Dict[str, int]
+            self._requests_by_status = defaultdict(set)  # type: Dict[int, Set[str]]
+            # timer wheel: bucket -> keys of unpaid requests expiring in that bucket
+            self._request_expiry_buckets = defaultdict(set)  # type: Dict[int, Set[str]]
+            self._request_expiry_heap = []  # type: List[int]
+            self._request_index_ready = True
+            for key, req in self.receive_requests.items():
+                self._index_request(key)
+
+    def _ensure_request_index(self):
+        if not self._request_index_ready:
+            self._build_request_index()
+        self._expire_requests()
+
+    def _index_request(self, key):
+        # note: call with self.lock
+        self._unindex_request(key)
+        req = self.receive_requests.get(key)
+        if req is None or req.get('type') != PR_TYPE_ONCHAIN:
+            return
+        status, conf = self._compute_request_status(key)
+        self._request_status[key] = status
+        self._requests_by_status[status].add(key)
+        expiry = self._get_request_expiry(req)
+        if status == PR_UNPAID and expiry:
+            bucket = expiry // REQUEST_EXPIRY_BUCKET_SIZE
+            if bucket not in self._request_expiry_buckets:
+                heapq.heappush(self._request_expiry_heap, bucket)
+            self._request_expiry_buckets[bucket].add(key)
+
+    def _unindex_request(self, key):
+        # note: call with self.lock. Expiry buckets are cleaned up lazily.
+        status = self._request_status.pop(key, None)
+        if status is not None:
+            self._requests_by_status[status].discard(key)
+
+    def _expire_requests(self):
+        """Moves the unpaid requests that have expired to the expired set."""
+        now = time.time()
+        with self.lock:
+            heap = self._request_expiry_heap
+            while heap and heap[0] * REQUEST_EXPIRY_BUCKET_SIZE <= now:
+                bucket = heap[0]
+                keys = self._request_expiry_buckets[bucket]
+                for key in list(keys):
+                    req = self.receive_requests.get(key)
+                    if req is not None and self._request_status.get(key) == PR_UNPAID:
+                        if now <= self._get_request_expiry(req):
+                            continue
+                        self._requests_by_status[PR_UNPAID].discard(key)
+                        self._requests_by_status[PR_EXPIRED].add(key)
+                        self._request_status[key] = PR_EXPIRED
+                    keys.discard(key)
+                if keys:
+                    # current bucket, the remaining requests have not expired yet
+                    break
+                heapq.heappop(heap)
+                del self._request_expiry_buckets[bucket]
+
+    def _update_request_status(self, addresses):
+        if not self._request_index_ready:
+            return
+        with self.lock:
+            for addr in addresses:
+                self._request_payment_height.pop(addr, None)
+                if addr in self.receive_requests:
+                    self._index_request(addr)
+
+    @staticmethod
+    def _get_request_expiry(req) -> int:
+        timestamp = req.get('time', 0)
+        if timestamp and type(timestamp) != int:
+            timestamp = 0
+        exp = req.get('exp', 0) or 0
+        return timestamp + exp if exp > 0 else 0
+
+    def _compute_request_status(self, address):
         r = self.receive_requests.get(address)
         if r is None:
             return PR_UNKNOWN
         amount = r.get('amount', 0) or 0
-        timestamp = r.get('time', 0)
-        if timestamp and type(timestamp) != int:
-            timestamp = 0
-        exp = r.get('exp', 0) or 0
-        paid, conf = self.get_payment_status(address, amount)
+        with self.lock:
+            if address not in self._request_payment_height:
+                self._request_payment_height[address] = self._get_payment_height(address, amount)
+            paid, height = self._request_payment_height[address]
         if not paid:
-            if exp > 0 and time.time() > timestamp + exp:
+            expiry = self._get_request_expiry(r)
+            if expiry and time.time() > expiry:
                 status = PR_EXPIRED
             else:
                 status = PR_UNPAID
+            conf = None
         else:
             status = PR_PAID
+            conf = self._payment_conf(height)
         return status, conf
 
+    def get_request_status(self, address):
+        self._ensure_request_index()
+        return self._compute_request_status(address)
+
     def get_request(self, key):
         req = self.receive_requests.get(key)
         if not req:
@@ -1632,6 +1864,11 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         amount = req.get('amount')
         self.receive_requests[key] = req
         self.storage.put('payment_requests', self.receive_requests)
+        if self._request_index_ready:
+            with self.lock:
+                # the amount may have changed, so the cached payment height is stale
+                self._request_payment_height.pop(key, None)
+                self._index_request(key)
         self.set_label(key, message) # should be a default label
         return req
 
@@ -1655,14 +1892,42 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
             return False
         self.receive_requests.pop(addr)
         self.storage.put('payment_requests', self.receive_requests)
+        if self._request_index_ready:
+            with self.lock:
+                self._unindex_request(addr)
+                self._request_payment_height.pop(addr, None)
         return True
 
+    def iter_sorted_requests(self, *, after_key=None, status=None):
+        """ sorted by timestamp. The status of a request is only
+        computed when it is consumed. If status is given, on-chain
+        requests are looked up in the request index. """
+        if status in (PR_UNPAID, PR_PAID, PR_EXPIRED):
+            self._ensure_request_index()
+            with self.lock:
+                keys = set(self._requests_by_status[status])
+                keys |= {k for k, r in self.receive_requests.items() if r.get('type') != PR_TYPE_ONCHAIN}
+                if after_key is not None:
+                    keys.add(after_key)
+        else:
+            keys = self.receive_requests.keys()
+        # note: ties are broken by key, so that pages are stable
+        keys = sorted(keys, key=lambda k: (self.receive_requests[k]['time'] if k in self.receive_requests else 0, k))
+        if after_key is not None:
+            if after_key not in self.receive_requests:
+                raise Exception(f'request not found: {after_key}')
+            keys = keys[keys.index(after_key) + 1:]
+        for key in keys:
+            req = self.get_request(key)
+            if req is None:
+                continue
+            if status is not None and req['status'] != status:
+                continue
+            yield req
+
     def get_sorted_requests(self):
         """ sorted by timestamp """
-        out = [self.get_request(x) for x in self.receive_requests.keys()]
-        out = [x for x in out if x is not None]
-        out.sort(key=operator.itemgetter('time'))
-        return out
+        return list(self.iter_sorted_requests())
 
     @abstractmethod
     def get_fingerprint(self):
@@ -1783,17 +2048,62 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
 
     def average_price(self, txid, price_func, ccy):
         """ Average acquisition price of the inputs of a transaction """
-        input_value = 0
-        total_price = 0
-        for addr in self.db.get_txi_addresses(txid):
-            d = self.db.get_txi_addr(txid, addr)
-            for ser, v in d:
-                input_value += v
-                total_price += self.coin_price(ser.split(':')[0], price_func, ccy, v)
-        return total_price / (input_value/Decimal(COIN))
+        with self.lock:
+            prices = self._acquisition_prices.setdefault(ccy, {})
+            price = prices.get(txid)
+            if price is not None:
+                return price
+            # Walk the ancestry of txid, parents before children, so that
+            # each transaction is priced once. An explicit stack is used
+            # because self-transfer chains can be deeper than the
+            # recursion limit.
+            stack = [txid]
+            while stack:
+                tx_hash = stack[-1]
+                if tx_hash in prices:
+                    stack.pop()
+                    continue
+                inputs = [(ser.split(':')[0], v)
+                          for addr in self.db.get_txi_addresses(tx_hash)
+                          for ser, v in self.db.get_txi_addr(tx_hash, addr)]
+                parents = [prev_hash for prev_hash, v in inputs
+                           if prev_hash not in prices and self.db.get_txi_addresses(prev_hash)]
+                if parents:
+                    stack.extend(parents)
+                    continue
+                stack.pop()
+                input_value = 0
+                total_price = 0
+                for prev_hash, v in inputs:
+                    input_value += v
+                    total_price += self.coin_price(prev_hash, price_func, ccy, v)
+                prices[tx_hash] = total_price / (input_value/Decimal(COIN))
+            return prices[txid]
 
     def clear_coin_price_cache(self):
-        self._coin_price_cache = {}
+        """To be called when the fiat price history changes."""
+        with self.lock:
+            self._acquisition_prices = {}
+
+    def _clear_acquisition_prices(self, txids):
+        """Forgets the acquisition prices of txids and of their descendants."""
+        if not any(self._acquisition_prices.values()):
+            return
+        with self.lock:
+            todo = list(txids)
+            done = set()
+            while todo:
+                tx_hash = todo.pop()
+                if tx_hash in done:
+                    continue
+                done.add(tx_hash)
+                for prices in self._acquisition_prices.values():
+                    prices.pop(tx_hash, None)
+                for addr in self.db.get_txo_addresses(tx_hash):
+                    for n, v, is_cb in self.db.get_txo_addr(tx_hash, addr):
+                        spender = self.db.get_spent_outpoint(tx_hash, n)
+                        if spender:
+                            todo.append(spender)
 
     def coin_price(self, txid, price_func, ccy, txin_value):
         """
@@ -1802,14 +2112,8 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         """
         if txin_value is None:
             return Decimal('NaN')
-        cache_key = "{}:{}:{}".format(str(txid), str(ccy), str(txin_value))
-        result = self._coin_price_cache.get(cache_key, None)
-        if result is not None:
-            return result
         if self.db.get_txi_addresses(txid):
-            result = self.average_price(txid, price_func, ccy) * txin_value/Decimal(COIN)
-            self._coin_price_cache[cache_key] = result
-            return result
+            return self.average_price(txid, price_func, ccy) * txin_value/Decimal(COIN)
         else:
             fiat_value = self.get_fiat_value(txid, ccy)
             if fiat_value is not None:
@@ -1946,7 +2250,7 @@ class Imported_Wallet(Simple_Wallet):
                 continue
             good_addr.append(address)
             self.db.add_imported_address(address, {})
-            self.add_address(address)
+        self.add_addresses(good_addr)
         if write_to_disk:
             self.storage.write()
         return good_addr, bad_addr
@@ -2023,7 +2327,7 @@ class Imported_Wallet(Simple_Wallet):
             addr = bitcoin.pubkey_to_address(txin_type, pubkey)
             good_addr.append(addr)
             self.db.add_imported_address(addr, {'type':txin_type, 'pubkey':pubkey})
-            self.add_address(addr)
+        self.add_addresses(good_addr)
         self.save_keystore()
         if write_to_disk:
             self.storage.write()